@@ -0,0 +1,324 @@
+"""End-to-end throughput and latency benchmark of the GEC/GRECO pipelines."""
+
+import argparse
+import asyncio
+import datetime
+import importlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from caches.response_cache import ResponseCache
+from metrics.stage_timer import get_stage_timer, percentile
+from metrics.usage import get_usage_tracker
+
+
+# GRECO workflow only, quality estimation replayed from a recorded cassette:
+# python3 -m benchmarks.run_benchmark --target greco --qe replay
+# main.py end to end, quality estimation served by clients/mock_llm_server:
+# python3 -m benchmarks.run_benchmark --target gec --qe local --endpoint http://127.0.0.1:8000/v1 --input test/ABCN.dev.gold.bea19.orig
+# Compare with an earlier run:
+# python3 -m benchmarks.run_benchmark --target greco --qe replay --compare benchmarks/results/greco_abc1234_20240501_120000.json
+
+
+TARGETS = ["gec", "greco"]
+QE_CLIENTS = ["replay", "local", "live"]
+DEFAULT_INPUTS = [
+    "test/ABCN.dev.gold.bea19.first5.orig",
+    "test/ABCN.dev.gold.bea19.first30.orig",
+    "test/ABCN.dev.gold.bea19.first100.orig",
+]
+RESULTS_DIR = "benchmarks/results"
+# Lines per execute_workflow call, as main.py batches them for GRECO
+GRECO_BATCH_LINES = 20
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS; children covers
+    # GRECO pool workers
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak / scale
+
+
+def configure_greco(args: argparse.Namespace) -> Any:
+    greco = importlib.import_module("systems.greco")
+    # Every request reaches a client, so latency is the client's, not the
+    # response cache's
+    greco.response_cache = ResponseCache(mode="off")
+    greco.DOC_CACHE_PATH = args.doc_cache
+    if args.qe == "replay":
+        greco.REPLAY_MODE = "replay"
+        greco.REPLAY_CASSETTE_PATH = args.cassette
+        greco.REPLAY_LATENCY_SCALE = args.latency_scale
+    elif args.qe == "local":
+        greco.QUALITY_ESTIMATION_MODEL_NAME = greco.LOCAL_LLM_MODELS[0]
+        greco.LOCAL_ENDPOINT = args.endpoint
+    greco.openai_clients.clear()
+    return greco
+
+
+async def run_greco(
+    greco: Any, input_path: str, args: argparse.Namespace
+) -> Dict[str, Any]:
+    with open(input_path) as f:
+        lines = f.read().strip().split("\n")
+    batches = [
+        "\n".join(lines[start : start + GRECO_BATCH_LINES])
+        for start in range(0, len(lines), GRECO_BATCH_LINES)
+    ]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+
+    async def run_batch(batch: str) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await greco.execute_workflow(batch)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[run_batch(batch) for batch in batches])
+    return {"sentences": len(lines), "batch_latencies": latencies}
+
+
+async def run_gec(
+    gec: Any, input_path: str, args: argparse.Namespace
+) -> Dict[str, Any]:
+    # Fresh output paths, so process_file never asks to resume
+    output_dir = tempfile.mkdtemp(prefix="benchmark_")
+    name = os.path.basename(input_path)
+    gec.FINAL_OUTPUT_PATH = os.path.join(output_dir, f"{name}.corrected")
+    gec.CSV_OUTPUT_PATH = os.path.join(output_dir, f"{name}.corrected.csv")
+    gec.FINAL_OUTPUT_PATH_AUGMENTED_POOL = os.path.join(
+        output_dir, f"{name}.augmented_pool.corrected"
+    )
+    gec.CACHE_FILE_PATH = os.path.join(output_dir, f"{name}.batches")
+    gec.DEAD_LETTER_PATH = os.path.join(
+        output_dir, f"{name}.dead_letter.jsonl"
+    )
+    gec.JOURNAL_PATH = os.path.join(output_dir, f"{name}.journal.sqlite3")
+
+    # The output files are written while the batches finish
+    await gec.process_file(gec.client, input_path, gec.CSV_OUTPUT_PATH)
+    with open(input_path) as f:
+        sentences = len(f.read().strip().split("\n"))
+    return {
+        "sentences": sentences,
+        "batch_latencies": list(get_stage_timer().durations["batch"]),
+        "output_dir": output_dir,
+    }
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    greco = configure_greco(args)
+    gec = None
+    if args.target == "gec":
+        gec = importlib.import_module("main")
+        gec.USE_SEMANTIC_CHUNKING = False
+        gec.response_cache = ResponseCache(mode="off")
+
+    runs = []
+    for input_path in args.input:
+        for repeat in range(args.repeat):
+            get_stage_timer().reset()
+            get_usage_tracker().reset()
+            start = time.perf_counter()
+            if gec is not None:
+                run = await run_gec(gec, input_path, args)
+            else:
+                run = await run_greco(greco, input_path, args)
+            wall_seconds = time.perf_counter() - start
+
+            latencies = run.pop("batch_latencies")
+            run.update(
+                {
+                    "input": input_path,
+                    "repeat": repeat,
+                    "batches": len(latencies),
+                    "wall_seconds": wall_seconds,
+                    "sentences_per_second": run["sentences"] / wall_seconds,
+                    "batch_latency": {
+                        "p50_seconds": percentile(latencies, 50),
+                        "p95_seconds": percentile(latencies, 95),
+                        "p99_seconds": percentile(latencies, 99),
+                        "max_seconds": max(latencies, default=0.0),
+                    },
+                    "stages": get_stage_timer().get_summary(),
+                    "peak_rss_mb": get_peak_rss_mb(),
+                    "usage": get_usage_tracker().get_totals(group_by=1),
+                }
+            )
+            runs.append(run)
+            print_run(run)
+
+    return {
+        "meta": {
+            "target": args.target,
+            "qe": args.qe,
+            "commit": get_commit(),
+            "created_at": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "concurrency": args.concurrency,
+        },
+        "runs": runs,
+    }
+
+
+def print_run(run: Dict[str, Any]) -> None:
+    latency = run["batch_latency"]
+    print(
+        f"{run['input']} #{run['repeat']}: {run['sentences']} sentences in "
+        f"{run['wall_seconds']:.2f}s ({run['sentences_per_second']:.2f}/s), "
+        f"batch p50/p95/p99 {latency['p50_seconds']:.2f}/"
+        f"{latency['p95_seconds']:.2f}/{latency['p99_seconds']:.2f}s, "
+        f"peak RSS {run['peak_rss_mb']:.0f} MB"
+    )
+    for name, stage in sorted(
+        run["stages"].items(), key=lambda item: -item[1]["total_seconds"]
+    ):
+        print(
+            f"  {name:<20} {stage['total_seconds']:>9.2f}s total "
+            f"{stage['count']:>6} calls  p95 {stage['p95_seconds']:.3f}s"
+        )
+    for name, usage in run["usage"].items():
+        print(
+            f"  {name:<20} {usage['prompt_tokens']:>9} prompt and "
+            f"{usage['completion_tokens']} completion tokens, "
+            f"{usage['continuation_calls']} continuations"
+        )
+
+
+def compare_results(
+    baseline: Dict[str, Any], results: Dict[str, Any]
+) -> None:
+    # Best of the repeats for each input, on both sides
+    def best_runs(runs: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        best: Dict[str, Dict[str, Any]] = {}
+        for run in runs:
+            current = best.get(run["input"])
+            if (
+                current is None
+                or run["sentences_per_second"]
+                > current["sentences_per_second"]
+            ):
+                best[run["input"]] = run
+        return best
+
+    before = best_runs(baseline["runs"])
+    after = best_runs(results["runs"])
+    print(
+        f"Compared with {baseline['meta'].get('commit')} "
+        f"({baseline['meta'].get('created_at')}):"
+    )
+    for input_path, run in after.items():
+        if input_path not in before:
+            continue
+        old = before[input_path]
+        throughput_change = (
+            run["sentences_per_second"] / old["sentences_per_second"] - 1
+        )
+        old_p95 = old["batch_latency"]["p95_seconds"]
+        p95_change = (
+            run["batch_latency"]["p95_seconds"] / old_p95 - 1
+            if old_p95
+            else 0.0
+        )
+        print(
+            f"  {input_path}: throughput {throughput_change:+.1%}, "
+            f"batch p95 {p95_change:+.1%}, peak RSS "
+            f"{run['peak_rss_mb'] - old['peak_rss_mb']:+.0f} MB"
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the GEC (main.py) or GRECO pipeline on fixed "
+        "inputs and save the results as JSON."
+    )
+    parser.add_argument("--target", choices=TARGETS, default="greco")
+    parser.add_argument(
+        "--input",
+        nargs="+",
+        default=DEFAULT_INPUTS,
+        help="Input .orig files, each benchmarked in turn.",
+    )
+    parser.add_argument(
+        "--qe",
+        choices=QE_CLIENTS,
+        default="replay",
+        help="Where quality estimation requests go: a recorded cassette, "
+        "a local stand-in server, or the configured endpoint.",
+    )
+    parser.add_argument("--cassette", default="cache/greco.cassette.jsonl")
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=1.0,
+        help="Multiplier on recorded latencies when replaying.",
+    )
+    parser.add_argument("--endpoint", default="http://127.0.0.1:8000/v1")
+    parser.add_argument(
+        "--doc-cache",
+        default=None,
+        help="Doc cache to reuse parses from (default: in memory only, so "
+        "the first repeat parses everything).",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="GRECO batches run at once (--target greco).",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--out",
+        default=None,
+        help=f"Results JSON path (default: under {RESULTS_DIR}/).",
+    )
+    parser.add_argument(
+        "--compare", default=None, help="An earlier results JSON."
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(run_benchmark(args))
+
+    out = args.out
+    if out is None:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        commit = results["meta"]["commit"] or "unknown"
+        out = os.path.join(
+            RESULTS_DIR, f"{args.target}_{commit}_{timestamp}.json"
+        )
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
@@ -0,0 +1,281 @@
+"""Parse-once cache of spaCy Docs: an in-memory LRU over a DocBin store."""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+from spacy.attrs import (
+    DEP,
+    ENT_IOB,
+    ENT_TYPE,
+    HEAD,
+    LEMMA,
+    MORPH,
+    NORM,
+    POS,
+    TAG,
+)
+from spacy.tokens import Doc, DocBin
+
+
+# python3 -m caches.doc_cache --stats
+# python3 -m caches.doc_cache --clear
+
+
+DEFAULT_DOC_CACHE_PATH = "cache/docs.sqlite3"
+
+# Docs kept deserialised in memory per cache
+MAX_IN_MEMORY_DOCS = 50_000
+
+# Raw text is parsed with spaCy's tokenizer (`nlp(text)`); pretokenised text
+# is split on whitespace first, like `annotator.parse(text, tokenise=False)`
+RAW = "raw"
+PRETOKENISED = "pretokenised"
+
+# Token annotations copied when a raw parse is reused for tokenised text
+ANNOTATION_ATTRS = [TAG, POS, MORPH, LEMMA, HEAD, DEP, ENT_IOB, ENT_TYPE, NORM]
+
+
+def get_pipeline_id(nlp: Any) -> str:
+    # Parses from a different model or version must never be reused
+    meta = nlp.meta
+    return f"{meta.get('lang')}_{meta.get('name')}-{meta.get('version')}"
+
+
+def serialize_doc(doc: Doc) -> bytes:
+    doc_bin = DocBin()
+    doc_bin.add(doc)
+    return doc_bin.to_bytes()
+
+
+def deserialize_doc(data: bytes, vocab: Any) -> Doc:
+    return next(DocBin().from_bytes(data).get_docs(vocab))
+
+
+def as_pretokenised(doc: Doc) -> Doc:
+    """
+    Rebuilds a raw parse as if its tokens had been given pre-split.
+
+    Spans then read back with single spaces between tokens ("do n't" rather
+    than "don't"), exactly as `Doc(vocab, text.split())` would, so ERRANT
+    writes the same M2 strings either way.
+    """
+    pretokenised = Doc(doc.vocab, words=[token.text for token in doc])
+    pretokenised.from_array(ANNOTATION_ATTRS, doc.to_array(ANNOTATION_ATTRS))
+    return pretokenised
+
+
+class DocCache:
+    """
+    Parses each distinct sentence once and reuses the Doc everywhere.
+
+    Lookups go to an in-memory LRU first, then to a SQLite table of
+    DocBin-serialised Docs shared by every process (the GEC run, GRECO
+    workers, evaluation), and only the remaining sentences are parsed, in a
+    single `nlp.pipe` call.
+
+    A raw parse whose tokens are all non-whitespace is also stored under its
+    space-joined token text, so the tokenised output written by main.py and
+    the tokenised .orig files used for evaluation hit the parses made while
+    correcting.
+    """
+
+    def __init__(
+        self,
+        nlp: Any,
+        path: Optional[str] = DEFAULT_DOC_CACHE_PATH,
+        max_in_memory: int = MAX_IN_MEMORY_DOCS,
+        n_process: int = 1,
+        batch_size: int = 256,
+    ):
+        self.nlp = nlp
+        self.path = path
+        self.max_in_memory = max_in_memory
+        self.n_process = n_process
+        self.batch_size = batch_size
+        self.pipeline_id = get_pipeline_id(nlp)
+        self.docs: "OrderedDict[str, Doc]" = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.parsed = 0
+        self.connection: Optional[sqlite3.Connection] = None
+
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.connection = sqlite3.connect(path, timeout=30)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS docs (
+                    key TEXT PRIMARY KEY,
+                    doc BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                )"""
+            )
+            self.connection.commit()
+
+    def make_key(self, text: str, tokenise: bool) -> str:
+        if tokenise:
+            return f"{self.pipeline_id}\t{RAW}\t{text}"
+        return f"{self.pipeline_id}\t{PRETOKENISED}\t{' '.join(text.split())}"
+
+    def remember(self, key: str, doc: Doc) -> None:
+        self.docs[key] = doc
+        self.docs.move_to_end(key)
+        while len(self.docs) > self.max_in_memory:
+            self.docs.popitem(last=False)
+
+    def load(self, keys: List[str]) -> Dict[str, Doc]:
+        if self.connection is None or not keys:
+            return {}
+        loaded = {}
+        # SQLite limits the number of bound parameters per statement
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for key, data in self.connection.execute(
+                f"SELECT key, doc FROM docs WHERE key IN ({placeholders})",
+                chunk,
+            ):
+                loaded[key] = deserialize_doc(data, self.nlp.vocab)
+        return loaded
+
+    def store(self, docs: Dict[str, Doc]) -> None:
+        if self.connection is None or not docs:
+            return
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO docs (key, doc, created_at) "
+            "VALUES (?, ?, ?)",
+            [(key, serialize_doc(doc), now) for key, doc in docs.items()],
+        )
+        self.connection.commit()
+
+    def get_docs(
+        self, texts: Iterable[str], tokenise: bool = True
+    ) -> List[Doc]:
+        """
+        Returns one Doc per text, in order.
+
+        :param tokenise: True to run spaCy's tokenizer over the text, False
+            if the text is already tokenised and should be split on spaces.
+        """
+        texts = list(texts)
+        keys = [self.make_key(text, tokenise) for text in texts]
+
+        found: Dict[str, Doc] = {}
+        for key in keys:
+            if key in self.docs:
+                self.docs.move_to_end(key)
+                found[key] = self.docs[key]
+        self.memory_hits += len(found)
+
+        missing_keys = list(dict.fromkeys(k for k in keys if k not in found))
+        loaded = self.load(missing_keys)
+        self.disk_hits += len(loaded)
+        for key, doc in loaded.items():
+            self.remember(key, doc)
+        found.update(loaded)
+
+        to_parse = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in to_parse:
+                to_parse[key] = (
+                    text if tokenise else Doc(self.nlp.vocab, text.split())
+                )
+
+        if to_parse:
+            # Multiple processes only pay off once there is enough to split
+            n_process = (
+                self.n_process if len(to_parse) > self.batch_size else 1
+            )
+            parsed_docs = self.nlp.pipe(
+                to_parse.values(),
+                n_process=n_process,
+                batch_size=self.batch_size,
+            )
+            new_docs = {}
+            for key, doc in zip(to_parse, parsed_docs):
+                new_docs[key] = doc
+                if (
+                    tokenise
+                    and len(doc) > 0
+                    and not any(token.is_space for token in doc)
+                ):
+                    alias = self.make_key(
+                        " ".join(token.text for token in doc), False
+                    )
+                    if alias not in new_docs:
+                        new_docs[alias] = as_pretokenised(doc)
+            self.parsed += len(to_parse)
+            self.store(new_docs)
+            for key, doc in new_docs.items():
+                self.remember(key, doc)
+            found.update(new_docs)
+
+        return [found[key] for key in keys]
+
+    def get_doc(self, text: str, tokenise: bool = True) -> Doc:
+        return self.get_docs([text], tokenise)[0]
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "parsed": self.parsed,
+        }
+        if self.connection is not None:
+            (entries,) = self.connection.execute(
+                "SELECT COUNT(*) FROM docs"
+            ).fetchone()
+            stats["entries"] = entries
+        return stats
+
+
+# One cache per pipeline and path, shared by every caller in the process
+doc_caches: Dict[tuple, DocCache] = {}
+
+
+def get_doc_cache(
+    nlp: Any,
+    path: Optional[str] = DEFAULT_DOC_CACHE_PATH,
+    n_process: int = 1,
+    batch_size: int = 256,
+) -> DocCache:
+    key = (get_pipeline_id(nlp), path)
+    if key not in doc_caches:
+        doc_caches[key] = DocCache(
+            nlp, path, n_process=n_process, batch_size=batch_size
+        )
+    return doc_caches[key]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Inspect or clear the spaCy Doc cache."
+    )
+    parser.add_argument("--path", default=DEFAULT_DOC_CACHE_PATH)
+    parser.add_argument(
+        "--stats", action="store_true", help="Print the number of entries."
+    )
+    parser.add_argument(
+        "--clear", action="store_true", help="Delete every cached Doc."
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not os.path.exists(args.path):
+        print({"entries": 0})
+        sys.exit(0)
+    connection = sqlite3.connect(args.path, timeout=30)
+    if args.clear:
+        connection.execute("DELETE FROM docs")
+        connection.commit()
+        connection.execute("VACUUM")
+    (entries,) = connection.execute("SELECT COUNT(*) FROM docs").fetchone()
+    print({"entries": entries})
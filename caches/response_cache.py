@@ -0,0 +1,252 @@
+"""Persistent, content-addressed cache of LLM responses backed by SQLite."""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Optional
+
+
+# python3 -m caches.response_cache --stats
+# python3 -m caches.response_cache --evict --max-age-days 30 --max-size-mb 500
+
+
+DEFAULT_CACHE_PATH = "cache/responses.sqlite3"
+
+# "readwrite": serve hits and store new responses
+# "readonly": serve hits only; never writes, so evaluation runs are reproducible
+# "off": bypass the cache entirely
+CACHE_MODES = ["readwrite", "readonly", "off"]
+
+# Run size-based eviction every this many writes
+EVICTION_INTERVAL = 100
+
+
+def make_cache_key(model_params: Dict[str, Any]) -> str:
+    """Hashes the full request so any change to it (model, prompt, user
+    content, temperature, response_format, ...) is a different entry."""
+    canonical = json.dumps(
+        model_params, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def serialize_usage(usage: Any) -> Optional[str]:
+    if usage is None:
+        return None
+    if hasattr(usage, "model_dump"):
+        usage = usage.model_dump()
+    elif not isinstance(usage, dict):
+        usage = vars(usage)
+    return json.dumps(usage)
+
+
+class CachedResponse:
+    def __init__(self, content: str, usage: Optional[Dict[str, Any]]):
+        self.content = content
+        self.usage = usage
+
+
+class ResponseCache:
+    """
+    Maps a hash of `model_params` to the response content and usage.
+
+    Entries older than `max_age_seconds` are treated as misses, and the least
+    recently used entries are evicted once the stored responses exceed
+    `max_size_bytes`. In "readonly" mode the database is opened read-only and
+    nothing (not even access times) is written.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        mode: str = "readwrite",
+        max_size_bytes: Optional[int] = None,
+        max_age_seconds: Optional[float] = None,
+    ):
+        if mode not in CACHE_MODES:
+            raise ValueError(
+                f"Unknown cache mode '{mode}', expected one of {CACHE_MODES}"
+            )
+
+        self.path = path
+        self.mode = mode
+        self.max_size_bytes = max_size_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self.writes_since_eviction = 0
+        self.connection: Optional[sqlite3.Connection] = None
+
+        if mode == "readwrite":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # Several processes (e.g. GRECO workers) may share one cache
+            self.connection = sqlite3.connect(path, timeout=30)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    response TEXT NOT NULL,
+                    usage TEXT,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )"""
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at "
+                "ON responses (accessed_at)"
+            )
+            self.connection.commit()
+        elif mode == "readonly" and os.path.exists(path):
+            self.connection = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, timeout=30
+            )
+
+    @property
+    def writable(self) -> bool:
+        return self.connection is not None and self.mode == "readwrite"
+
+    def get(self, model_params: Dict[str, Any]) -> Optional[CachedResponse]:
+        if self.connection is None:
+            return None
+
+        key = make_cache_key(model_params)
+        row = self.connection.execute(
+            "SELECT response, usage, created_at FROM responses WHERE key = ?",
+            (key,),
+        ).fetchone()
+
+        now = time.time()
+        if row is not None and self.max_age_seconds is not None:
+            if now - row[2] > self.max_age_seconds:
+                row = None
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if self.writable:
+            self.connection.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                (now, key),
+            )
+            self.connection.commit()
+
+        usage = json.loads(row[1]) if row[1] else None
+        return CachedResponse(row[0], usage)
+
+    def put(
+        self,
+        model_params: Dict[str, Any],
+        response: str,
+        usage: Any = None,
+    ) -> None:
+        if not self.writable:
+            return
+        assert self.connection is not None
+
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses "
+            "(key, model, response, usage, size, created_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                make_cache_key(model_params),
+                model_params.get("model") or model_params.get("bot_id"),
+                response,
+                serialize_usage(usage),
+                len(response.encode("utf-8")),
+                now,
+                now,
+            ),
+        )
+        self.connection.commit()
+
+        self.writes_since_eviction += 1
+        if self.writes_since_eviction >= EVICTION_INTERVAL:
+            self.evict()
+
+    def evict(self) -> int:
+        """Removes expired entries, then least recently used entries until the
+        cache fits in `max_size_bytes`. Returns the number of rows removed."""
+        if not self.writable:
+            return 0
+        assert self.connection is not None
+        self.writes_since_eviction = 0
+        removed = 0
+
+        if self.max_age_seconds is not None:
+            cursor = self.connection.execute(
+                "DELETE FROM responses WHERE created_at < ?",
+                (time.time() - self.max_age_seconds,),
+            )
+            removed += cursor.rowcount
+
+        if self.max_size_bytes is not None:
+            (total_size,) = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            excess = total_size - self.max_size_bytes
+            if excess > 0:
+                keys = []
+                for key, size in self.connection.execute(
+                    "SELECT key, size FROM responses ORDER BY accessed_at"
+                ):
+                    keys.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                self.connection.executemany(
+                    "DELETE FROM responses WHERE key = ?", keys
+                )
+                removed += len(keys)
+
+        self.connection.commit()
+        return removed
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {"hits": self.hits, "misses": self.misses}
+        if self.connection is not None:
+            entries, total_size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            stats.update({"entries": entries, "size_bytes": total_size})
+        return stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Inspect or evict entries from the LLM response cache."
+    )
+    parser.add_argument("--path", default=DEFAULT_CACHE_PATH)
+    parser.add_argument(
+        "--stats", action="store_true", help="Print entry count and size."
+    )
+    parser.add_argument(
+        "--evict", action="store_true", help="Run age/size-based eviction."
+    )
+    parser.add_argument("--max-age-days", type=float, default=None)
+    parser.add_argument("--max-size-mb", type=float, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cache = ResponseCache(
+        args.path,
+        mode="readwrite" if args.evict else "readonly",
+        max_size_bytes=(
+            int(args.max_size_mb * 1024 * 1024) if args.max_size_mb else None
+        ),
+        max_age_seconds=(
+            args.max_age_days * 24 * 3600 if args.max_age_days else None
+        ),
+    )
+    if args.evict:
+        print(f"Evicted {cache.evict()} entries.")
+    print(cache.get_stats())
@@ -6,6 +6,12 @@ import json
 import subprocess
 import shlex
 import datetime
+import importlib
+import logging
+import sys
+from typing import Any, Optional
+from systems.greco_rpc import read_frame, write_frame
+from pipelines.dead_letter import LLMCallError
 
 
 # Load environment variables from .env file
@@ -19,6 +25,19 @@ COZE_BOT_ID = os.getenv("COZE_BOT_ID", "")
 ENABLE_QUIET = True
 # ENABLE_QUIET = False
 
+# "inprocess": import systems.greco once and run every batch in the caller's
+#   event loop, keeping the spaCy/ERRANT models warm between batches
+# "pool": keep GRECO_POOL_SIZE `python3 -m systems.greco --worker` processes
+#   alive and send them batches over stdin/stdout (process isolation)
+# "subprocess": spawn `python3 -m systems.greco` for every batch (legacy)
+GRECO_MODE = "inprocess"
+# GRECO_MODE = "pool"
+# GRECO_MODE = "subprocess"
+
+GRECO_POOL_SIZE = 4
+# Restart a worker after this many batches to cap memory growth
+GRECO_MAX_REQUESTS_PER_WORKER = 100
+
 
 def call_greco(sentences: str, quiet: bool = False) -> str:
     base_command = ["python3", "-m", "systems.greco"]
@@ -55,6 +74,196 @@ async def call_greco_async(sentences: str, quiet: bool = False) -> str:
     )
 
 
+class GrecoEngine:
+    """
+    Runs the GRECO workflow inside the current process.
+
+    `systems.greco` is imported lazily on the first batch (it imports this
+    module, and loading spaCy/ERRANT is only needed when GRECO is actually
+    used). After that, `nlp`, `annotator` and the model clients stay loaded,
+    so each batch only pays for the workflow itself.
+    """
+
+    def __init__(self, max_concurrent_batches: Optional[int] = None):
+        self.workflow: Optional[Any] = None
+        self.semaphore = (
+            asyncio.Semaphore(max_concurrent_batches)
+            if max_concurrent_batches
+            else None
+        )
+
+    def load(self) -> Any:
+        if self.workflow is None:
+            self.workflow = importlib.import_module("systems.greco")
+        return self.workflow
+
+    async def run(self, sentences: str) -> str:
+        workflow = self.load()
+        if self.semaphore is None:
+            return await workflow.execute_workflow(sentences)
+        async with self.semaphore:
+            return await workflow.execute_workflow(sentences)
+
+
+class GrecoWorker:
+    """A single `python3 -m systems.greco --worker` child process."""
+
+    def __init__(self, quiet: bool = ENABLE_QUIET):
+        self.quiet = quiet
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.requests_served = 0
+        # Set when a request was abandoned after its frame may have been
+        # written, so the worker's next reply could belong to that request
+        self.needs_restart = False
+
+    async def start(self) -> None:
+        command = [sys.executable, "-m", "systems.greco", "--worker"]
+        if self.quiet:
+            command.append("--quiet")
+
+        self.process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        self.requests_served = 0
+        self.needs_restart = False
+        logging.info(f"[greco-pool] Started worker pid={self.process.pid}")
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    def kill(self) -> None:
+        if self.is_alive():
+            assert self.process is not None
+            self.process.kill()
+
+    async def stop(self) -> None:
+        if not self.is_alive():
+            return
+        assert self.process is not None and self.process.stdin is not None
+        # Closing stdin ends the worker's read loop and lets it exit cleanly
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+
+    async def request(self, sentences: str) -> str:
+        assert self.process is not None
+        assert self.process.stdin is not None
+        assert self.process.stdout is not None
+
+        self.requests_served += 1
+        request_id = self.requests_served
+        await write_frame(
+            self.process.stdin,
+            {"id": request_id, "query": sentences},
+        )
+        response = await read_frame(self.process.stdout)
+        if response is None:
+            raise ConnectionError(
+                f"GRECO worker pid={self.process.pid} exited mid-request"
+            )
+        if response.get("id") != request_id:
+            raise ConnectionError(
+                f"GRECO worker pid={self.process.pid} answered request {response.get('id')} instead of {request_id}"
+            )
+        if "error" in response:
+            raise LLMCallError(
+                RuntimeError(f"GRECO worker error: {response['error']}"),
+                response.get("raw_response", ""),
+            )
+
+        return json.dumps(
+            {
+                "best_sentences": response["best_sentences"],
+                "best_sentences_augmented_pool": response[
+                    "best_sentences_augmented_pool"
+                ],
+            }
+        )
+
+
+class GrecoWorkerPool:
+    """
+    A fixed-size pool of long-lived GRECO workers.
+
+    Each worker loads spaCy/ERRANT once and handles one batch at a time, so
+    the pool runs up to `size` batches in parallel on separate cores. Workers
+    that crash are replaced (the failing batch is raised to the caller so
+    its retry logic applies) and healthy workers are recycled after
+    `max_requests_per_worker` batches. A worker whose request was cancelled
+    or failed midway is killed and restarted before it serves another
+    batch, so no batch reads a reply meant for an earlier one.
+    """
+
+    def __init__(
+        self,
+        size: int = GRECO_POOL_SIZE,
+        max_requests_per_worker: int = GRECO_MAX_REQUESTS_PER_WORKER,
+    ):
+        self.size = size
+        self.max_requests_per_worker = max_requests_per_worker
+        self.idle_workers: Optional[asyncio.Queue] = None
+        self.workers: list[GrecoWorker] = []
+
+    async def start(self) -> None:
+        self.idle_workers = asyncio.Queue()
+        for _ in range(self.size):
+            worker = GrecoWorker()
+            await worker.start()
+            self.workers.append(worker)
+            self.idle_workers.put_nowait(worker)
+
+    async def close(self) -> None:
+        await asyncio.gather(*[worker.stop() for worker in self.workers])
+        self.workers = []
+        self.idle_workers = None
+
+    async def restart(self, worker: GrecoWorker, reason: str) -> None:
+        logging.warning(f"[greco-pool] Restarting worker: {reason}")
+        await worker.stop()
+        await worker.start()
+
+    async def run(self, sentences: str) -> str:
+        if self.idle_workers is None:
+            await self.start()
+        assert self.idle_workers is not None
+
+        worker = await self.idle_workers.get()
+        try:
+            if worker.needs_restart:
+                await self.restart(worker, "an earlier request was abandoned")
+            elif not worker.is_alive():
+                await self.restart(worker, "worker exited while idle")
+            return await worker.request(sentences)
+        except LLMCallError:
+            # The worker replied with an error frame, so it is still in step
+            raise
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            await self.restart(worker, f"worker crashed ({e})")
+            raise ConnectionError(f"GRECO worker crashed: {e}") from e
+        except BaseException:
+            # Cancelled or failed with the reply possibly still to come; the
+            # worker is killed now and restarted by the next batch that
+            # takes it, as awaiting here could be cancelled again
+            worker.needs_restart = True
+            worker.kill()
+            raise
+        finally:
+            if (
+                not worker.needs_restart
+                and worker.requests_served >= self.max_requests_per_worker
+            ):
+                await self.restart(
+                    worker,
+                    f"served {worker.requests_served} requests",
+                )
+            self.idle_workers.put_nowait(worker)
+
+
 class Message:
     def __init__(self, content):
         self.content = content
@@ -90,8 +299,14 @@ class Completion:
 
 # TODO: change name to greco
 class AsyncGreco:
-    def __init__(self, api_key: str, timeout=30.0):
+    def __init__(self, api_key: str, timeout=30.0, mode: str = GRECO_MODE):
         self.api_key = api_key
+        self.mode = mode
+        self.engine: Optional[Any] = None
+        if mode == "inprocess":
+            self.engine = GrecoEngine()
+        elif mode == "pool":
+            self.engine = GrecoWorkerPool()
         self.client = httpx.AsyncClient(timeout=timeout)
         self.headers = {
             "Authorization": f"Bearer {api_key}",
@@ -102,6 +317,12 @@ class AsyncGreco:
         self.endpoint = COZE_ENDPOINT
         self.chat = self.Chat(self)
 
+    async def close(self) -> None:
+        # Pool workers are tied to the event loop that started them; the
+        # pool starts again on the next batch
+        if isinstance(self.engine, GrecoWorkerPool):
+            await self.engine.close()
+
     class Chat:
         def __init__(self, outer):
             self.completions = self.Completions(outer)
@@ -121,9 +342,14 @@ class AsyncGreco:
 
                 print("> greco query:", model_params["query"])
 
-                response = await call_greco_async(
-                    model_params["query"], ENABLE_QUIET
-                )
+                if self.outer.engine is not None:
+                    response = await self.outer.engine.run(
+                        model_params["query"]
+                    )
+                else:
+                    response = await call_greco_async(
+                        model_params["query"], ENABLE_QUIET
+                    )
                 # response = await call_greco_async(model_params["query"], False)
                 response = response.strip()
 
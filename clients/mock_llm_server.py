@@ -0,0 +1,442 @@
+"""OpenAI-compatible stand-in server with synthetic latency and failures."""
+
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from caches.response_cache import make_cache_key
+
+
+# python3 -m clients.mock_llm_server --port 8000
+# python3 -m clients.mock_llm_server --port 8000 --latency lognormal --latency-mean 2 --tokens-per-second 60 --rate-429 0.05 --rate-5xx 0.02 --max-tokens-cap 512
+# LOCAL_ENDPOINT=http://127.0.0.1:8000/v1 python3 main.py
+#
+# Any model in LOCAL_LLM_MODELS is then sent here by get_openai_client.
+
+
+MOCK_DATA_DIR = "clients/mock_data"
+DEFAULT_CORRECTIONS = "ABCN.dev.gold.bea19.BART-A.corrected.csv"
+
+TEXT_DELIMITER = "~~~"
+LATENCY_DISTRIBUTIONS = ["fixed", "uniform", "exponential", "lognormal"]
+SERVER_ERROR_STATUSES = [500, 502, 503]
+
+# Whitespace-led words stand in for tokens, so the server needs no tokenizer
+# download; joining the pieces gives back the exact text
+TOKEN_PATTERN = re.compile(r"\s*\S+|\s+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text)
+
+
+def find_continuation(full_response: str, partial: str) -> Optional[int]:
+    """
+    Returns where `partial` ends in `full_response`, or None if it is not a
+    prefix. Whitespace is ignored, since merge_responses strips it where
+    the pieces of a continued answer are joined.
+    """
+    target = "".join(partial.split())
+    matched = 0
+    for position, char in enumerate(full_response):
+        if matched == len(target):
+            return position
+        if char.isspace():
+            continue
+        if char != target[matched]:
+            return None
+        matched += 1
+    return len(full_response) if matched == len(target) else None
+
+
+def load_corrections(path: str) -> Dict[str, str]:
+    corrections = {}
+    with open(path, newline="", encoding="utf-8") as csvfile:
+        for original, corrected in csv.reader(csvfile):
+            corrections[original.strip()] = corrected.strip()
+    return corrections
+
+
+class MockLLM:
+    """
+    Answers chat completions from the mock GEC CSVs, the way each of the
+    repo's prompts expects:
+
+    - `{"input": "a~~~b"}` (GRECO students, GRAMMAR_PROMPT_DEFAULT):
+      `{"text": "A~~~B"}`
+    - `[{"student_sentence": ...}]` (main.py GRAMMAR_PROMPT_WITH_INDEX):
+      `{"all_sentences": [{"corrected_sentence": ...}]}`
+    - `[{"original_sentence": ..., "student_sentence": ...}]` (GRECO quality
+      estimation): `{"evaluations": [{"corrected_sentence": ...,
+      "score": ...}]}`
+
+    Responses longer than `max_tokens` are cut there with finish_reason
+    "length"; a continuation request (the partial answer sent back as an
+    assistant message) gets the rest, as a model continuing would.
+
+    Every random draw (latency, 429, 5xx) comes from a generator seeded by
+    the request and how often it has been seen, so a run is reproducible
+    whatever order concurrent requests arrive in.
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.corrections: Dict[str, Dict[str, str]] = {}
+        for path in glob.glob(os.path.join(args.mock_data, "*.csv")):
+            self.corrections[os.path.basename(path)] = load_corrections(path)
+        if args.corrections not in self.corrections:
+            raise ValueError(
+                f"{args.corrections} not found in {args.mock_data}"
+            )
+        self.lock = threading.Lock()
+        self.attempts: Counter = Counter()
+        self.request_times: deque = deque()
+        self.stats: Counter = Counter()
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_corrections(self, model: str) -> Dict[str, str]:
+        # A model named after a mock CSV answers from it
+        return self.corrections.get(
+            model, self.corrections[self.args.corrections]
+        )
+
+    def get_random(self, model_params: Dict[str, Any]) -> random.Random:
+        key = make_cache_key(model_params)
+        with self.lock:
+            attempt = self.attempts[key]
+            self.attempts[key] += 1
+        seed = hashlib.sha256(
+            f"{self.args.seed}:{key}:{attempt}".encode("utf-8")
+        ).hexdigest()
+        return random.Random(seed)
+
+    def check_rate_limit(self) -> Optional[float]:
+        # Sliding one-minute window; returns seconds until a slot frees up
+        if not self.args.rpm:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            while self.request_times and now - self.request_times[0] >= 60:
+                self.request_times.popleft()
+            if len(self.request_times) >= self.args.rpm:
+                return 60 - (now - self.request_times[0])
+            self.request_times.append(now)
+        return None
+
+    def sample_latency(self, rng: random.Random) -> float:
+        mean = self.args.latency_mean
+        if self.args.latency == "uniform":
+            return rng.uniform(0, 2 * mean)
+        if self.args.latency == "exponential":
+            return rng.expovariate(1 / mean) if mean > 0 else 0.0
+        if self.args.latency == "lognormal":
+            sigma = self.args.latency_sigma
+            # Parameterised so the distribution's mean is latency_mean
+            mu = math.log(mean) - sigma**2 / 2 if mean > 0 else 0.0
+            return rng.lognormvariate(mu, sigma) if mean > 0 else 0.0
+        return mean
+
+    def score(self, original: str, student: str, corrected: str) -> int:
+        if student == corrected:
+            return 100
+        digest = hashlib.sha256(f"{original}\t{student}".encode("utf-8"))
+        return 60 + int(digest.hexdigest(), 16) % 36
+
+    def answer(self, model: str, content: str) -> str:
+        corrections = self.get_corrections(model)
+
+        def correct(sentence: str) -> str:
+            return corrections.get(sentence.strip(), sentence)
+
+        try:
+            data = json.loads(content)
+        except json.JSONDecodeError:
+            return "\n".join(correct(line) for line in content.split("\n"))
+
+        if isinstance(data, dict) and "input" in data:
+            sentences = data["input"].split(TEXT_DELIMITER)
+            return json.dumps(
+                {"text": TEXT_DELIMITER.join(map(correct, sentences))}
+            )
+        if isinstance(data, list) and all(
+            "original_sentence" in item for item in data
+        ):
+            evaluations = []
+            for item in data:
+                corrected = correct(item["original_sentence"])
+                evaluations.append(
+                    {
+                        "unique_index": item.get("unique_index"),
+                        "student_sentence": item["student_sentence"],
+                        "corrected_sentence": corrected,
+                        "score": self.score(
+                            item["original_sentence"],
+                            item["student_sentence"],
+                            corrected,
+                        ),
+                    }
+                )
+            return json.dumps(
+                {"total_sentences": len(data), "evaluations": evaluations},
+                indent=4,
+            )
+        if isinstance(data, list):
+            return json.dumps(
+                {
+                    "total_sentences": len(data),
+                    "all_sentences": [
+                        {
+                            "unique_index": item.get("unique_index"),
+                            "student_sentence": item["student_sentence"],
+                            "corrected_sentence": correct(
+                                item["student_sentence"]
+                            ),
+                        }
+                        for item in data
+                    ],
+                },
+                indent=4,
+            )
+        raise ValueError("Unrecognised user content.")
+
+    def complete(
+        self, model_params: Dict[str, Any]
+    ) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+        """Returns the status, JSON body and extra headers for a request."""
+        rng = self.get_random(model_params)
+        self.count("requests")
+
+        retry_after = self.check_rate_limit()
+        if retry_after is None and rng.random() < self.args.rate_429:
+            retry_after = self.args.retry_after
+        if retry_after is not None:
+            self.count("429")
+            return (
+                429,
+                error_body("Rate limit reached.", "rate_limit_exceeded"),
+                {"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+
+        latency = self.sample_latency(rng)
+        if rng.random() < self.args.rate_5xx:
+            time.sleep(latency)
+            status = rng.choice(SERVER_ERROR_STATUSES)
+            self.count(str(status))
+            return status, error_body("The server had an error.", None), {}
+
+        model = model_params.get("model", "")
+        messages = model_params["messages"]
+        user_messages = [m for m in messages if m["role"] == "user"]
+        full_response = self.answer(model, user_messages[0]["content"])
+        # Continuations carry the partial answer so far
+        partial = "".join(
+            m["content"] for m in messages if m["role"] == "assistant"
+        )
+        response = full_response
+        offset = find_continuation(full_response, partial) if partial else None
+        if offset is not None:
+            response = full_response[offset:]
+            self.count("continuations")
+
+        tokens = tokenize(response)
+        max_tokens = model_params.get("max_tokens") or len(tokens)
+        if self.args.max_tokens_cap:
+            max_tokens = min(max_tokens, self.args.max_tokens_cap)
+        finish_reason = "stop"
+        if len(tokens) > max_tokens:
+            tokens = tokens[:max_tokens]
+            response = "".join(tokens)
+            finish_reason = "length"
+            self.count("truncated")
+
+        if self.args.tokens_per_second:
+            latency += len(tokens) / self.args.tokens_per_second
+        time.sleep(latency)
+
+        prompt_tokens = sum(
+            len(tokenize(m["content"])) for m in messages if m["content"]
+        )
+        self.count("completed")
+        return (
+            200,
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": response},
+                        "finish_reason": finish_reason,
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(tokens),
+                    "total_tokens": prompt_tokens + len(tokens),
+                },
+            },
+            {},
+        )
+
+
+def error_body(message: str, code: Optional[str]) -> Dict[str, Any]:
+    return {"error": {"message": message, "type": "mock_error", "code": code}}
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    server: "MockLLMServer"
+    protocol_version = "HTTP/1.1"
+
+    def send_json(
+        self, status: int, body: Any, headers: Optional[Dict[str, str]] = None
+    ) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/").endswith("/models"):
+            models = sorted(self.server.llm.corrections)
+            self.send_json(
+                200,
+                {
+                    "object": "list",
+                    "data": [{"id": m, "object": "model"} for m in models],
+                },
+            )
+        elif self.path.rstrip("/") == "/stats":
+            self.send_json(200, dict(self.server.llm.stats))
+        else:
+            self.send_json(404, error_body("Not found.", None))
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.rfile.read(length)
+            self.send_json(404, error_body("Not found.", None))
+            return
+        try:
+            model_params = json.loads(self.rfile.read(length))
+            status, body, headers = self.server.llm.complete(model_params)
+        except (ValueError, KeyError, IndexError) as e:
+            status, body, headers = 400, error_body(str(e), None), {}
+        self.send_json(status, body, headers)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], llm: MockLLM, quiet: bool):
+        super().__init__(address, MockLLMHandler)
+        self.llm = llm
+        self.quiet = quiet
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Serve OpenAI-compatible chat completions from the mock "
+        "GEC CSVs, with synthetic latency and failures."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--mock-data", default=MOCK_DATA_DIR)
+    parser.add_argument(
+        "--corrections",
+        default=DEFAULT_CORRECTIONS,
+        help="Mock CSV answering models not named after one.",
+    )
+    parser.add_argument(
+        "--latency", choices=LATENCY_DISTRIBUTIONS, default="fixed"
+    )
+    parser.add_argument(
+        "--latency-mean",
+        type=float,
+        default=0.5,
+        help="Mean time to first token, in seconds.",
+    )
+    parser.add_argument(
+        "--latency-sigma",
+        type=float,
+        default=0.5,
+        help="Shape of the lognormal latency distribution.",
+    )
+    parser.add_argument(
+        "--tokens-per-second",
+        type=float,
+        default=0,
+        help="Generation speed added to the latency; 0 for instant.",
+    )
+    parser.add_argument(
+        "--rate-429",
+        type=float,
+        default=0.0,
+        help="Probability of answering 429 with Retry-After.",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=0,
+        help="Requests per minute before answering 429; 0 for no limit.",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=float,
+        default=1.0,
+        help="Retry-After seconds sent with random 429s.",
+    )
+    parser.add_argument(
+        "--rate-5xx",
+        type=float,
+        default=0.0,
+        help="Probability of answering 500, 502 or 503.",
+    )
+    parser.add_argument(
+        "--max-tokens-cap",
+        type=int,
+        default=0,
+        help="Truncate every response at this many tokens, even below the "
+        "request's max_tokens, to exercise continuations; 0 for none.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--quiet", action="store_true", help="Do not log every request."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = MockLLMServer((args.host, args.port), MockLLM(args), args.quiet)
+    print(f"Serving on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Any, Callable, Dict, Optional
+
+from caches.response_cache import make_cache_key, serialize_usage
+
+
+# "record": call the real client and append every request/response pair to
+#   the cassette
+# "replay": answer from the cassette only, never touching the network
+REPLAY_MODES = ["record", "replay"]
+
+
+class Message:
+    def __init__(self, content):
+        self.content = content
+
+
+class Choice:
+    def __init__(self, message, finish_reason=None):
+        self.message = message
+        self.finish_reason = finish_reason
+
+
+class Usage:
+    def __init__(self, usage: Dict[str, Any]):
+        self.prompt_tokens = usage.get("prompt_tokens", 0)
+        self.completion_tokens = usage.get("completion_tokens", 0)
+        self.total_tokens = usage.get("total_tokens", 0)
+
+    def model_dump(self) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+        }
+
+
+class Completion:
+    def __init__(self, choices, usage=None):
+        self.choices = choices
+        self.usage = usage
+
+    @staticmethod
+    def from_entry(entry: Dict[str, Any]):
+        usage = entry.get("usage")
+        return Completion(
+            [Choice(Message(entry["content"]), entry.get("finish_reason"))],
+            Usage(usage) if usage else None,
+        )
+
+
+class AsyncReplayClient:
+    """
+    Records `chat.completions.create` calls to a JSONL cassette, or replays
+    them, so the full workflow (including quality estimation) runs offline.
+
+    Each cassette line holds the request hash (the response cache key, so
+    any change to the prompt or parameters is a different entry), the
+    request, the response content, usage, finish reason and the latency it
+    took. On replay, a response is served after
+
+        latency_scale * recorded latency + latency_seconds
+            + uniform(0, latency_jitter)
+
+    seconds; a request that was never recorded raises KeyError, which
+    `ask_llm` treats like any other failed call.
+    """
+
+    def __init__(
+        self,
+        cassette_path: str,
+        mode: str = "replay",
+        client_factory: Optional[Callable[[], Any]] = None,
+        latency_scale: float = 1.0,
+        latency_seconds: float = 0.0,
+        latency_jitter: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        if mode not in REPLAY_MODES:
+            raise ValueError(
+                f"Unknown replay mode '{mode}', expected one of {REPLAY_MODES}"
+            )
+        if mode == "record" and client_factory is None:
+            raise ValueError("Recording needs a client_factory to call.")
+
+        self.chat = self.Chat(self)
+        self.cassette_path = cassette_path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.latency_seconds = latency_seconds
+        self.latency_jitter = latency_jitter
+        self.random = random.Random(seed)
+        # The real client is only built when recording, so replaying needs
+        # no API keys or endpoints
+        self.client = client_factory() if mode == "record" else None
+        self.entries: Dict[str, Dict[str, Any]] = {}
+
+        if os.path.exists(cassette_path):
+            with open(cassette_path, encoding="utf-8") as cassette:
+                for line in cassette:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry
+
+    def record(
+        self,
+        key: str,
+        model_params: Dict[str, Any],
+        completion: Any,
+        latency: float,
+    ) -> None:
+        choice = completion.choices[0]
+        entry = {
+            "key": key,
+            "request": model_params,
+            "content": choice.message.content,
+            "finish_reason": getattr(choice, "finish_reason", None),
+            "usage": None,
+            "latency": latency,
+        }
+        usage = serialize_usage(getattr(completion, "usage", None))
+        if usage is not None:
+            entry["usage"] = json.loads(usage)
+        self.entries[key] = entry
+        os.makedirs(
+            os.path.dirname(self.cassette_path) or ".", exist_ok=True
+        )
+        with open(self.cassette_path, "a", encoding="utf-8") as cassette:
+            cassette.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def get_latency(self, entry: Dict[str, Any]) -> float:
+        return (
+            self.latency_scale * entry.get("latency", 0.0)
+            + self.latency_seconds
+            + self.random.uniform(0, self.latency_jitter)
+        )
+
+    class Chat:
+        def __init__(self, outer):
+            self.completions = self.Completions(outer)
+            self.outer = outer
+
+        class Completions:
+            def __init__(self, outer):
+                self.outer = outer
+
+            async def create(self, **model_params):
+                outer = self.outer
+                key = make_cache_key(model_params)
+
+                if outer.mode == "record":
+                    start = time.monotonic()
+                    completion = await outer.client.chat.completions.create(
+                        **model_params
+                    )
+                    outer.record(
+                        key, model_params, completion, time.monotonic() - start
+                    )
+                    return completion
+
+                entry = outer.entries.get(key)
+                if entry is None:
+                    raise KeyError(
+                        f"No recorded response for request {key} "
+                        f"(model {model_params.get('model')}) in "
+                        f"{outer.cassette_path}"
+                    )
+                await asyncio.sleep(outer.get_latency(entry))
+                return Completion.from_entry(entry)
+
+
+async def main():
+    replay_client = AsyncReplayClient(
+        cassette_path="cache/greco.cassette.jsonl", latency_seconds=0.5
+    )
+    print(f"{len(replay_client.entries)} recorded responses")
+    for entry in list(replay_client.entries.values())[:1]:
+        completion = await replay_client.chat.completions.create(
+            **entry["request"]
+        )
+        for choice in completion.choices:
+            print(choice.message.content)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,37 +1,217 @@
 import argparse
 from collections import Counter
+from itertools import zip_longest
 
 def main():
     # Parse command line args
     args = parse_args()
-    # Open hypothesis and reference m2 files and split into chunks
-    hyp_m2 = open(args.hyp).read().strip().split("\n\n")
-    ref_m2 = open(args.ref).read().strip().split("\n\n")
-    # Make sure they have the same number of sentences
-    assert len(hyp_m2) == len(ref_m2)
+    if args.hyp2 or args.bootstrap:
+        return main_bootstrap(args)
+    # Stream the hypothesis and reference m2 files block by block
+    hyp_m2 = read_m2_blocks(args.hyp)
+    ref_m2 = read_m2_blocks(args.ref)
+    # Score the hypothesis against the processed reference edits
+    best_dict, best_cats = score_m2(hyp_m2, process_refs(ref_m2, args), args)
+    # Print results
+    print_results(best_dict, best_cats, args)
+
+# Score -hyp (and -hyp2) once, keeping the TP, FP and FN chosen for every
+# sentence, then resample those counts instead of re-scoring.
+def main_bootstrap(args):
+    # NumPy is only imported here, so plain scoring runs never load it
+    import numpy as np
+    # Process the reference once for both hypotheses
+    ref_sents = list(process_refs(read_m2_blocks(args.ref), args))
+    hyps = [args.hyp] + ([args.hyp2] if args.hyp2 else [])
+    sent_counts = []
+    for hyp in hyps:
+        counts = []
+        best_dict, best_cats = score_m2(
+            read_m2_blocks(hyp), ref_sents, args, counts)
+        print("Results for " + hyp + ":")
+        print_results(best_dict, best_cats, args)
+        sent_counts.append(np.array(counts, dtype=np.float64))
+    if args.bootstrap:
+        print_bootstrap(hyps, bootstrap(
+            sent_counts, args.bootstrap, args.beta, args.seed), args)
+
+# Input 1: A path to an m2 file
+# Input 2: The number of characters to read at a time
+# Output: The m2 blocks of the file, one at a time. Identical to
+# open(path).read().strip().split("\n\n") without holding the whole file.
+def read_m2_blocks(path, chunk_size=1 << 20):
+    with open(path) as m2:
+        buffer = ""
+        started = False
+        # Blocks that may still be affected by the final strip(): the last
+        # non-blank block and any blank blocks after it
+        tail = []
+        for chunk in iter(lambda: m2.read(chunk_size), ""):
+            buffer += chunk
+            if not started:
+                buffer = buffer.lstrip()
+                if not buffer: continue
+                started = True
+            *blocks, buffer = buffer.split("\n\n")
+            for block in blocks:
+                if block.strip():
+                    yield from tail
+                    tail = [block]
+                else:
+                    tail.append(block)
+        rest = "\n\n".join(tail + [buffer]).rstrip()
+        if rest or not started:
+            yield from rest.split("\n\n")
+
+# Input 1: An iterable of reference m2 blocks
+# Input 2: Command line args
+# Output: The processed reference edits of each sentence (see process_ref).
+# Make it a list to share it between several hypotheses.
+def process_refs(ref_m2, args):
+    return (process_ref(sent, args) for sent in ref_m2)
+
+# Input 1: A reference m2 format sentence with edits.
+# Input 2: Command line args
+# Output 1: A dict; key is coder, value is edit dict (see process_edits).
+# Output 2: The list of coder ids, in order.
+# Output 3: For each coder, the number of non noop edit categories.
+# Output 4: An index; key is edit, value is a list of (coder position,
+# category count, whether the edit is not a noop) for each coder with it.
+# None with a single coder, where it is only built if the hyp has several.
+def process_ref(sent, args):
+    ref_dict = process_edits(simplify_edits(sent), args)
+    if len(ref_dict) == 1:
+        return ref_dict, list(ref_dict.keys()), None, None
+    return (ref_dict, list(ref_dict.keys())) + index_ref_edits(ref_dict)
+
+# Input: A ref dict; key is coder_id, value is dict of processed ref edits.
+# Output 1-2: Output 3-4 of process_ref.
+def index_ref_edits(ref_dict):
+    totals = []
+    index = {}
+    for ref_pos, ref_edits in enumerate(ref_dict.values()):
+        total = 0
+        for r_edit, r_cats in ref_edits.items():
+            scored = r_cats[0] != "noop"
+            if scored: total += len(r_cats)
+            if r_edit in index:
+                index[r_edit].append((ref_pos, len(r_cats), scored))
+            else:
+                index[r_edit] = [(ref_pos, len(r_cats), scored)]
+        totals.append(total)
+    return totals, index
 
+# Input 1: An iterable of hypothesis m2 blocks
+# Input 2: An iterable of processed reference edits (see process_refs)
+# Input 3: Command line args
+# Input 4: An optional list to append each sentence's best (TP, FP, FN) to
+# Output 1: A dict of the corpus level best TP, FP and FN counts.
+# Output 2: The corresponding error type dict for the above dict.
+def score_m2(hyp_m2, ref_sents, args, sent_counts=None):
     # Store global corpus level best counts here
     best_dict = Counter({"tp":0, "fp":0, "fn":0})
     best_cats = {}
     # Process each sentence
-    sents = zip(hyp_m2, ref_m2)
+    sents = zip_longest(hyp_m2, ref_sents)
     for sent_id, sent in enumerate(sents):
+        # Make sure they have the same number of sentences
+        assert sent[0] is not None and sent[1] is not None
         # Simplify the edits into lists of lists
         hyp_edits = simplify_edits(sent[0])
-        ref_edits = simplify_edits(sent[1])
         # Process the edits for detection/correction based on args
         hyp_dict = process_edits(hyp_edits, args)
-        ref_dict = process_edits(ref_edits, args)
-        # original sentence for logging
-        original_sentence = sent[0][2:].split("\nA")[0]
-        # Evaluate edits and get best TP, FP, FN hyp+ref combo.
-        count_dict, cat_dict = evaluate_edits(
-            hyp_dict, ref_dict, best_dict, sent_id, original_sentence, args)
+        if args.verbose:
+            # original sentence for logging
+            original_sentence = sent[0][2:].split("\nA")[0]
+            # Evaluate edits and get best TP, FP, FN hyp+ref combo.
+            count_dict, cat_dict = evaluate_edits(
+                hyp_dict, sent[1][0], best_dict, sent_id, original_sentence, args)
+        else:
+            count_dict, cat_dict = evaluate_indexed_edits(
+                hyp_dict, sent[1], best_dict, args)
         # Merge these dicts with best_dict and best_cats
-        best_dict += Counter(count_dict)
+        best_dict["tp"] += count_dict["tp"]
+        best_dict["fp"] += count_dict["fp"]
+        best_dict["fn"] += count_dict["fn"]
         best_cats = merge_dict(best_cats, cat_dict)
-    # Print results
-    print_results(best_dict, best_cats, args)
+        if sent_counts is not None:
+            sent_counts.append(
+                (count_dict["tp"], count_dict["fp"], count_dict["fn"]))
+    return best_dict, best_cats
+
+# Input 1: A list of per-sentence (TP, FP, FN) arrays, one per system, all
+# over the same sentences
+# Input 2: The number of bootstrap resamples
+# Input 3: Value of beta in F-score.
+# Input 4: A random seed
+# Input 5: Resamples drawn at a time, bounding memory to batch x sentences
+# Output: An array of shape (resamples, systems, 3) with the P, R and F of
+# every system on every resample. Resamples are paired: all systems are
+# scored on the same resampled sentences.
+def bootstrap(sent_counts, num_samples, beta, seed=0, batch_size=1000):
+    import numpy as np
+    num_sents = len(sent_counts[0])
+    # (sentences, systems * 3) so one matrix product sums every system
+    counts = np.concatenate(sent_counts, axis=1)
+    rng = np.random.default_rng(seed)
+    scores = []
+    for start in range(0, num_samples, batch_size):
+        size = min(batch_size, num_samples - start)
+        # How often each sentence is drawn in each resample
+        draws = rng.integers(0, num_sents, size=(size, num_sents))
+        draws += np.arange(size)[:, None] * num_sents
+        weights = np.bincount(draws.ravel(), minlength=size * num_sents)
+        totals = weights.reshape(size, num_sents) @ counts
+        totals = totals.reshape(size, len(sent_counts), 3)
+        scores.append(np.stack(computeFScores(
+            totals[..., 0], totals[..., 1], totals[..., 2], beta), axis=-1))
+    return np.concatenate(scores)
+
+# Vectorised computeFScore, without rounding.
+# Input 1-3: Arrays of true positives, false positives, false negatives
+# Input 4: Value of beta in F-score.
+# Output 1-3: Arrays of precision, recall and F-score.
+def computeFScores(tp, fp, fn, beta):
+    import numpy as np
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = np.where(fp > 0, tp/(tp+fp), 1.0)
+        r = np.where(fn > 0, tp/(tp+fn), 1.0)
+        f = np.where(p+r > 0, ((1+(beta**2))*p*r)/(((beta**2)*p)+r), 0.0)
+    return p, r, f
+
+# Input 1: The hypothesis file of each system
+# Input 2: Bootstrap scores from bootstrap()
+# Input 3: Command line args
+def print_bootstrap(hyps, scores, args):
+    import numpy as np
+    alpha = (1 - args.confidence) / 2
+    low, high = 100 * alpha, 100 * (1 - alpha)
+    ci = str(round(100 * args.confidence, 2)).rstrip("0").rstrip(".") + "%"
+    title = " Paired Bootstrap: " + str(len(scores)) + " resamples, " + ci + " CI "
+    print('{:=^66}'.format(title))
+    print("System".ljust(8), "P".ljust(18), "R".ljust(18), "F"+str(args.beta))
+    for sys_id in range(len(hyps)):
+        cols = []
+        for metric in range(3):
+            lo, hi = np.percentile(scores[:, sys_id, metric], [low, high])
+            cols.append("[" + str(round(lo, 4)) + ", " + str(round(hi, 4)) + "]")
+        print(str(sys_id).ljust(8), cols[0].ljust(18), cols[1].ljust(18), cols[2])
+    for sys_id, hyp in enumerate(hyps):
+        print(str(sys_id) + ": " + hyp)
+    # Paired test on F: how often the resampled difference has either sign
+    if len(hyps) > 1:
+        delta = scores[:, 1, 2] - scores[:, 0, 2]
+        lo, hi = np.percentile(delta, [low, high])
+        # Add-one estimate: with no resample crossing zero, N resamples only
+        # show that p < 1/N, never that p = 0
+        crossings = min(np.sum(delta <= 0), np.sum(delta >= 0))
+        p_value = min(1.0, 2 * (crossings + 1) / (len(delta) + 1))
+        print("")
+        print("F"+str(args.beta)+" difference (1 - 0):", str(round(np.mean(delta), 4)),
+            "[" + str(round(lo, 4)) + ", " + str(round(hi, 4)) + "]")
+        print("Two-sided p-value:", "{:.4g}".format(p_value))
+    print('{:=^66}'.format(""))
+    print("")
 
 # Parse command line args
 def parse_args():
@@ -44,6 +224,9 @@ def parse_args():
         "-hyp",
         help="A hypothesis M2 file.",
         required=True)
+    parser.add_argument(
+        "-hyp2",
+        help="A second hypothesis M2 file to compare with -hyp.")
     parser.add_argument(
         "-ref",
         help="A reference M2 file.",
@@ -97,6 +280,22 @@ def parse_args():
             "3: Show all category scores; e.g. R:NOUN.",
         choices=[1, 2, 3],
         type=int)
+    parser.add_argument(
+        "-bootstrap",
+        help="Report paired bootstrap confidence intervals (and a p-value\n"
+            "for -hyp2 vs -hyp) from this many resamples; e.g. 10000.",
+        default=0,
+        type=int)
+    parser.add_argument(
+        "-confidence",
+        help="Confidence level of the bootstrap intervals. (default: 0.95)",
+        default=0.95,
+        type=float)
+    parser.add_argument(
+        "-seed",
+        help="Random seed for bootstrap resampling. (default: 0)",
+        default=0,
+        type=int)
     args = parser.parse_args()
     return args
 
@@ -265,6 +464,68 @@ def evaluate_edits(hyp_dict, ref_dict, best, sent_id, original_sentence, args):
     best_dict = {"tp":best_tp, "fp":best_fp, "fn":best_fn}
     return best_dict, best_cat
 
+# Same as evaluate_edits without verbose output, but faster: a single hyp
+# and ref coder (the usual case) are compared once, with no F-score needed
+# to choose between combinations. With many coders, the TP, FP and FN of
+# one hyp coder against every ref coder come from a single pass over the
+# hyp edits using the ref edit index, the F-score is computed once per
+# distinct count, and the error type dict is only built for the chosen
+# hyp+ref combination.
+# Input 1: A hyp dict; key is coder_id, value is dict of processed hyp edits.
+# Input 2: The processed ref edits of the sentence (see process_ref).
+# Input 3: A dictionary of the best corpus level TP, FP and FN counts so far.
+# Input 4: Command line args
+# Output 1: A dict of the best corpus level TP, FP and FN for the input sentence.
+# Output 2: The corresponding error type dict for the above dict.
+def evaluate_indexed_edits(hyp_dict, ref, best, args):
+    ref_dict, ref_ids, ref_totals, ref_index = ref
+    if len(ref_ids) == 1 and len(hyp_dict) == 1:
+        tp, fp, fn, best_cat = compareEdits(
+            next(iter(hyp_dict.values())), ref_dict[ref_ids[0]])
+        return {"tp":tp, "fp":fp, "fn":fn}, best_cat
+    if ref_index is None:
+        ref_totals, ref_index = index_ref_edits(ref_dict)
+    num_refs = len(ref_ids)
+    b_tp, b_fp, b_fn = best["tp"], best["fp"], best["fn"]
+    f_scores = {}
+    best_tp, best_fp, best_fn, best_f, best_hyp, best_ref = 0, 0, 0, -1, 0, 0
+    # Compare each hyp and ref combination
+    for hyp_id, hyp_edits in hyp_dict.items():
+        tps = [0] * num_refs
+        fps = [0] * num_refs
+        fns = list(ref_totals)
+        h_total = 0
+        for h_edit, h_cats in hyp_edits.items():
+            # noop hyp edits cannot be TP or FP
+            scored = h_cats[0] != "noop"
+            if scored: h_total += len(h_cats)
+            for ref_pos, r_count, r_scored in ref_index.get(h_edit, ()):
+                # TRUE POSITIVES use the ref dict, and are not FPs
+                if scored:
+                    tps[ref_pos] += r_count
+                    fps[ref_pos] -= len(h_cats)
+                # Ref edits found in the hyp are not FNs
+                if r_scored: fns[ref_pos] -= r_count
+        for ref_pos in range(num_refs):
+            tp = tps[ref_pos]
+            fp = h_total + fps[ref_pos]
+            fn = fns[ref_pos]
+            # Compute the global sentence F-score
+            f = f_scores.get((tp, fp, fn))
+            if f is None:
+                f = f_scores[(tp, fp, fn)] = computeFScore(
+                    tp+b_tp, fp+b_fp, fn+b_fn, args.beta)[2]
+            # Save the scores if they are better (see evaluate_edits)
+            if     (f > best_f) or \
+                (f == best_f and tp > best_tp) or \
+                (f == best_f and tp == best_tp and fp < best_fp) or \
+                (f == best_f and tp == best_tp and fp == best_fp and fn < best_fn):
+                best_tp, best_fp, best_fn = tp, fp, fn
+                best_f, best_hyp, best_ref = f, hyp_id, ref_ids[ref_pos]
+    best_cat = compareEdits(hyp_dict[best_hyp], ref_dict[best_ref])[3]
+    best_dict = {"tp":best_tp, "fp":best_fp, "fn":best_fn}
+    return best_dict, best_cat
+
 # Input 1: A dictionary of hypothesis edits for a single system.
 # Input 2: A dictionary of reference edits for a single annotator.
 # Output 1-3: The TP, FP and FN for the hyp vs the given ref annotator.
@@ -8,6 +8,14 @@ import argparse
 def main(args):
     m2 = open(args.m2_file).read().strip().split("\n\n")
     out = open(args.out, "w")
+    for cor_sent in apply_edits(m2, args.id):
+        out.write(cor_sent + "\n")
+
+
+# Input 1: A list of m2 blocks
+# Input 2: The id of the target annotator
+# Output: The corrected sentence of each block
+def apply_edits(m2, id=0):
     # Do not apply edits with these error types
     skip = {"noop", "UNK", "Um"}
 
@@ -21,7 +29,7 @@ def main(args):
             if edit[1] in skip:
                 continue  # Ignore certain edits
             coder = int(edit[-1])
-            if coder != args.id:
+            if coder != id:
                 continue  # Ignore other coders
             span = edit[0].split()[1:]  # Ignore "A "
             start = int(span[0])
@@ -29,7 +37,7 @@ def main(args):
             cor = edit[2].split()
             cor_sent[start + offset : end + offset] = cor
             offset = offset - (end - start) + len(cor)
-        out.write(" ".join(cor_sent) + "\n")
+        yield " ".join(cor_sent)
 
 
 if __name__ == "__main__":
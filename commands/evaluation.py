@@ -0,0 +1,260 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from typing import Any, Dict, List, Optional, Union
+import errant
+
+# Make the repository root importable when run as commands/evaluation.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from caches.doc_cache import DEFAULT_DOC_CACHE_PATH, get_doc_cache
+from commands.compare_m2 import (
+    computeFScore,
+    print_results,
+    process_refs,
+    read_m2_blocks,
+    score_m2,
+)
+from commands.parallel_to_m2 import generate_blocks, init_worker, write_blocks
+
+
+# In-process equivalent of parallel_to_m2.py followed by compare_m2.py for
+# every hypothesis, with ERRANT/spaCy loaded once and M2 passed in memory:
+#
+#   from commands.evaluation import evaluate
+#   scores = evaluate(orig, [corrected, augmented_pool], ref_m2)
+#
+# python3 commands/evaluation.py -orig test/ABCN.dev.gold.bea19.orig -hyp corrected_output/ABCN.dev.gold.bea19.corrected corrected_output/ABCN.dev.gold.bea19.augmented_pool.corrected -ref reference_m2/ABCN.dev.gold.bea19.m2
+
+
+# ERRANT annotators, loaded on first use and kept for the whole process
+annotators: Dict[str, Any] = {}
+
+# The processed reference and compare_m2 args of a scoring pool worker,
+# sent once per process rather than once per hypothesis
+worker_ref_sents: List[Any] = []
+worker_score_args: Optional[argparse.Namespace] = None
+
+
+def get_annotator(lang: str = "en") -> Any:
+    if lang not in annotators:
+        annotators[lang] = errant.load(lang)
+    return annotators[lang]
+
+
+# Input 1-3: Value of beta, category granularity and other compare_m2 flags
+# Output: The args compare_m2 expects from its command line
+def make_score_args(beta: float = 0.5, cat: Optional[int] = None, **flags):
+    args = argparse.Namespace(
+        beta=beta,
+        verbose=False,
+        dt=False,
+        ds=False,
+        cs=False,
+        cse=False,
+        single=False,
+        multi=False,
+        filt=[],
+        cat=cat,
+    )
+    vars(args).update(flags)
+    return args
+
+
+# Input 1: The path to the original text file
+# Input 2: The paths to >= 1 corrected text files
+# Input 3: Processes for spacy parsing and edit annotation
+# Input 4: Optional output M2 paths, one per corrected file
+# Output: The M2 blocks of each corrected file, as compare_m2 reads them
+def parallel_to_m2(
+    orig: str,
+    hyps: List[str],
+    n_process: int = 1,
+    out_m2_paths: Optional[List[str]] = None,
+    doc_cache_path: Optional[str] = DEFAULT_DOC_CACHE_PATH,
+) -> List[List[str]]:
+    annotator = get_annotator()
+    args = argparse.Namespace(
+        tok=False,
+        lev=False,
+        merge="rules",
+        n_process=n_process,
+        batch_size=256,
+        chunk_size=10000,
+    )
+    doc_cache = get_doc_cache(
+        annotator.nlp,
+        doc_cache_path,
+        n_process=args.n_process,
+        batch_size=args.batch_size,
+    )
+
+    hyp_m2s: List[List[str]] = [[] for _ in hyps]
+    with ExitStack() as stack:
+        in_files = [stack.enter_context(open(i)) for i in [orig] + hyps]
+        out_m2s = [
+            stack.enter_context(open(o, "w")) for o in out_m2_paths or []
+        ]
+        executor = None
+        if n_process > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(n_process, initializer=init_worker)
+            )
+        # Every hypothesis gets its own single-coder M2, as if
+        # parallel_to_m2.py had been run once per corrected file
+        for blocks in generate_blocks(
+            in_files, annotator, doc_cache, args, True, executor
+        ):
+            if out_m2s:
+                write_blocks(blocks, out_m2s)
+            for s_line, cor_edits in blocks:
+                for hyp_m2, edits in zip(hyp_m2s, cor_edits):
+                    hyp_m2.append((s_line + edits).rstrip("\n"))
+    return hyp_m2s
+
+
+def init_score_worker(ref_sents, score_args):
+    global worker_ref_sents, worker_score_args
+    worker_ref_sents = ref_sents
+    worker_score_args = score_args
+
+
+def score_worker_hyp(hyp_m2):
+    return score_hyp(hyp_m2, worker_ref_sents, worker_score_args)
+
+
+# Input 1: The M2 blocks of a hypothesis
+# Input 2: The processed reference, from compare_m2.process_refs
+# Input 3: The args compare_m2 expects from its command line
+# Output: A dict with TP/FP/FN, P/R/F, categories and, per sentence, the
+# best (TP, FP, FN)
+def score_hyp(hyp_m2, ref_sents, score_args) -> Dict[str, Any]:
+    sent_counts: List[tuple] = []
+    best, best_cats = score_m2(hyp_m2, ref_sents, score_args, sent_counts)
+    p, r, f = computeFScore(
+        best["tp"], best["fp"], best["fn"], score_args.beta
+    )
+    return {
+        "tp": best["tp"],
+        "fp": best["fp"],
+        "fn": best["fn"],
+        "precision": p,
+        "recall": r,
+        "f_score": f,
+        "categories": best_cats,
+        "sentences": sent_counts,
+    }
+
+
+# Input 1: The M2 blocks of each hypothesis
+# Input 2: The processed reference, from compare_m2.process_refs
+# Input 3: The args compare_m2 expects from its command line
+# Input 4: Processes to score hypotheses on
+# Output: The score_hyp dict of each hypothesis, in order
+def score_hyps(
+    hyp_m2s: List[List[str]],
+    ref_sents: List[Any],
+    score_args: argparse.Namespace,
+    n_process: int = 1,
+) -> List[Dict[str, Any]]:
+    n_process = min(n_process, len(hyp_m2s))
+    if n_process <= 1:
+        return [score_hyp(m2, ref_sents, score_args) for m2 in hyp_m2s]
+    with ProcessPoolExecutor(
+        n_process,
+        initializer=init_score_worker,
+        initargs=(ref_sents, score_args),
+    ) as executor:
+        return list(executor.map(score_worker_hyp, hyp_m2s))
+
+
+# Input 1: The path to the original text file
+# Input 2: The path, or paths, to the corrected text files to evaluate
+# Input 3: The path to the reference M2 file
+# Input 4: Value of beta in F-score
+# Input 5: Error category granularity, as compare_m2.py -cat
+# Input 6: Processes for spacy parsing and edit annotation
+# Input 7: Optional paths to also write each hypothesis M2 to
+# Output: A dict; key is hyp path, value is TP/FP/FN, P/R/F, categories and
+# per-sentence counts
+def evaluate(
+    orig: str,
+    hyps: Union[str, List[str]],
+    ref_m2: str,
+    beta: float = 0.5,
+    cat: Optional[int] = None,
+    n_process: int = 1,
+    out_m2_paths: Optional[List[str]] = None,
+) -> Dict[str, Dict[str, Any]]:
+    if isinstance(hyps, str):
+        hyps = [hyps]
+    hyp_m2s = parallel_to_m2(orig, hyps, n_process, out_m2_paths)
+
+    # The reference is read and processed once for all hypotheses
+    score_args = make_score_args(beta, cat)
+    ref_sents = list(process_refs(read_m2_blocks(ref_m2), score_args))
+
+    return dict(
+        zip(hyps, score_hyps(hyp_m2s, ref_sents, score_args, n_process))
+    )
+
+
+# Input 1: One entry of the dict returned by evaluate
+# Input 2-3: Value of beta and error category granularity
+# Prints the same tables as compare_m2.py
+def print_scores(score, beta=0.5, cat=None):
+    print_results(score, score["categories"], make_score_args(beta, cat))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Evaluate >= 1 corrected text files against a reference M2 file.",
+        formatter_class=argparse.RawTextHelpFormatter,
+        usage="%(prog)s [-h] [options] -orig ORIG -hyp HYP [HYP ...] -ref REF",
+    )
+    parser.add_argument(
+        "-orig", help="The path to the original text file.", required=True
+    )
+    parser.add_argument(
+        "-hyp",
+        help="The paths to >= 1 corrected text files.",
+        nargs="+",
+        required=True,
+    )
+    parser.add_argument(
+        "-ref", help="A reference M2 file.", required=True
+    )
+    parser.add_argument(
+        "-b",
+        "--beta",
+        help="Value of beta in F-score. (default: 0.5)",
+        default=0.5,
+        type=float,
+    )
+    parser.add_argument(
+        "-cat",
+        help="Show error category scores.\n"
+        "1: Only show operation tier scores; e.g. R.\n"
+        "2: Only show main tier scores; e.g. NOUN.\n"
+        "3: Show all category scores; e.g. R:NOUN.",
+        choices=[1, 2, 3],
+        type=int,
+    )
+    parser.add_argument(
+        "-n_process",
+        help="Processes for spacy parsing and edit annotation (default: 1).",
+        type=int,
+        default=1,
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    scores = evaluate(
+        args.orig, args.hyp, args.ref, args.beta, args.cat, args.n_process
+    )
+    for hyp, score in scores.items():
+        print(f"Evaluation Results for {hyp}:")
+        print_scores(score, args.beta, args.cat)
@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+import sys
+
+# Make the repository root importable when run as commands/leaderboard.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from commands.compare_m2 import (
+    computeFScore,
+    print_table,
+    processCategories,
+    process_refs,
+    read_m2_blocks,
+)
+from commands.evaluation import make_score_args, parallel_to_m2, score_hyps
+
+
+# Scores every system in one run: orig is parsed once for all hypotheses,
+# the reference is processed once, and systems are scored in parallel.
+#
+# The four mock students, their teacher corrections and the combined output:
+# python3 commands/leaderboard.py -orig test/ABCN.dev.gold.bea19.orig -hyp clients/mock_data/ABCN.dev.gold.bea19.BART-A.corrected clients/mock_data/ABCN.dev.gold.bea19.BART-B.corrected clients/mock_data/ABCN.dev.gold.bea19.T5-small-A.corrected clients/mock_data/ABCN.dev.gold.bea19.T5-small-B.corrected corrected_output/ABCN.dev.gold.bea19.corrected corrected_output/ABCN.dev.gold.bea19.augmented_pool.corrected -ref reference_m2/ABCN.dev.gold.bea19.m2 -n_process 4
+
+
+def main():
+    # Parse command line args
+    args = parse_args()
+    names = args.names or [os.path.basename(hyp) for hyp in args.hyp]
+    if len(names) != len(args.hyp):
+        raise ValueError(
+            f"Expected {len(args.hyp)} system names, got {len(names)}."
+        )
+    print("Processing parallel files...")
+    hyp_m2s = parallel_to_m2(args.orig, args.hyp, args.n_process)
+    print("Scoring systems...")
+    score_args = make_score_args(args.beta, args.cat)
+    ref_sents = list(process_refs(read_m2_blocks(args.ref), score_args))
+    scores = score_hyps(hyp_m2s, ref_sents, score_args, args.n_process)
+    # Print results
+    print_leaderboard(names, scores, args)
+    if args.out:
+        write_scores(names, scores, args)
+
+
+# Input 1: The name of each system
+# Input 2: The score_hyp dict of each system
+# Input 3: Command line args
+def print_leaderboard(names, scores, args):
+    ranked = sorted(
+        range(len(names)), key=lambda i: scores[i]["f_score"], reverse=True
+    )
+    title = " Span-Based Correction "
+    print("")
+    print("{:=^66}".format(title))
+    header = ["#", "System", "TP", "FP", "FN", "Prec", "Rec"]
+    table = [header + ["F" + str(args.beta)]]
+    for rank, i in enumerate(ranked, 1):
+        score = scores[i]
+        table.append(
+            [rank, names[i], score["tp"], score["fp"], score["fn"]]
+            + [score["precision"], score["recall"], score["f_score"]]
+        )
+    print_table(table)
+
+    # Category F-scores, one column per system in leaderboard order
+    if args.cat:
+        system_cats = [
+            processCategories(scores[i]["categories"], args.cat)
+            for i in ranked
+        ]
+        cats = sorted(set().union(*system_cats))
+        print("")
+        print("{:=^66}".format(" Category F" + str(args.beta) + " "))
+        ranks = ["#" + str(rank) for rank in range(1, len(ranked) + 1)]
+        table = [["Category"] + ranks]
+        for cat in cats:
+            row = [cat]
+            for cat_dict in system_cats:
+                tp, fp, fn = cat_dict.get(cat, [0, 0, 0])
+                row.append(computeFScore(tp, fp, fn, args.beta)[2])
+            table.append(row)
+        print_table(table)
+    print("{:=^66}".format(""))
+    print("")
+
+
+# Input 1: The name of each system
+# Input 2: The score_hyp dict of each system
+# Input 3: Command line args
+# Writes the scores, including each sentence's best TP/FP/FN, to args.out
+def write_scores(names, scores, args):
+    results = {
+        "orig": args.orig,
+        "ref": args.ref,
+        "beta": args.beta,
+        "systems": {},
+    }
+    for name, hyp, score in zip(names, args.hyp, scores):
+        results["systems"][name] = dict(score, hyp=hyp)
+    with open(args.out, "w") as f:
+        json.dump(results, f)
+
+
+# Parse command line args
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Rank >= 1 corrected text files against a reference M2 file.",
+        formatter_class=argparse.RawTextHelpFormatter,
+        usage="%(prog)s [-h] [options] -orig ORIG -hyp HYP [HYP ...] -ref REF",
+    )
+    parser.add_argument(
+        "-orig", help="The path to the original text file.", required=True
+    )
+    parser.add_argument(
+        "-hyp",
+        help="The paths to >= 1 corrected text files.",
+        nargs="+",
+        required=True,
+    )
+    parser.add_argument(
+        "-ref", help="A reference M2 file.", required=True
+    )
+    parser.add_argument(
+        "-names",
+        help="A name per corrected text file (default: the file names).",
+        nargs="+",
+    )
+    parser.add_argument(
+        "-b",
+        "--beta",
+        help="Value of beta in F-score. (default: 0.5)",
+        default=0.5,
+        type=float,
+    )
+    parser.add_argument(
+        "-cat",
+        help="Show error category F-scores. (default: 3)\n"
+        "0: Only show the overall scores.\n"
+        "1: Only show operation tier scores; e.g. R.\n"
+        "2: Only show main tier scores; e.g. NOUN.\n"
+        "3: Show all category scores; e.g. R:NOUN.",
+        choices=[0, 1, 2, 3],
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "-n_process",
+        help="Processes for parsing, annotation and scoring (default: 1).",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-out",
+        help="Also write every system's scores to this JSON file, e.g. for\n"
+        "commands/oracle.py.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import argparse
+import json
+import os
+import sys
+import numpy as np
+
+# Make the repository root importable when run as commands/oracle.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from commands.compare_m2 import computeFScore, print_table
+
+
+# How far is system combination from the best possible choice of candidate
+# per sentence? Reuses the per-sentence TP/FP/FN that leaderboard.py saved,
+# so nothing is parsed or annotated again:
+#
+# python3 commands/leaderboard.py -orig test/ABCN.dev.gold.bea19.orig -hyp clients/mock_data/ABCN.dev.gold.bea19.BART-A.corrected clients/mock_data/ABCN.dev.gold.bea19.BART-B.corrected clients/mock_data/ABCN.dev.gold.bea19.T5-small-A.corrected clients/mock_data/ABCN.dev.gold.bea19.T5-small-B.corrected corrected_output/ABCN.dev.gold.bea19.corrected -names model1 model2 model3 model4 combined -ref reference_m2/ABCN.dev.gold.bea19.m2 -out corrected_m2/ABCN.dev.gold.bea19.scores.json
+# python3 commands/oracle.py -scores corrected_m2/ABCN.dev.gold.bea19.scores.json -combined combined
+
+
+def main():
+    # Parse command line args
+    args = parse_args()
+    with open(args.scores) as f:
+        results = json.load(f)
+    systems = results["systems"]
+    beta = results["beta"]
+    names = args.candidates or [
+        name for name in systems if name != args.combined
+    ]
+    # (candidates, sentences, 3) TP, FP and FN
+    counts = np.array(
+        [systems[name]["sentences"] for name in names], dtype=np.float64
+    )
+    combined = np.array(
+        systems[args.combined]["sentences"], dtype=np.float64
+    )
+    if counts.shape[1] != len(combined):
+        raise ValueError(
+            f"Expected {counts.shape[1]} sentences for {args.combined}, "
+            f"got {len(combined)}."
+        )
+
+    oracle = oracle_selection(counts, beta)
+    # Which candidate the combination took, recovered from the texts
+    chosen = infer_selection(
+        results["orig"],
+        [systems[name]["hyp"] for name in names],
+        systems[args.combined]["hyp"],
+    )
+    print_analysis(names, counts, oracle, combined, chosen, beta)
+    if args.out:
+        write_selection(names, oracle, chosen, args.out)
+
+
+# Input 1: Per candidate, per sentence TP, FP and FN
+# Input 2: Value of beta in F-score
+# Input 3: The maximum number of iterations
+# Output: The index of the candidate to take for every sentence
+# F = (1+b^2)TP / ((1+b^2)TP + b^2 FN + FP) is a ratio of per-sentence sums,
+# so the corpus-level optimum is found exactly with Dinkelbach's method:
+# given the current F, choosing per sentence is an independent argmax.
+def oracle_selection(counts, beta, max_iter=100):
+    tp, fp, fn = counts[..., 0], counts[..., 1], counts[..., 2]
+    gain = (1 + beta**2) * tp
+    cost = gain + (beta**2) * fn + fp
+    sents = np.arange(counts.shape[1])
+    f = 0.0
+    for _ in range(max_iter):
+        selection = np.argmax(gain - f * cost, axis=0)
+        total_cost = cost[selection, sents].sum()
+        if total_cost == 0:
+            break
+        new_f = gain[selection, sents].sum() / total_cost
+        if new_f <= f + 1e-12:
+            break
+        f = new_f
+    return selection
+
+
+# Input 1: The path to the original text file
+# Input 2: The path to each candidate's corrected text file
+# Input 3: The path to the combined corrected text file
+# Output: Per scored sentence, the index of the first candidate whose
+# correction the combination output, or -1 if none matches
+def infer_selection(orig, hyps, combined):
+    files = [open(path) for path in [orig, combined] + hyps]
+    try:
+        chosen = []
+        for line in zip(*files):
+            # Sentences with an empty orig are not scored
+            if not line[0].strip():
+                continue
+            texts = [text.strip() for text in line[2:]]
+            combined_text = line[1].strip()
+            chosen.append(
+                texts.index(combined_text) if combined_text in texts else -1
+            )
+        return np.array(chosen)
+    finally:
+        for f in files:
+            f.close()
+
+
+def f_score(totals, beta):
+    tp, fp, fn = (int(total) for total in totals)
+    return computeFScore(tp, fp, fn, beta)
+
+
+# Input 1: The name of each candidate
+# Input 2: Per candidate, per sentence TP, FP and FN
+# Input 3: The oracle candidate of each sentence
+# Input 4: Per sentence TP, FP and FN of the combination
+# Input 5: The candidate the combination chose for each sentence, or -1
+# Input 6: Value of beta in F-score
+def print_analysis(names, counts, oracle, combined, chosen, beta):
+    sents = np.arange(counts.shape[1])
+    oracle_counts = counts[oracle, sents]
+    oracle_f = f_score(oracle_counts.sum(axis=0), beta)[2]
+    combined_f = f_score(combined.sum(axis=0), beta)[2]
+    single_f = [f_score(totals, beta)[2] for totals in counts.sum(axis=1)]
+    best_single = int(np.argmax(single_f))
+
+    # What each sentence adds to the Dinkelbach objective at the oracle F;
+    # the combination's shortfall per sentence is where its F is lost
+    def value(sent_counts):
+        tp, fp, fn = sent_counts[:, 0], sent_counts[:, 1], sent_counts[:, 2]
+        gain = (1 + beta**2) * tp
+        return gain - oracle_f * (gain + (beta**2) * fn + fp)
+
+    loss = value(oracle_counts) - value(combined)
+    lost = loss > 1e-9
+
+    print("")
+    print("{:=^66}".format(" Sentence-Level Oracle "))
+    header = ["System", "TP", "FP", "FN", "Prec", "Rec", "F" + str(beta)]
+    print("\t".join(header))
+    for name, totals in [
+        ("oracle", oracle_counts.sum(axis=0)),
+        ("best", counts[best_single].sum(axis=0)),
+        ("combined", combined.sum(axis=0)),
+    ]:
+        row = [name] + [int(total) for total in totals]
+        print("\t".join(map(str, row + list(f_score(totals, beta)))))
+    print("")
+    print("Best single candidate:", names[best_single])
+    print("Regret (oracle - combined):", round(oracle_f - combined_f, 4))
+    print(
+        "Gain over best (combined - best):",
+        round(combined_f - single_f[best_single], 4),
+    )
+    print("Sentences below the oracle:", int(lost.sum()), "of", len(loss))
+
+    # Where the combination loses, by the candidate it chose
+    print("")
+    header = ["Candidate", "F" + str(beta), "Oracle", "Chosen", "Lost"]
+    table = [header + ["Loss"]]
+    for i, name in enumerate(names):
+        picked = chosen == i
+        table.append([
+            name + ("*" if i == best_single else ""),
+            single_f[i],
+            int((oracle == i).sum()),
+            int(picked.sum()),
+            int((picked & lost).sum()),
+            round(float(loss[picked].sum()), 2),
+        ])
+    # Combined sentences that match no candidate's text
+    unmatched = chosen == -1
+    if unmatched.any():
+        table.append([
+            "(none)",
+            "-",
+            "-",
+            int(unmatched.sum()),
+            int((unmatched & lost).sum()),
+            round(float(loss[unmatched].sum()), 2),
+        ])
+    print_table(table)
+    print("{:=^66}".format(""))
+    print("")
+
+
+# Input 1: The name of each candidate
+# Input 2: The oracle candidate of each sentence
+# Input 3: The candidate the combination chose for each sentence, or -1
+# Input 4: The path of the JSON file to write
+def write_selection(names, oracle, chosen, out):
+    with open(out, "w") as f:
+        json.dump(
+            {
+                "candidates": names,
+                "oracle": oracle.tolist(),
+                "combined": chosen.tolist(),
+            },
+            f,
+        )
+
+
+# Parse command line args
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare system combination with the sentence-level "
+        "oracle over its candidates.",
+        formatter_class=argparse.RawTextHelpFormatter,
+        usage="%(prog)s [-h] [options] -scores SCORES -combined COMBINED",
+    )
+    parser.add_argument(
+        "-scores",
+        help="A scores JSON file written by leaderboard.py -out.",
+        required=True,
+    )
+    parser.add_argument(
+        "-combined",
+        help="The name of the system combination output in SCORES.",
+        required=True,
+    )
+    parser.add_argument(
+        "-candidates",
+        help="The names of the candidates in SCORES\n"
+        "(default: every other system).",
+        nargs="+",
+    )
+    parser.add_argument(
+        "-out",
+        help="Also write the oracle and combined selections to this JSON\n"
+        "file.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
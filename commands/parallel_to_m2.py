@@ -1,54 +1,209 @@
 import argparse
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import ExitStack
 import errant
+from spacy.tokens import DocBin
+
+# Make the repository root importable when run as commands/parallel_to_m2.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from caches.doc_cache import get_doc_cache
+
+
+# python3 commands/parallel_to_m2.py -orig test/ABCN.dev.gold.bea19.orig -cor corrected_output/ABCN.dev.gold.bea19.corrected -out corrected_m2/ABCN.dev.gold.bea19.m2
+# One M2 file per hypothesis, parsing orig once and annotating on 4 cores:
+# python3 commands/parallel_to_m2.py -orig test/ABCN.dev.gold.bea19.orig -cor corrected_output/ABCN.dev.gold.bea19.corrected corrected_output/ABCN.dev.gold.bea19.augmented_pool.corrected -out corrected_m2/ABCN.dev.gold.bea19.m2 corrected_m2/ABCN.dev.gold.bea19.augmented_pool.m2 -n_process 4
+
+
+# The annotator of a pool worker, loaded once per process
+worker_annotator = None
 
 
 def main():
     # Parse command line args
     args = parse_args()
+    # One output per corrected file writes each hypothesis as its own M2
+    # (coder id 0); a single output combines them as coders 0..n-1
+    split_outputs = len(args.out) > 1
+    if split_outputs and len(args.out) != len(args.cor):
+        raise ValueError(
+            f"Expected 1 or {len(args.cor)} output paths, got {len(args.out)}."
+        )
     print("Loading resources...")
     # Load Errant
     annotator = errant.load("en")
+    # Reuse parses from the GEC run (and earlier evaluations) where possible
+    doc_cache = get_doc_cache(
+        annotator.nlp,
+        None if args.no_cache else args.cache,
+        n_process=args.n_process,
+        batch_size=args.batch_size,
+    )
 
     print("Processing parallel files...")
     # Process an arbitrary number of files line by line simultaneously. Python 3.3+
-    # See https://tinyurl.com/y4cj4gth . Also opens the output m2 file.
-    with ExitStack() as stack, open(args.out, "w") as out_m2:
+    # See https://tinyurl.com/y4cj4gth . Also opens the output m2 files.
+    with ExitStack() as stack:
         in_files = [
             stack.enter_context(open(i)) for i in [args.orig] + args.cor
         ]
-        # Process each line of all input files
-        for line in zip(*in_files):
-            # Get the original and all the corrected texts
-            orig = line[0].strip()
-            cors = line[1:]
-            # Skip the line if orig is empty
-            if not orig:
+        out_m2s = [stack.enter_context(open(o, "w")) for o in args.out]
+        executor = None
+        if args.n_process > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(
+                    args.n_process, initializer=init_worker
+                )
+            )
+
+        for blocks in generate_blocks(
+            in_files, annotator, doc_cache, args, split_outputs, executor
+        ):
+            write_blocks(blocks, out_m2s)
+
+
+# Input 1: The open orig file followed by the open cor files
+# Input 2: An ERRANT annotator
+# Input 3: The Doc cache to parse through
+# Input 4: Command line args
+# Input 5: Whether every cor goes to its own output file
+# Input 6: A process pool to annotate shards on, or None
+# Output: Lists of blocks (see annotate_shard), in input order
+def generate_blocks(in_files, annotator, doc_cache, args, split_outputs, executor):
+    # Shards are annotated out of order but yielded in input order, as soon
+    # as every shard before them is done
+    pending = deque()
+    for chunk in read_chunks(in_files, args.chunk_size):
+        for shard in parse_chunk(chunk, doc_cache, args):
+            if executor is None:
+                yield annotate_shard(annotator, *shard, args, split_outputs)
                 continue
-            # Parse orig with spacy
-            orig = annotator.parse(orig, args.tok)
-            # Write orig to the output m2 file
-            out_m2.write(
-                " ".join(["S"] + [token.text for token in orig]) + "\n"
+            data, cors = shard
+            pending.append(
+                executor.submit(
+                    annotate_serialized_shard,
+                    data.to_bytes(),
+                    cors,
+                    args,
+                    split_outputs,
+                )
             )
-            # Loop through the corrected texts
-            for cor_id, cor in enumerate(cors):
-                cor = cor.strip()
-                # If the texts are the same, write a noop edit
-                if orig.text.strip() == cor:
-                    out_m2.write(noop_edit(cor_id) + "\n")
-                # Otherwise, do extra processing
-                else:
-                    # Parse cor with spacy
-                    cor = annotator.parse(cor, args.tok)
-                    # Align the texts and extract and classify the edits
-                    edits = annotator.annotate(orig, cor, args.lev, args.merge)
-                    # Loop through the edits
-                    for edit in edits:
-                        # Write the edit to the output m2 file
-                        out_m2.write(edit.to_m2(cor_id) + "\n")
+            # Bound the work in flight so memory stays flat
+            while len(pending) > 2 * args.n_process:
+                yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+# Input 1: The open orig file followed by the open cor files
+# Input 2: The number of lines to read at once
+# Output: Lists of (orig, [cor, ...]) stripped lines, skipping empty origs
+def read_chunks(in_files, chunk_size):
+    chunk = []
+    # Process each line of all input files
+    for line in zip(*in_files):
+        # Get the original and all the corrected texts
+        orig = line[0].strip()
+        # Skip the line if orig is empty
+        if not orig:
+            continue
+        chunk.append((orig, [cor.strip() for cor in line[1:]]))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Input 1: A list of (orig, [cor, ...]) lines
+# Input 2: The Doc cache to parse through
+# Input 3: Command line args
+# Output: Shards of args.batch_size lines as (DocBin, cors); per line the
+# DocBin holds orig followed by every cor that differs from it
+def parse_chunk(chunk, doc_cache, args):
+    # Parse every orig in one pass, then every cor that needs alignment
+    origs = doc_cache.get_docs([orig for orig, _ in chunk], args.tok)
+    cor_docs = iter(
+        doc_cache.get_docs(
+            [
+                cor
+                for orig, (_, cors) in zip(origs, chunk)
+                for cor in cors
+                if orig.text.strip() != cor
+            ],
+            args.tok,
+        )
+    )
+    for start in range(0, len(chunk), args.batch_size):
+        data = DocBin()
+        shard_cors = []
+        for orig, (_, cors) in zip(
+            origs[start : start + args.batch_size],
+            chunk[start : start + args.batch_size],
+        ):
+            data.add(orig)
+            for cor in cors:
+                if orig.text.strip() != cor:
+                    data.add(next(cor_docs))
+            shard_cors.append(cors)
+        yield data, shard_cors
+
+
+def init_worker():
+    global worker_annotator
+    worker_annotator = errant.load("en")
+
+
+def annotate_serialized_shard(data, cors, args, split_outputs):
+    docs = DocBin().from_bytes(data)
+    return annotate_shard(worker_annotator, docs, cors, args, split_outputs)
+
+
+# Input 1: An ERRANT annotator
+# Input 2: A DocBin from parse_chunk
+# Input 3: The corrected texts of each line
+# Input 4: Command line args
+# Input 5: Whether every cor goes to its own output file
+# Output: Per line, the S line and the edit lines of each cor
+def annotate_shard(annotator, data, cors, args, split_outputs):
+    docs = data.get_docs(annotator.nlp.vocab)
+    blocks = []
+    for line_cors in cors:
+        orig = next(docs)
+        # Write orig to the output m2 file
+        s_line = " ".join(["S"] + [token.text for token in orig]) + "\n"
+        cor_edits = []
+        # Loop through the corrected texts
+        for cor_id, cor in enumerate(line_cors):
+            if split_outputs:
+                cor_id = 0
+            # If the texts are the same, write a noop edit
+            if orig.text.strip() == cor:
+                cor_edits.append(noop_edit(cor_id) + "\n")
+            # Otherwise, do extra processing
+            else:
+                cor = next(docs)
+                # Align the texts and extract and classify the edits
+                edits = annotator.annotate(orig, cor, args.lev, args.merge)
+                # Write each edit to the output m2 file
+                cor_edits.append(
+                    "".join(edit.to_m2(cor_id) + "\n" for edit in edits)
+                )
+        blocks.append((s_line, cor_edits))
+    return blocks
+
+
+def write_blocks(blocks, out_m2s):
+    for s_line, cor_edits in blocks:
+        if len(out_m2s) == 1:
+            out_m2s[0].write(s_line + "".join(cor_edits))
             # Write a newline when we have processed all corrections for each line
-            out_m2.write("\n")
+            out_m2s[0].write("\n")
+        else:
+            for out_m2, edits in zip(out_m2s, cor_edits):
+                out_m2.write(s_line + edits + "\n")
 
 
 # Parse command line args
@@ -56,7 +211,7 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description="Align parallel text files and extract and classify the edits.\n",
         formatter_class=argparse.RawTextHelpFormatter,
-        usage="%(prog)s [-h] [options] -orig ORIG -cor COR [COR ...] -out OUT",
+        usage="%(prog)s [-h] [options] -orig ORIG -cor COR [COR ...] -out OUT [OUT ...]",
     )
     parser.add_argument(
         "-orig", help="The path to the original text file.", required=True
@@ -68,7 +223,12 @@ def parse_args():
         default=[],
         required=True,
     )
-    parser.add_argument("-out", help="The output filepath.", required=True)
+    parser.add_argument(
+        "-out",
+        help="The output filepath, or one output filepath per corrected file.",
+        nargs="+",
+        required=True,
+    )
     parser.add_argument(
         "-tok",
         help="Word tokenise the text using spacy (default: False).",
@@ -89,6 +249,34 @@ def parse_args():
         choices=["rules", "all-split", "all-merge", "all-equal"],
         default="rules",
     )
+    parser.add_argument(
+        "-cache",
+        help="The spaCy Doc cache to reuse parses from (default: %(default)s).",
+        default="cache/docs.sqlite3",
+    )
+    parser.add_argument(
+        "-no_cache",
+        help="Parse every sentence without reading or writing the cache.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-n_process",
+        help="Processes for spacy parsing and edit annotation (default: 1).",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-batch_size",
+        help="Lines per parsing batch and per annotation shard (default: 256).",
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        "-chunk_size",
+        help="Lines read and parsed together (default: 10000).",
+        type=int,
+        default=10000,
+    )
     args = parser.parse_args()
     return args
 
@@ -0,0 +1,32 @@
+import asyncio
+import logging
+import os
+import sys
+
+# Make the repository root importable when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main as gec
+
+
+# Correct again only the batches main.py gave up on (listed in
+# gec.DEAD_LETTER_PATH), with the model and paths configured in main.py, then
+# rebuild the output files. Batches that fail again stay dead-lettered:
+#
+# python3 commands/redrive_dead_letters.py
+
+
+if __name__ == "__main__":
+    logging.info("=" * 80)
+    logging.info(f"Model selected: {gec.MODEL_NAME}")
+    if gec.TRACING_ENABLED:
+        gec.tracer.export_to(gec.TRACE_OUTPUT_PATH)
+    asyncio.run(gec.redrive_dead_letters(gec.client, gec.CSV_OUTPUT_PATH))
+    logging.info(f"Token usage: {gec.usage_tracker.get_totals().get('run')}")
+    gec.usage_tracker.write_summary(gec.USAGE_OUTPUT_PATH)
+
+    logging.info("Generating the corrected and augmented pool files...")
+    gec.generate_output_files(
+        gec.JOURNAL_PATH,
+        gec.FINAL_OUTPUT_PATH,
+        gec.FINAL_OUTPUT_PATH_AUGMENTED_POOL,
+    )
@@ -12,10 +12,16 @@ from typing import Any, List
 import spacy
 import logging
 import datetime
-from tiktoken import get_encoding
 import subprocess
 import groq
+
+# Share modules (clients/, limiters/) with the GEC drivers in the repo root
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
 from clients.greco import AsyncGreco
+from limiters.rate_limiter import get_rate_limiter, estimate_request_tokens
+from splitters.token_counter import get_token_counter
 
 
 # python3 main.py
@@ -108,6 +114,7 @@ MAX_RETRIES = 3  # Maximum number of retries for an API call
 RETRY_DELAY = 30  # Delay in seconds before retrying an API
 # QPM_LIMIT = 3  # Queries per minute limit
 QPM_LIMIT = 10  # Queries per minute limit
+TPM_LIMIT = 80000  # Tokens per minute limit (None to disable)
 
 
 # CONFIGS: OTHERS
@@ -219,29 +226,13 @@ def get_openai_client(model_name: str) -> Any:
 client = get_openai_client(MODEL_NAME)
 
 
-# Rate limiter using an asyncio Semaphore
-class RateLimiter:
-    def __init__(self, rate_limit: int):
-        self.rate_limit = rate_limit
-        self.semaphore = asyncio.Semaphore(rate_limit)
-
-    async def __aenter__(self):
-        await self.semaphore.acquire()
-        return self
-
-    async def __aexit__(self, exc_type, exc, tb):
-        await asyncio.sleep(60 / self.rate_limit)
-        self.semaphore.release()
-
-
 rate_limiter = None  # Declare rate_limiter at the global scope for visibility
 
 
 async def main():
     global rate_limiter
-    rate_limiter = RateLimiter(
-        QPM_LIMIT
-    )  # Initialize rate_limiter in the async context
+    # Token-bucket rate limiter shared by every request to this endpoint
+    rate_limiter = get_rate_limiter(MODEL_NAME, QPM_LIMIT, TPM_LIMIT)
     await process_file(
         client, TEST_FILE_PATH, CSV_OUTPUT_PATH, REFERENCE_ANSWERS_PATH
     )
@@ -254,10 +245,8 @@ def format_user_content(text: str) -> str:
 
 
 def count_tokens(text: str) -> int:
-    enc = get_encoding("gpt2")
-    tokens = enc.encode(text)
-    token_count = len(tokens)
-    return token_count
+    # Uses the tokenizer of the target model and memoises repeated strings
+    return get_token_counter(MODEL_NAME).count(text)
 
 
 def calculate_avg_chars_per_token(sample_text: str) -> float:
@@ -277,8 +266,12 @@ def split_text_into_batches(
     current_batch_tokens = 0
     current_batch_lines = 0
 
-    for line in lines:
-        line_tokens = count_tokens(line + "\n")
+    # Count every line in one batched encode instead of one call per line
+    all_line_tokens = get_token_counter(MODEL_NAME).count_batch(
+        [line + "\n" for line in lines]
+    )
+
+    for line, line_tokens in zip(lines, all_line_tokens):
         if line_tokens > batch_size_in_tokens:
             print(
                 f"Error: Line exceeds the batch size of {batch_size_in_tokens} tokens."
@@ -368,7 +361,16 @@ async def ask_llm(
                 }
 
             # TODO: extract to a function
-            completion = await client.chat.completions.create(**model_params)
+            estimated_tokens = estimate_request_tokens(
+                model_params, count_tokens
+            )
+            async with rate_limiter.limit(estimated_tokens) as rate_limit_slot:
+                completion = await client.chat.completions.create(
+                    **model_params
+                )
+                rate_limit_slot.record_usage(
+                    getattr(completion, "usage", None)
+                )
             response = completion.choices[0].message.content
 
             # TODO: debug special character
@@ -428,36 +430,35 @@ async def correct_grammar_and_write_csv(
     model_name: str,
     correct_answer: str,
 ) -> str:
-    async with rate_limiter:
-        corrected_text = await ask_llm(
-            client,
-            FACT_CHECK_PROMPT,
-            text,
-            batch_number,
-            total_batches,
-            model_name,
-        )
+    corrected_text = await ask_llm(
+        client,
+        FACT_CHECK_PROMPT,
+        text,
+        batch_number,
+        total_batches,
+        model_name,
+    )
 
-        # TODO: better way?
-        # Process the corrected text with spaCy
-        doc = nlp(corrected_text.strip())
-        processed_text = " ".join(token.text for token in doc)
-        stripped_lines = [line.strip() for line in processed_text.split("\n")]
-        processed_text = "\n".join(stripped_lines)
+    # TODO: better way?
+    # Process the corrected text with spaCy
+    doc = nlp(corrected_text.strip())
+    processed_text = " ".join(token.text for token in doc)
+    stripped_lines = [line.strip() for line in processed_text.split("\n")]
+    processed_text = "\n".join(stripped_lines)
 
-        logging.info(
-            f"{GREEN}Received correction for batch {batch_number}/{total_batches}: {processed_text}{RESET}"
-        )
+    logging.info(
+        f"{GREEN}Received correction for batch {batch_number}/{total_batches}: {processed_text}{RESET}"
+    )
 
-        # Write the batch number and corrected text to the CSV
-        row = {"Batch Number": batch_number, "Corrected Text": processed_text}
-        if INCLUDE_INPUT_IN_CSV:
-            row["Input Text"] = text
-        if INCLUDE_ANSWER_IN_CSV:
-            row["Correct Answer"] = correct_answer
+    # Write the batch number and corrected text to the CSV
+    row = {"Batch Number": batch_number, "Corrected Text": processed_text}
+    if INCLUDE_INPUT_IN_CSV:
+        row["Input Text"] = text
+    if INCLUDE_ANSWER_IN_CSV:
+        row["Correct Answer"] = correct_answer
 
-        await csv_writer.writerow(row)
-        return processed_text
+    await csv_writer.writerow(row)
+    return processed_text
 
 
 # Function to check which batches have already been processed
@@ -0,0 +1,218 @@
+"""AIMD concurrency control driven by observed latency and overload errors."""
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from metrics.tracing import Tracer
+
+
+# Additive increase: +1 to the limit after roughly `limit` good requests
+INCREASE_STEP = 1.0
+# Multiplicative decrease on 429/5xx/timeouts
+DECREASE_FACTOR = 0.5
+# Latency is "flat" while the recent average stays within this factor of
+# the long-run average; above it the limit is held instead of raised
+LATENCY_TOLERANCE = 1.5
+SHORT_LATENCY_ALPHA = 0.3
+LONG_LATENCY_ALPHA = 0.05
+
+
+def get_status_code(error: BaseException) -> Optional[int]:
+    # openai/groq APIStatusError expose status_code; httpx errors a response
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        response = getattr(error, "response", None)
+        status_code = getattr(response, "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def is_overload_error(error: BaseException) -> bool:
+    status_code = get_status_code(error)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return isinstance(error, asyncio.TimeoutError) or (
+        "Timeout" in type(error).__name__
+    )
+
+
+class AdaptiveConcurrencyController:
+    """
+    Limits the number of in-flight requests to a backend and tunes that limit.
+
+    The limit grows additively while requests succeed and latency stays
+    flat, and is cut multiplicatively when the backend answers with a
+    rate-limit (429), a server error (5xx) or times out. Over a run it
+    settles just below the highest concurrency the backend sustains, so
+    QPM/concurrency no longer have to be retuned per provider.
+
+    The limit and the in-flight requests are kept as tracer gauges
+    (`gec_concurrency_limit`, `gec_concurrency_in_flight`).
+
+    Usage:
+        async with controller.slot():
+            completion = await client.chat.completions.create(**params)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial_limit: float = 4,
+        min_limit: float = 1,
+        max_limit: float = 64,
+        tracer: Optional[Tracer] = None,
+    ):
+        self.name = name
+        self.tracer = tracer
+        self.limit = float(initial_limit)
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.in_flight = 0
+        self.short_latency: Optional[float] = None
+        self.long_latency: Optional[float] = None
+        self.last_decrease_at = 0.0
+        self.successes = 0
+        self.overloads = 0
+        # Created by `get_condition`, inside the event loop that uses it; the
+        # controller is shared by the process and outlives any one loop
+        self.condition: Optional[asyncio.Condition] = None
+        self.condition_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.update_gauges()
+
+    @property
+    def current_limit(self) -> int:
+        return max(int(self.limit), int(self.min_limit))
+
+    def get_metrics(self) -> Dict[str, float]:
+        return {
+            "concurrency_limit": self.current_limit,
+            "concurrency_in_flight": self.in_flight,
+            "latency_short_seconds": self.short_latency or 0.0,
+            "latency_long_seconds": self.long_latency or 0.0,
+            "requests_succeeded": self.successes,
+            "requests_overloaded": self.overloads,
+        }
+
+    def update_gauges(self) -> None:
+        if self.tracer is None:
+            return
+        self.tracer.set_gauge(
+            "concurrency_limit", self.current_limit, model=self.name
+        )
+        self.tracer.set_gauge(
+            "concurrency_in_flight", self.in_flight, model=self.name
+        )
+
+    def get_condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self.condition is None or self.condition_loop is not loop:
+            self.condition = asyncio.Condition()
+            self.condition_loop = loop
+            # Requests of an earlier loop can no longer be in flight
+            self.in_flight = 0
+            self.update_gauges()
+        return self.condition
+
+    async def acquire(self) -> None:
+        condition = self.get_condition()
+        async with condition:
+            await condition.wait_for(
+                lambda: self.in_flight < self.current_limit
+            )
+            self.in_flight += 1
+        self.update_gauges()
+
+    async def release(self) -> None:
+        condition = self.get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+        self.update_gauges()
+
+    def set_limit(self, limit: float, reason: str) -> None:
+        previous_limit = self.current_limit
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+        if self.current_limit != previous_limit:
+            self.update_gauges()
+            logging.info(
+                f"[{self.name}] Concurrency limit {previous_limit} -> "
+                f"{self.current_limit} ({reason})"
+            )
+
+    def record_success(self, latency: float) -> None:
+        self.successes += 1
+        if self.short_latency is None or self.long_latency is None:
+            self.short_latency = latency
+            self.long_latency = latency
+        else:
+            self.short_latency += SHORT_LATENCY_ALPHA * (
+                latency - self.short_latency
+            )
+            self.long_latency += LONG_LATENCY_ALPHA * (
+                latency - self.long_latency
+            )
+
+        if self.short_latency <= self.long_latency * LATENCY_TOLERANCE:
+            self.set_limit(
+                self.limit + INCREASE_STEP / self.limit, "latency flat"
+            )
+
+    def record_failure(self, error: BaseException) -> None:
+        if not is_overload_error(error):
+            return
+        self.overloads += 1
+
+        # Requests that were already in flight when the backend got
+        # overloaded fail together; back off once per latency window
+        now = time.monotonic()
+        window = self.long_latency or 1.0
+        if now - self.last_decrease_at < window:
+            return
+        self.last_decrease_at = now
+        self.set_limit(
+            self.limit * DECREASE_FACTOR,
+            f"backend overloaded: {type(error).__name__}",
+        )
+
+    def slot(self) -> "ConcurrencySlot":
+        return ConcurrencySlot(self)
+
+
+class ConcurrencySlot:
+    def __init__(self, controller: AdaptiveConcurrencyController):
+        self.controller = controller
+        self.started_at = 0.0
+
+    async def __aenter__(self) -> "ConcurrencySlot":
+        await self.controller.acquire()
+        self.started_at = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        if exc is None:
+            self.controller.record_success(
+                time.monotonic() - self.started_at
+            )
+        else:
+            self.controller.record_failure(exc)
+        await self.controller.release()
+        return False
+
+
+# One controller per backend, shared by every caller in the process
+concurrency_controllers: Dict[str, AdaptiveConcurrencyController] = {}
+
+
+def get_concurrency_controller(
+    name: str,
+    initial_limit: float = 4,
+    min_limit: float = 1,
+    max_limit: float = 64,
+    tracer: Optional[Tracer] = None,
+) -> AdaptiveConcurrencyController:
+    if name not in concurrency_controllers:
+        concurrency_controllers[name] = AdaptiveConcurrencyController(
+            name, initial_limit, min_limit, max_limit, tracer
+        )
+    return concurrency_controllers[name]
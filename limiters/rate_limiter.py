@@ -0,0 +1,257 @@
+"""Token-bucket rate limiting with requests- and tokens-per-minute budgets."""
+
+import asyncio
+import email.utils
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+
+def estimate_tokens_from_chars(text: str) -> int:
+    # Rough fallback for callers without a tokenizer: ~4 characters per token
+    return len(text) // 4 + 1
+
+
+def count_prompt_tokens(
+    model_params: Dict[str, Any],
+    count_tokens: Callable[[str], int] = estimate_tokens_from_chars,
+) -> int:
+    messages: List[Dict[str, Any]] = model_params.get("messages", [])
+    prompt_tokens = sum(
+        count_tokens(message.get("content") or "") for message in messages
+    )
+    # GRECO/Coze requests carry the text in "query" rather than "messages"
+    if "query" in model_params:
+        prompt_tokens += count_tokens(model_params["query"])
+    return prompt_tokens
+
+
+def estimate_request_tokens(
+    model_params: Dict[str, Any],
+    count_tokens: Callable[[str], int] = estimate_tokens_from_chars,
+) -> int:
+    """
+    Estimates the token cost of a chat completion request before sending it.
+
+    The estimate is the prompt size plus `max_tokens`, i.e. the most the
+    request can consume; it is corrected from the response's usage later.
+    """
+    prompt_tokens = count_prompt_tokens(model_params, count_tokens)
+    return prompt_tokens + model_params.get("max_tokens", 0)
+
+
+def get_retry_after(error: BaseException) -> Optional[float]:
+    """
+    Returns the delay in seconds requested by a 429/503 response, if any.
+
+    Understands `retry-after-ms`, `retry-after` in seconds and `retry-after`
+    as an HTTP date, as sent by OpenAI, Azure OpenAI, Together and Groq.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        # A malformed header must not replace the API error it came with
+        return None
+    if retry_date is None:
+        return None
+    return max(retry_date.timestamp() - time.time(), 0.0)
+
+
+def get_backoff_delay(
+    attempt: int, base_delay: float, max_delay: float
+) -> float:
+    """
+    Exponential backoff with jitter before retry number `attempt` (1-based).
+
+    The delay doubles with every attempt up to `max_delay`, and a random
+    half of it is dropped so that batches failing together (e.g. on one
+    outage) do not all come back at the same moment.
+    """
+    delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class TokenBucket:
+    """
+    A bucket holding up to `capacity_per_minute` units, refilled continuously.
+
+    The level may go negative when a request turns out to cost more than was
+    reserved for it; later requests then wait until the debt is repaid.
+    """
+
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = float(capacity_per_minute)
+        self.refill_per_second = self.capacity / 60
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.level = min(
+            self.capacity, self.level + elapsed * self.refill_per_second
+        )
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        self.refill()
+        # A single request larger than the whole bucket only has to wait for
+        # a full bucket, otherwise it could never be sent
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_per_second
+
+    def consume(self, amount: float) -> None:
+        self.refill()
+        self.level -= amount
+
+    def adjust(self, amount: float) -> None:
+        # Positive amounts refund over-estimated tokens, negative ones charge
+        # for under-estimated tokens
+        self.refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    Enforces a requests-per-minute and an optional tokens-per-minute budget.
+
+    Usage:
+        async with rate_limiter.limit(estimated_tokens) as slot:
+            completion = await client.chat.completions.create(**params)
+            slot.record_usage(completion.usage)
+
+    Unlike the previous sleep-on-exit semaphore, capacity is released as it
+    refills rather than after a fixed delay, so throughput follows the
+    provider quota instead of `60 / rate_limit` per slot.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float,
+        tokens_per_minute: Optional[float] = None,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = (
+            TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        )
+        self.blocked_until = 0.0
+        # Waiters are served in arrival order. Created by `get_lock`, inside
+        # the event loop that uses it; the limiter is shared by the process
+        # and outlives any one loop
+        self.lock: Optional[asyncio.Lock] = None
+        self.lock_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def wait_time(self, estimated_tokens: int) -> float:
+        wait = max(
+            self.blocked_until - time.monotonic(),
+            self.request_bucket.wait_time(1),
+        )
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.wait_time(estimated_tokens))
+        return wait
+
+    def get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self.lock is None or self.lock_loop is not loop:
+            self.lock = asyncio.Lock()
+            self.lock_loop = loop
+        return self.lock
+
+    async def acquire(self, estimated_tokens: int = 0) -> None:
+        async with self.get_lock():
+            while True:
+                wait = self.wait_time(estimated_tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            self.request_bucket.consume(1)
+            if self.token_bucket is not None:
+                self.token_bucket.consume(estimated_tokens)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int) -> None:
+        if self.token_bucket is not None:
+            self.token_bucket.adjust(estimated_tokens - actual_tokens)
+
+    def pause(self, seconds: float) -> None:
+        """Blocks all new requests for `seconds`, e.g. from a Retry-After."""
+        self.blocked_until = max(
+            self.blocked_until, time.monotonic() + seconds
+        )
+
+    def limit(self, estimated_tokens: int = 0) -> "RateLimitSlot":
+        return RateLimitSlot(self, estimated_tokens)
+
+
+class RateLimitSlot:
+    def __init__(self, rate_limiter: RateLimiter, estimated_tokens: int):
+        self.rate_limiter = rate_limiter
+        self.estimated_tokens = estimated_tokens
+        self.usage_recorded = False
+
+    async def __aenter__(self) -> "RateLimitSlot":
+        await self.rate_limiter.acquire(self.estimated_tokens)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        if exc is not None:
+            retry_after = get_retry_after(exc)
+            if retry_after is not None:
+                self.rate_limiter.pause(retry_after)
+            # A request that failed without a response generated nothing, so
+            # its reserved tokens go back to the bucket for other requests
+            # instead of being held while the caller backs off
+            if not self.usage_recorded:
+                self.rate_limiter.record_usage(self.estimated_tokens, 0)
+        return False
+
+    def record_usage(self, usage: Any) -> None:
+        """Corrects the reserved token count from `completion.usage`."""
+        actual_tokens = getattr(usage, "total_tokens", None)
+        if actual_tokens is None and isinstance(usage, dict):
+            actual_tokens = usage.get("total_tokens")
+        if actual_tokens is not None:
+            self.rate_limiter.record_usage(
+                self.estimated_tokens, actual_tokens
+            )
+            self.usage_recorded = True
+
+
+# One limiter per endpoint, shared by every caller in the process
+rate_limiters: Dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(
+    endpoint: str,
+    requests_per_minute: float,
+    tokens_per_minute: Optional[float] = None,
+) -> RateLimiter:
+    if endpoint not in rate_limiters:
+        rate_limiters[endpoint] = RateLimiter(
+            requests_per_minute, tokens_per_minute
+        )
+    return rate_limiters[endpoint]
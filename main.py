@@ -8,14 +8,30 @@ import aiofiles
 import csv
 from dotenv import load_dotenv
 import atexit
-from typing import Any, List, Optional, Dict
+from typing import Any, Iterable, List, Optional, Dict
 import spacy
 import logging
 import datetime
-from tiktoken import get_encoding
-import subprocess
 import groq
 from clients.greco import AsyncGreco
+from limiters.rate_limiter import (
+    get_rate_limiter,
+    estimate_request_tokens,
+    get_backoff_delay,
+    get_retry_after,
+)
+from limiters.concurrency_controller import get_concurrency_controller
+from caches.response_cache import ResponseCache
+from caches.doc_cache import get_doc_cache
+from splitters.token_counter import get_token_counter
+from metrics.stage_timer import get_stage_timer
+from metrics.tracing import get_tracer, serve_metrics
+from metrics.usage import get_usage_tracker
+from pipelines.staged_pipeline import StagedPipeline, RetryLater
+from pipelines.dead_letter import DeadLetterQueue, LLMCallError
+from pipelines.run_journal import RunJournal, remove_journal
+from pipelines.ordered_writer import OrderedOutputWriter
+from commands.evaluate_correction import evaluate_correction
 from splitters.text_splitter import (
     SemanticChunker,
     BreakpointThresholdType,
@@ -95,6 +111,9 @@ MAX_TOKENS = 4096
 BATCH_SIZE_IN_TOKENS = int(MAX_TOKENS * 0.6)
 # MAX_LINES_PER_BATCH = 3
 MAX_LINES_PER_BATCH: Optional[int] = 20
+# Split on embedding-based topic shifts before batching (needs the OpenAI
+# embeddings API); False batches by tokens/lines only
+USE_SEMANTIC_CHUNKING = True
 # CHUNK_OVERLAP_IN_TOKENS = 50
 
 
@@ -106,14 +125,33 @@ CEFR_LEVEL_FILENAME = "ABCN.dev.gold.bea19"
 TEST_FILE_PATH = f"test/{CEFR_LEVEL_FILENAME}.orig"
 FINAL_OUTPUT_PATH = f"corrected_output/{CEFR_LEVEL_FILENAME}.corrected"
 CSV_OUTPUT_PATH = f"corrected_output/{CEFR_LEVEL_FILENAME}.corrected.csv"
+# Status, attempts, timing and text of every batch (SQLite); resume and the
+# output files read it instead of the CSV
+JOURNAL_PATH = f"corrected_output/{CEFR_LEVEL_FILENAME}.journal.sqlite3"
 FINAL_OUTPUT_PATH_AUGMENTED_POOL = (
     f"corrected_output/{CEFR_LEVEL_FILENAME}.augmented_pool.corrected"
 )
 CACHE_FILE_PATH = f"cache/{CEFR_LEVEL_FILENAME}.batches"
+# Batches that ran out of retries; their original text stands in for the
+# correction until `python3 commands/redrive_dead_letters.py` redoes them
+DEAD_LETTER_PATH = f"corrected_output/{CEFR_LEVEL_FILENAME}.dead_letter.jsonl"
+# Token usage and cost of every run on this file, beside the output CSV
+USAGE_OUTPUT_PATH = f"corrected_output/{CEFR_LEVEL_FILENAME}.usage.json"
+RESPONSE_CACHE_PATH = "cache/responses.sqlite3"
+DOC_CACHE_PATH = "cache/docs.sqlite3"
+
+
+# CONFIGS: RESPONSE CACHE
+# "readwrite": reuse and store responses; "readonly": reuse only, for
+# reproducible evaluation runs; "off": always call the API
+RESPONSE_CACHE_MODE = "readwrite"
+RESPONSE_CACHE_MAX_SIZE_BYTES = 1024 * 1024 * 1024  # 1 GiB
+RESPONSE_CACHE_MAX_AGE_SECONDS: Optional[float] = None  # Never expire
 
 
 # CONFIGS: API
 AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT", "")
+# e.g. http://127.0.0.1:8000/v1 for `python3 -m clients.mock_llm_server`
 LOCAL_ENDPOINT = os.getenv("LOCAL_ENDPOINT", "")
 TOGETHER_ENDPOINT = os.getenv("TOGETHER_ENDPOINT", "")
 TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY", "")
@@ -125,10 +163,42 @@ COZE_API_KEY = os.getenv("COZE_API_KEY", "")
 # RETRY_DELAY = 5  # Delay in seconds before retrying an API
 MAX_RETRIES = 5  # Maximum number of retries for an API call
 # RETRY_DELAY = 15  # Delay in seconds before retrying an API
-RETRY_DELAY = 30  # Delay in seconds before retrying an API
+# Delay in seconds before the first retry of a batch, doubled (with jitter)
+# on every further retry up to RETRY_MAX_DELAY; the batch waits in the
+# pipeline's retry queue, not in an LLM worker
+RETRY_DELAY = 30
+RETRY_MAX_DELAY = 300
 # QPM_LIMIT = 5  # Queries per minute limit
 # QPM_LIMIT = 15  # Queries per minute limit
 QPM_LIMIT = 3  # Queries per minute limit
+TPM_LIMIT = 80000  # Tokens per minute limit (None to disable)
+# In-flight requests to start with; the adaptive concurrency controller raises
+# it while latency is flat and halves it on 429/5xx
+INITIAL_CONCURRENCY = 3
+MAX_CONCURRENCY = 32
+
+
+# CONFIGS: PIPELINE
+# Batches are corrected, tokenised and written by separate stages joined by
+# bounded queues, so only a few batches are in memory at once however large
+# the input is
+# LLM requests in flight at most; the concurrency controller and rate
+# limiter still decide when each one is sent
+PIPELINE_LLM_WORKERS = MAX_CONCURRENCY
+# Batches waiting in front of each stage
+PIPELINE_QUEUE_SIZE = 64
+# Log every stage's queue depth this often (seconds); the depths are also
+# Prometheus gauges on METRICS_PORT
+PIPELINE_MONITOR_INTERVAL = 30
+
+
+# CONFIGS: TRACING
+# Append every span (batch, LLM call, GRECO stage) to TRACE_OUTPUT_PATH;
+# print each batch's critical path with `python3 -m metrics.tracing <path>`
+TRACING_ENABLED = True
+# Serve Prometheus metrics on http://127.0.0.1:<port>/metrics while the run
+# goes on (None to disable)
+METRICS_PORT: Optional[int] = None
 
 
 # CONFIGS: OTHERS
@@ -226,6 +296,9 @@ run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 # Define log file paths with the unique run identifier
 LOGGING_OUTPUT_PATH = f"logs/run_{run_id}.log"
 ERROR_OUTPUT_PATH = f"logs/error_{run_id}.log"
+TRACE_OUTPUT_PATH = f"logs/trace_{run_id}.jsonl"
+# logs/ is not tracked, so a fresh checkout does not have it
+os.makedirs(os.path.dirname(LOGGING_OUTPUT_PATH), exist_ok=True)
 
 # Configure logging to output to a file
 logging.basicConfig(
@@ -277,23 +350,27 @@ def get_openai_client(model_name: str) -> Any:
 
 client = get_openai_client(MODEL_NAME)
 
+response_cache = ResponseCache(
+    RESPONSE_CACHE_PATH,
+    mode=RESPONSE_CACHE_MODE,
+    max_size_bytes=RESPONSE_CACHE_MAX_SIZE_BYTES,
+    max_age_seconds=RESPONSE_CACHE_MAX_AGE_SECONDS,
+)
 
-# Rate limiter using an asyncio Semaphore
-class RateLimiter:
-    def __init__(self, rate_limit: int):
-        self.rate_limit = rate_limit
-        self.semaphore = asyncio.Semaphore(rate_limit)
-
-    async def __aenter__(self):
-        await self.semaphore.acquire()
-        return self
+# spaCy parses shared with GRECO's edit extraction and parallel_to_m2
+doc_cache = get_doc_cache(nlp, DOC_CACHE_PATH)
 
-    async def __aexit__(self, exc_type, exc, tb):
-        await asyncio.sleep(60 / self.rate_limit)
-        self.semaphore.release()
 
+# Shared with the in-process GRECO workflow, so its spans join the batch's
+# trace
+tracer = get_tracer()
+usage_tracker = get_usage_tracker()
 
-rate_limiter = RateLimiter(QPM_LIMIT)
+# Token-bucket rate limiter shared by every request to this model's endpoint
+rate_limiter = get_rate_limiter(MODEL_NAME, QPM_LIMIT, TPM_LIMIT)
+concurrency_controller = get_concurrency_controller(
+    MODEL_NAME, INITIAL_CONCURRENCY, max_limit=MAX_CONCURRENCY, tracer=tracer
+)
 
 
 def format_user_content(text: str) -> str:
@@ -314,11 +391,19 @@ def format_user_content(text: str) -> str:
     return json.dumps({"input": text_with_next_token})
 
 
+def tokenise_text(text: str) -> str:
+    # Tokenising line by line gives the same tokens as tokenising the whole
+    # text (spaCy never merges across whitespace) and lets every line's
+    # parse be reused from, and by, the other stages
+    docs = doc_cache.get_docs(text.strip().split("\n"))
+    return "\n".join(
+        " ".join(token.text for token in doc).strip() for doc in docs
+    )
+
+
 def count_tokens(text: str) -> int:
-    enc = get_encoding("gpt2")
-    tokens = enc.encode(text)
-    token_count = len(tokens)
-    return token_count
+    # Uses the tokenizer of the target model and memoises repeated strings
+    return get_token_counter(MODEL_NAME).count(text)
 
 
 def calculate_avg_chars_per_token(sample_text: str) -> float:
@@ -407,8 +492,12 @@ def split_text_into_batches(
     current_batch_tokens = 0
     current_batch_lines = 0
 
-    for line in lines:
-        line_tokens = count_tokens(line + "\n")
+    # Count every line in one batched encode instead of one call per line
+    all_line_tokens = get_token_counter(MODEL_NAME).count_batch(
+        [line + "\n" for line in lines]
+    )
+
+    for line, line_tokens in zip(lines, all_line_tokens):
         if line_tokens > batch_size_in_tokens:
             print(
                 f"Error: Line exceeds the batch size of {batch_size_in_tokens} tokens."
@@ -523,9 +612,13 @@ async def ask_llm(
     batch_number: int,
     total_batches: int,
     model_name: str,
+    attempt: int = 1,
 ) -> Dict[str, str]:
-    retries = 0
-    while retries < MAX_RETRIES:
+    # One attempt; failures are logged and raised for the caller to retry
+    with tracer.span(
+        "ask_llm", model=model_name, batch_number=batch_number, attempt=attempt
+    ) as span:
+        response = ""
         try:
             # TODO: refactor later
             logging.info(
@@ -552,9 +645,60 @@ async def ask_llm(
                     "stream": False,
                 }
 
-            # TODO: extract to a function
-            completion = await client.chat.completions.create(**model_params)
-            response = completion.choices[0].message.content
+            # Identical requests (e.g. on a rerun) are served from disk. A
+            # GRECO request only carries the batch text, not the prompts,
+            # rubric and models behind it, so it is never cached here; the
+            # workflow caches each of its own calls
+            use_response_cache = model_name not in GRECO_SYSTEMS
+            cached_response = (
+                response_cache.get(model_params)
+                if use_response_cache
+                else None
+            )
+            if cached_response is not None:
+                logging.info(
+                    f"Using cached response for batch {batch_number}/{total_batches}"
+                )
+                response = cached_response.content
+                usage = cached_response.usage
+                span.set(cached=True)
+                usage_tracker.record(
+                    model_name,
+                    "correction",
+                    batch_number,
+                    model_params,
+                    response,
+                    cached=True,
+                )
+            else:
+                # TODO: extract to a function
+                estimated_tokens = estimate_request_tokens(
+                    model_params, count_tokens
+                )
+                # Time spent waiting on the rate limiter counts towards the
+                # observed latency, so the controller stops adding
+                # concurrency once the QPM/TPM budget is the bottleneck
+                async with concurrency_controller.slot(), rate_limiter.limit(
+                    estimated_tokens
+                ) as rate_limit_slot:
+                    completion = await client.chat.completions.create(
+                        **model_params
+                    )
+                    usage = getattr(completion, "usage", None)
+                    rate_limit_slot.record_usage(usage)
+                span.add_usage(usage)
+                response = completion.choices[0].message.content
+                # The GRECO workflow records each of its own calls; its
+                # outer request never reaches a paid model
+                if model_name not in GRECO_SYSTEMS:
+                    usage_tracker.record(
+                        model_name,
+                        "correction",
+                        batch_number,
+                        model_params,
+                        response,
+                        usage,
+                    )
 
             # TODO: debug special character
             logging.info(
@@ -591,122 +735,216 @@ async def ask_llm(
                     "Number of lines in response_text does not match the number of lines in text"
                 )
 
+            # Only responses that parsed and validated are cached, so a bad
+            # response is never replayed on retry
+            if use_response_cache and cached_response is None:
+                response_cache.put(model_params, response, usage)
+
             return {
                 "corrected_text": corrected_text,
                 "corrected_text_augmented_pool": corrected_text_augmented_pool,
             }
         except json.JSONDecodeError as e:
+            error = e
             error_snippet = extract_error_snippet(e)
             logging.error(
                 f"Error processing response for batch {batch_number}/{total_batches}: {error_snippet}"
             )
         except ValueError as e:
+            error = e
             logging.error(
                 f"Error processing response for batch {batch_number}/{total_batches}: {e}"
             )
         except Exception as e:
+            error = e
             logging.error(
                 f"An error occurred while processing batch {batch_number}/{total_batches}: {e}"
             )
-        retries += 1
-        if retries < MAX_RETRIES:
-            logging.info(
-                f"{YELLOW}Retrying for batch {batch_number}/{total_batches} (Attempt {retries}/{MAX_RETRIES}){RESET}"
+        # Whatever came back for this attempt is paid for but unused
+        if model_name not in GRECO_SYSTEMS:
+            usage_tracker.record_discarded(
+                model_name, "correction", batch_number, response
             )
-            await asyncio.sleep(RETRY_DELAY)
-        else:
-            logging.error(
-                f"Max retries reached for batch {batch_number}/{total_batches}. Exiting the program."
-            )
-            sys.exit(1)  # Exit the program with a non-zero status code
-    raise RuntimeError("Unexpected execution path")
+        # A GRECO workflow that gave up carries the response it gave up on
+        raise LLMCallError(
+            error, response or getattr(error, "raw_response", "")
+        ) from error
 
 
-async def correct_grammar_and_write_csv(
+async def correct_batch(
     client: Any,
-    text: str,
-    batch_number: int,
+    batch: Dict[str, Any],
     total_batches: int,
-    csv_writer: Any,
     model_name: str,
-) -> str:
+    dead_letters: DeadLetterQueue,
+) -> Dict[str, Any]:
+    batch_number = batch["batch_number"]
+    if "span" not in batch:
+        batch["start_time"] = time.time()  # Capture start time
+        # Root span of this batch's trace, ended once the batch is written;
+        # GRECO's spans nest under it when the workflow runs in-process
+        batch["span"] = tracer.start_span(
+            "batch", batch_number=batch_number, model=model_name
+        )
+    batch["attempts"] = batch.get("attempts", 0) + 1
+    batch["span"].set(retries=batch["attempts"] - 1)
 
-    async with rate_limiter:
-        start_time = time.time()  # Capture start time
+    try:
+        with tracer.use_span(batch["span"]), get_stage_timer().stage("llm"):
+            response = await ask_llm(
+                client,
+                GRAMMAR_PROMPT,
+                batch["text"],
+                batch_number,
+                total_batches,
+                model_name,
+                batch["attempts"],
+            )
+    except Exception as e:
+        error = e.error if isinstance(e, LLMCallError) else e
+        if batch["attempts"] < MAX_RETRIES:
+            # The worker (and any rate-limit reservation) is free for other
+            # batches while this one backs off
+            delay = get_backoff_delay(
+                batch["attempts"], RETRY_DELAY, RETRY_MAX_DELAY
+            )
+            delay = max(delay, get_retry_after(error) or 0.0)
+            logging.info(
+                f"{YELLOW}Retrying for batch {batch_number}/{total_batches} in {delay:.1f} seconds (Attempt {batch['attempts']}/{MAX_RETRIES}){RESET}"
+            )
+            raise RetryLater(delay) from e
 
-        response = await ask_llm(
-            client,
-            GRAMMAR_PROMPT,
-            text,
+        logging.error(
+            f"Max retries reached for batch {batch_number}/{total_batches}. Keeping its original text and writing it to {dead_letters.path}."
+        )
+        dead_letters.add(
             batch_number,
-            total_batches,
-            model_name,
+            batch["text"],
+            batch["attempts"],
+            error,
+            getattr(e, "raw_response", ""),
         )
+        # The rest of the run goes on; the original text keeps the output
+        # aligned with the input until the batch is re-driven
+        batch["error"] = e
+        batch["corrected_text"] = batch["text"]
+        batch["corrected_text_augmented_pool"] = batch["text"]
+        return batch
+    except BaseException as e:
+        tracer.end_span(batch["span"], e)
+        raise
+
+    batch.update(response)
+    print(
+        "> corrected_text_augmented_pool:",
+        batch["corrected_text_augmented_pool"],
+    )
+    return batch
 
-        corrected_text = response["corrected_text"]
-        corrected_text_augmented_pool = response[
-            "corrected_text_augmented_pool"
-        ]
 
-        print(
-            "> corrected_text_augmented_pool:", corrected_text_augmented_pool
-        )
+async def tokenise_batch(
+    batch: Dict[str, Any], total_batches: int
+) -> Dict[str, Any]:
+    stage_timer = get_stage_timer()
 
-        # TODO: better way?
-        # Process the corrected text with spaCy
-        doc = nlp(corrected_text.strip())
-        processed_text = " ".join(token.text for token in doc)
-        stripped_lines = [line.strip() for line in processed_text.split("\n")]
-        processed_text = "\n".join(stripped_lines)
-
-        doc = nlp(corrected_text_augmented_pool.strip())
-        processed_text_augmented_pool = " ".join(token.text for token in doc)
-        stripped_lines = [
-            line.strip() for line in processed_text_augmented_pool.split("\n")
-        ]
-        processed_text_augmented_pool = "\n".join(stripped_lines)
-
-        # Right before your existing logging statement
-        end_time = (
-            time.time()
-        )  # Capture end time after processing is completed
-        duration_seconds = (
-            end_time - start_time
-        )  # Calculate the duration in seconds
-
-        # Modified logging statement to include duration
-        logging.info(
-            f"{GREEN}Received correction for batch {batch_number}/{total_batches} in {duration_seconds:.2f} seconds: {processed_text}{RESET}"
+    # Process the corrected text with spaCy
+    with stage_timer.stage("tokenisation"), tracer.span(
+        "tokenisation", parent=batch["span"]
+    ):
+        batch["processed_text"] = tokenise_text(batch["corrected_text"])
+        batch["processed_text_augmented_pool"] = tokenise_text(
+            batch["corrected_text_augmented_pool"]
         )
 
-        # Write the batch number and corrected text to the CSV
-        row = {
-            "Batch Number": batch_number,
-            "Corrected Text": processed_text,
-            "Augmented Pool Text": processed_text_augmented_pool,
-        }
+    # Calculate the duration in seconds
+    duration_seconds = time.time() - batch["start_time"]
+    stage_timer.record("batch", duration_seconds)
+
+    # Modified logging statement to include duration
+    logging.info(
+        f"{GREEN}Received correction for batch {batch['batch_number']}/{total_batches} in {duration_seconds:.2f} seconds: {batch['processed_text']}{RESET}"
+    )
+    return batch
+
+
+async def write_batch(
+    batch: Dict[str, Any],
+    csv_writer: Any,
+    journal: RunJournal,
+    output_writer: Optional[OrderedOutputWriter],
+) -> None:
+    # Write the batch number and corrected text to the CSV
+    row = {
+        "Batch Number": batch["batch_number"],
+        "Corrected Text": batch["processed_text"],
+        "Augmented Pool Text": batch["processed_text_augmented_pool"],
+    }
+    error = batch.get("error")
+    with get_stage_timer().stage("csv_write"), tracer.span(
+        "csv_write", parent=batch["span"]
+    ):
         await csv_writer.writerow(row)
-        return processed_text
+        journal.record(
+            batch["batch_number"],
+            "done" if error is None else "dead_lettered",
+            batch["attempts"],
+            batch["processed_text"],
+            batch["processed_text_augmented_pool"],
+            batch["start_time"],
+            None if error is None else str(error),
+        )
+    if output_writer is not None:
+        with get_stage_timer().stage("output_write"), tracer.span(
+            "output_write", parent=batch["span"]
+        ):
+            await output_writer.add(
+                batch["batch_number"],
+                batch["processed_text"],
+                batch["processed_text_augmented_pool"],
+            )
+    tracer.end_span(batch["span"], error)
 
 
-# Function to check which batches have already been processed
-async def get_processed_batches(csv_output_path: str) -> set[int]:
-    processed_batches = set()
+async def correct_batches(
+    client: Any,
+    batches: Iterable[Dict[str, Any]],
+    total_batches: int,
+    csv_writer: Any,
+    dead_letters: DeadLetterQueue,
+    journal: RunJournal,
+    output_writer: Optional[OrderedOutputWriter] = None,
+):
+    # Only the batches in the pipeline's queues and stages are held as
+    # prompts, responses and rows, however many batches there are
+    pipeline = StagedPipeline(
+        "batches",
+        tracer=tracer,
+        monitor_interval=PIPELINE_MONITOR_INTERVAL,
+    )
+    pipeline.add_stage(
+        "llm",
+        lambda batch: correct_batch(
+            client, batch, total_batches, MODEL_NAME, dead_letters
+        ),
+        workers=PIPELINE_LLM_WORKERS,
+        queue_size=PIPELINE_QUEUE_SIZE,
+    )
+    # spaCy and the CSV writer run on the event loop, so one worker each
+    pipeline.add_stage(
+        "postprocessing",
+        lambda batch: tokenise_batch(batch, total_batches),
+        queue_size=PIPELINE_QUEUE_SIZE,
+    )
+    pipeline.add_stage(
+        "write",
+        lambda batch: write_batch(batch, csv_writer, journal, output_writer),
+        queue_size=PIPELINE_QUEUE_SIZE,
+    )
     try:
-        async with aiofiles.open(csv_output_path, "r") as csv_file:
-            content = await csv_file.read()
-            reader = csv.DictReader(content.splitlines())
-            for row in reader:
-                try:
-                    batch_number = int(row["Batch Number"])
-                    processed_batches.add(batch_number)
-                except (ValueError, KeyError):
-                    # Skip rows with invalid or missing "Batch Number"
-                    continue
-    except FileNotFoundError:
-        # If the CSV file does not exist, return an empty set
-        pass
-    return processed_batches
+        await pipeline.run(batches)
+    finally:
+        if isinstance(client, AsyncGreco):
+            await client.close()
 
 
 async def process_file(client: Any, test_file_path: str, csv_output_path: str):
@@ -714,6 +952,7 @@ async def process_file(client: Any, test_file_path: str, csv_output_path: str):
     existing_files = (
         os.path.exists(FINAL_OUTPUT_PATH)
         or os.path.exists(CSV_OUTPUT_PATH)
+        or os.path.exists(JOURNAL_PATH)
         or os.path.exists(CACHE_FILE_PATH)
     )
     if existing_files:
@@ -730,9 +969,11 @@ async def process_file(client: Any, test_file_path: str, csv_output_path: str):
                 FINAL_OUTPUT_PATH,
                 CSV_OUTPUT_PATH,
                 CACHE_FILE_PATH,
+                DEAD_LETTER_PATH,
             ]:
                 if os.path.exists(file_path):
                     os.remove(file_path)
+            remove_journal(JOURNAL_PATH)
             print("Existing files removed. Starting fresh...")
             # Since we're starting fresh, ensure there's no cached batches
             cached_batches = []
@@ -751,7 +992,11 @@ async def process_file(client: Any, test_file_path: str, csv_output_path: str):
     else:
         cached_batches = []
 
-    processed_batches = await get_processed_batches(csv_output_path)
+    journal = RunJournal(JOURNAL_PATH, run_id)
+    if journal.is_empty() and os.path.exists(csv_output_path):
+        # A run started before the journal existed resumes from its CSV
+        imported = journal.import_csv(csv_output_path)
+        logging.info(f"Imported {imported} rows from {csv_output_path}")
     file_exists = os.path.exists(csv_output_path)
     should_write_header = (
         not file_exists or os.stat(csv_output_path).st_size == 0
@@ -759,7 +1004,9 @@ async def process_file(client: Any, test_file_path: str, csv_output_path: str):
 
     async with aiofiles.open(test_file_path, "r") as test_file, aiofiles.open(
         csv_output_path, "a", newline=""
-    ) as csv_file:
+    ) as csv_file, OrderedOutputWriter(
+        FINAL_OUTPUT_PATH, FINAL_OUTPUT_PATH_AUGMENTED_POOL
+    ) as output_writer:
         text = await test_file.read()
         csv_writer = csv.DictWriter(
             csv_file,
@@ -776,9 +1023,12 @@ async def process_file(client: Any, test_file_path: str, csv_output_path: str):
             )
 
         if not cached_batches:  # Check if we need to generate batches
-            batches = split_text_into_batches(
-                text, BATCH_SIZE_IN_TOKENS, use_semantic_chunking=True
-            )
+            with get_stage_timer().stage("splitting"):
+                batches = split_text_into_batches(
+                    text,
+                    BATCH_SIZE_IN_TOKENS,
+                    use_semantic_chunking=USE_SEMANTIC_CHUNKING,
+                )
             # Save batches to cache file
             with open(CACHE_FILE_PATH, "w") as cache_file:
                 json.dump(batches, cache_file)
@@ -786,61 +1036,104 @@ async def process_file(client: Any, test_file_path: str, csv_output_path: str):
             batches = cached_batches
 
         total_batches = len(batches)
-        tasks = []
-        for batch_number, batch_text in enumerate(batches, start=1):
-            if batch_number in processed_batches:
-                continue
-            tasks.append(
-                correct_grammar_and_write_csv(
-                    client,
-                    batch_text,
-                    batch_number,
-                    total_batches,
-                    csv_writer,
-                    MODEL_NAME,
-                )
-            )
-        await asyncio.gather(*tasks)
+        # Batches finished by an earlier run go first, so the output files
+        # carry on from where that run stopped
+        for completed_batch in journal.iter_completed():
+            await output_writer.add(*completed_batch)
 
+        dead_letters = DeadLetterQueue(DEAD_LETTER_PATH, run_id)
+        await correct_batches(
+            client,
+            (
+                {"batch_number": batch_number, "text": batch_text}
+                for batch_number, batch_text in enumerate(batches, start=1)
+                if not journal.is_completed(batch_number)
+            ),
+            total_batches,
+            csv_writer,
+            dead_letters,
+            journal,
+            output_writer,
+        )
+    journal.close()
+    logging.info(
+        f"Output files written up to batch {output_writer.next_batch - 1}/{total_batches}, at most {output_writer.max_pending} batches waiting for an earlier one"
+    )
 
-def generate_corrected_file_from_csv(csv_output_path: str, output_path: str):
-    with open(
-        csv_output_path, mode="r", newline="", encoding="utf-8"
-    ) as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        sorted_rows = sorted(
-            csv_reader, key=lambda row: int(row["Batch Number"])
+    if dead_letters.added:
+        logging.warning(
+            f"{dead_letters.added} batches ran out of retries and were written to {DEAD_LETTER_PATH}; re-drive them with python3 commands/redrive_dead_letters.py"
         )
 
-    with open(
-        output_path, mode="w", newline="", encoding="utf-8"
-    ) as output_file:
-        for row in sorted_rows:
-            if "Corrected Text" in row:
-                corrected_lines = row["Corrected Text"].split("\n")
-                for corrected_line in corrected_lines:
-                    output_file.write(corrected_line + "\n")
 
+async def redrive_dead_letters(client: Any, csv_output_path: str):
+    dead_letters = DeadLetterQueue(DEAD_LETTER_PATH, run_id)
+    entries = dead_letters.read()
+    if not entries:
+        logging.info(f"No dead-lettered batches in {DEAD_LETTER_PATH}")
+        return
+    if not os.path.exists(csv_output_path):
+        print(f"Error: {csv_output_path} not found. Run main.py first.")
+        sys.exit(1)
+
+    total_batches = max(entries)
+    if os.path.exists(CACHE_FILE_PATH):
+        with open(CACHE_FILE_PATH, "r") as cache_file:
+            total_batches = len(json.load(cache_file))
+    logging.info(
+        f"Re-driving {len(entries)} dead-lettered batches: {list(entries)}"
+    )
 
-def generate_augmented_pool_file_from_csv(
-    csv_output_path: str, output_path: str
-):
-    with open(
-        csv_output_path, mode="r", newline="", encoding="utf-8"
-    ) as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        sorted_rows = sorted(
-            csv_reader, key=lambda row: int(row["Batch Number"])
+    # Corrected rows replace the placeholders in the journal, and are
+    # appended after them in the CSV
+    async with aiofiles.open(csv_output_path, "a", newline="") as csv_file:
+        csv_writer = csv.DictWriter(
+            csv_file,
+            fieldnames=[
+                "Batch Number",
+                "Corrected Text",
+                "Augmented Pool Text",
+            ],
+        )
+        journal = RunJournal(JOURNAL_PATH, run_id)
+        await correct_batches(
+            client,
+            (
+                {"batch_number": batch_number, "text": entry["text"]}
+                for batch_number, entry in entries.items()
+            ),
+            total_batches,
+            csv_writer,
+            dead_letters,
+            journal,
         )
+        journal.close()
+
+    # Batches that failed again were dead-lettered by this run
+    dead_letters.keep_run(run_id)
+    logging.info(
+        f"{len(entries) - dead_letters.added} of {len(entries)} dead-lettered batches corrected"
+    )
+
 
+def generate_output_files(
+    journal_path: str, output_path: str, augmented_pool_output_path: str
+):
+    # One scan of the journal in batch order writes both files, without
+    # reading every batch into memory to sort it; process_file writes them
+    # as it goes, so this is only needed after a re-drive
+    journal = RunJournal(journal_path)
     with open(
         output_path, mode="w", newline="", encoding="utf-8"
-    ) as output_file:
-        for row in sorted_rows:
-            if "Augmented Pool Text" in row:
-                augmented_pool_lines = row["Augmented Pool Text"].split("\n")
-                for augmented_pool_line in augmented_pool_lines:
-                    output_file.write(augmented_pool_line + "\n")
+    ) as output_file, open(
+        augmented_pool_output_path, mode="w", newline="", encoding="utf-8"
+    ) as augmented_pool_output_file:
+        for _, corrected_text, augmented_pool_text in journal.iter_completed():
+            for corrected_line in corrected_text.split("\n"):
+                output_file.write(corrected_line + "\n")
+            for augmented_pool_line in augmented_pool_text.split("\n"):
+                augmented_pool_output_file.write(augmented_pool_line + "\n")
+    journal.close()
 
 
 # Function to log a divider when the program exits
@@ -858,19 +1151,11 @@ def prompt_for_evaluation():
     )
     if user_response == "yes":
         try:
-            # Execute the evaluation script
+            # Evaluate in this process, reusing the Doc cache of this run
             print("Evaluating the corrections...")
-            subprocess.run(
-                [
-                    "python3",
-                    "commands/evaluate_correction.py",
-                    "--filename",
-                    CEFR_LEVEL_FILENAME,
-                ],
-                check=True,
-            )
+            evaluate_correction(CEFR_LEVEL_FILENAME)
             print("Evaluation completed successfully.")
-        except subprocess.CalledProcessError as e:
+        except Exception as e:
             print(f"An error occurred during evaluation: {e}")
     elif user_response == "no":
         print("Evaluation skipped.")
@@ -883,16 +1168,19 @@ if __name__ == "__main__":
     logging.info("=" * 80)
     logging.info(f"Model selected: {MODEL_NAME}")
     logging.info(f"{BLUE}Using prompt: {GRAMMAR_PROMPT}{RESET}")
+    if TRACING_ENABLED:
+        tracer.export_to(TRACE_OUTPUT_PATH)
+    if METRICS_PORT is not None:
+        serve_metrics(tracer, METRICS_PORT)
     logging.info("Starting to process the file...")
     asyncio.run(process_file(client, TEST_FILE_PATH, CSV_OUTPUT_PATH))
-
-    logging.info("Generating the corrected file from CSV...")
-    generate_corrected_file_from_csv(CSV_OUTPUT_PATH, FINAL_OUTPUT_PATH)
-
-    logging.info("Generating the augmented pool file from CSV...")
-    generate_augmented_pool_file_from_csv(
-        CSV_OUTPUT_PATH, FINAL_OUTPUT_PATH_AUGMENTED_POOL
+    logging.info(
+        f"Concurrency metrics: {concurrency_controller.get_metrics()}"
     )
+    logging.info(f"Response cache: {response_cache.get_stats()}")
+    logging.info(f"Doc cache: {doc_cache.get_stats()}")
+    logging.info(f"Token usage: {usage_tracker.get_totals().get('run')}")
+    usage_tracker.write_summary(USAGE_OUTPUT_PATH)
 
     logging.info("File processing completed.")
     prompt_for_evaluation()
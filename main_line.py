@@ -12,6 +12,7 @@ from typing import Any
 import spacy
 import logging
 import datetime
+from limiters.rate_limiter import get_rate_limiter, estimate_request_tokens
 
 
 # python3 main.py
@@ -55,6 +56,7 @@ API_KEY = os.getenv("AZURE_OPENAI_API_KEY", "")
 MAX_RETRIES = 3  # Maximum number of retries for an API call
 RETRY_DELAY = 30  # Delay in seconds before retrying an API
 QPM_LIMIT = 3  # Queries per minute limit
+TPM_LIMIT = 80000  # Tokens per minute limit (None to disable)
 
 
 # ABCN test set (evaluate on: https://codalab.lisn.upsaclay.fr/competitions/4057)
@@ -172,22 +174,8 @@ def get_openai_client(model_name: str) -> Any:
 client = get_openai_client(MODEL_NAME)
 
 
-# Rate limiter using an asyncio Semaphore
-class RateLimiter:
-    def __init__(self, rate_limit: int):
-        self.rate_limit = rate_limit
-        self.semaphore = asyncio.Semaphore(rate_limit)
-
-    async def __aenter__(self):
-        await self.semaphore.acquire()
-        return self
-
-    async def __aexit__(self, exc_type, exc, tb):
-        await asyncio.sleep(60 / self.rate_limit)
-        self.semaphore.release()
-
-
-rate_limiter = RateLimiter(QPM_LIMIT)
+# Token-bucket rate limiter shared by every request to this model's endpoint
+rate_limiter = get_rate_limiter(MODEL_NAME, QPM_LIMIT, TPM_LIMIT)
 
 
 def format_user_content(text: str) -> str:
@@ -222,7 +210,14 @@ async def ask_llm(
             if model_name in ["gpt-4-1106-preview", "gpt-3.5-turbo-1106"]:
                 model_params["response_format"] = {"type": "json_object"}
 
-            completion = await client.chat.completions.create(**model_params)
+            estimated_tokens = estimate_request_tokens(model_params)
+            async with rate_limiter.limit(estimated_tokens) as rate_limit_slot:
+                completion = await client.chat.completions.create(
+                    **model_params
+                )
+                rate_limit_slot.record_usage(
+                    getattr(completion, "usage", None)
+                )
 
             # Parse the 'content' field as JSON
             response = completion.choices[0].message.content
@@ -272,25 +267,24 @@ async def correct_grammar_and_write_csv(
     csv_writer: Any,
     model_name: str,
 ) -> str:
-    async with rate_limiter:
-        corrected_text = await ask_llm(
-            client, GRAMMAR_PROMPT, text, line_number, total_lines, model_name
-        )
-        # Process the corrected text with spaCy
-        doc = nlp(corrected_text.strip())
-        processed_text = " ".join(token.text for token in doc)
-        logging.info(
-            f"{GREEN}Received correction for line {line_number}/{total_lines}: {processed_text}{RESET}"
-        )
-        # Create a dictionary for the CSV row
-        row = {
-            "Line Number": line_number,
-            "Original Sentence": text.strip(),
-            "Corrected Sentence": processed_text,
-        }
-        # Use the writerow method to write the dictionary to the CSV
-        await csv_writer.writerow(row)
-        return processed_text
+    corrected_text = await ask_llm(
+        client, GRAMMAR_PROMPT, text, line_number, total_lines, model_name
+    )
+    # Process the corrected text with spaCy
+    doc = nlp(corrected_text.strip())
+    processed_text = " ".join(token.text for token in doc)
+    logging.info(
+        f"{GREEN}Received correction for line {line_number}/{total_lines}: {processed_text}{RESET}"
+    )
+    # Create a dictionary for the CSV row
+    row = {
+        "Line Number": line_number,
+        "Original Sentence": text.strip(),
+        "Corrected Sentence": processed_text,
+    }
+    # Use the writerow method to write the dictionary to the CSV
+    await csv_writer.writerow(row)
+    return processed_text
 
 
 # Function to check which lines have already been processed
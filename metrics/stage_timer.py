@@ -0,0 +1,75 @@
+"""Wall-clock timings of pipeline stages, for benchmarks and run logs."""
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+
+def percentile(values: List[float], q: float) -> float:
+    # Linear interpolation between closest ranks, as numpy.percentile does
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (
+        position - lower
+    )
+
+
+class StageTimer:
+    """
+    Records how long each pass through a named stage took.
+
+    Stages of concurrent batches overlap, so a stage's total is the time
+    spent in it summed over batches, not its share of the run's wall time.
+
+    Usage:
+        with get_stage_timer().stage("quality_estimation"):
+            ...
+    """
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name].append(time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float) -> None:
+        self.durations[name].append(seconds)
+
+    def reset(self) -> None:
+        self.durations.clear()
+
+    def get_summary(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: {
+                "count": len(durations),
+                "total_seconds": sum(durations),
+                "mean_seconds": sum(durations) / len(durations),
+                "p50_seconds": percentile(durations, 50),
+                "p95_seconds": percentile(durations, 95),
+                "p99_seconds": percentile(durations, 99),
+                "max_seconds": max(durations),
+            }
+            for name, durations in self.durations.items()
+            if durations
+        }
+
+
+# One timer per process by default, shared by main.py and the in-process
+# GRECO workflow so a run's stages land in the same place
+stage_timers: Dict[str, StageTimer] = {}
+
+
+def get_stage_timer(name: str = "default") -> StageTimer:
+    if name not in stage_timers:
+        stage_timers[name] = StageTimer()
+    return stage_timers[name]
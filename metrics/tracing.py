@@ -0,0 +1,468 @@
+"""Structured spans over the pipeline stages, exported as JSONL and as
+Prometheus text metrics."""
+
+import argparse
+import contextvars
+import functools
+import json
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+# Write spans while running:
+#   get_tracer().export_to("logs/trace.jsonl")
+#   serve_metrics(get_tracer(), port=9464)  # then GET /metrics
+# Critical path of every batch in a trace file:
+# python3 -m metrics.tracing logs/trace_20240501_120000.jsonl
+# python3 -m metrics.tracing logs/trace_20240501_120000.jsonl --batch 3
+
+
+# Attributes a span takes from its parent unless it sets them itself, so a
+# GRECO stage knows which main.py batch it belongs to
+INHERITED_ATTRIBUTES = ["batch_number"]
+
+# Upper bounds in seconds of the span duration histogram buckets
+DURATION_BUCKETS = [
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+]
+
+METRICS_PREFIX = "gec"
+
+
+class Span:
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        attributes: Dict[str, Any],
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.status = "ok"
+        self.error: Optional[str] = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def add_usage(self, usage: Any) -> None:
+        """Adds the prompt/completion tokens of a `completion.usage`."""
+        if usage is None:
+            return
+        for key in ["prompt_tokens", "completion_tokens"]:
+            tokens = getattr(usage, key, None)
+            if tokens is None and isinstance(usage, dict):
+                tokens = usage.get(key)
+            if tokens is not None:
+                self.attributes[key] = self.attributes.get(key, 0) + tokens
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration_seconds": self.duration,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class Tracer:
+    """
+    Records nested spans and aggregates them into Prometheus metrics.
+
+    A span opened with no span around it starts a new trace, so every
+    main.py batch (or standalone GRECO workflow run) is one trace. Tasks
+    created by `asyncio.gather` copy the context, so spans opened in them
+    are children of the span that awaited the gather.
+
+    Usage:
+        with get_tracer().span("ask_llm", model=model_name) as span:
+            ...
+            span.add_usage(completion.usage)
+            span.set(retries=retries)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.output_file: Optional[Any] = None
+        self.duration_sums: Dict[Tuple[str, str], float] = defaultdict(float)
+        self.bucket_counts: Dict[Tuple[str, str], List[int]] = {}
+        self.errors: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.tokens: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.retries: Dict[str, int] = defaultdict(int)
+        self.gauges: Dict[Tuple[str, str], float] = {}
+
+    def export_to(self, output_path: str) -> None:
+        """Appends every finished span to `output_path` as a JSON line."""
+        with self.lock:
+            if self.output_file is not None:
+                self.output_file.close()
+            # Line buffered, so a trace is usable while the run goes on
+            self.output_file = open(
+                output_path, "a", buffering=1, encoding="utf-8"
+            )
+
+    def close(self) -> None:
+        with self.lock:
+            if self.output_file is not None:
+                self.output_file.close()
+                self.output_file = None
+
+    def start_span(
+        self, name: str, parent: Optional[Span] = None, **attributes: Any
+    ) -> Span:
+        """
+        Opens a span that is only ended by `end_span`, for work handed from
+        one task to another (e.g. a batch going through pipeline stages).
+        `parent` defaults to the current span.
+        """
+        if parent is None:
+            parent = current_span.get()
+        if parent is None:
+            trace_id = uuid.uuid4().hex
+            parent_id = None
+        else:
+            trace_id = parent.trace_id
+            parent_id = parent.span_id
+            for key in INHERITED_ATTRIBUTES:
+                if key in parent.attributes:
+                    attributes.setdefault(key, parent.attributes[key])
+        return Span(name, trace_id, parent_id, attributes)
+
+    def end_span(
+        self, span: Span, error: Optional[BaseException] = None
+    ) -> None:
+        if error is not None:
+            span.status = "error"
+            span.error = f"{type(error).__name__}: {error}"
+        span.duration = time.perf_counter() - span.start
+        self.finish(span)
+
+    @contextmanager
+    def span(
+        self, name: str, parent: Optional[Span] = None, **attributes: Any
+    ) -> Iterator[Span]:
+        span = self.start_span(name, parent, **attributes)
+        error: Optional[BaseException] = None
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            current_span.reset(token)
+            self.end_span(span, error)
+
+    @contextmanager
+    def use_span(self, span: Span) -> Iterator[Span]:
+        """Makes `span` the parent of the spans opened in the block."""
+        token = current_span.set(span)
+        try:
+            yield span
+        finally:
+            current_span.reset(token)
+
+    def trace(self, name: str) -> Callable:
+        """Decorator running every call of a coroutine function in a span."""
+
+        def decorator(function: Callable) -> Callable:
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return await function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def finish(self, span: Span) -> None:
+        model = str(span.attributes.get("model", ""))
+        key = (span.name, model)
+        with self.lock:
+            if key not in self.bucket_counts:
+                # Cumulative, the last bucket being +Inf (the span count)
+                self.bucket_counts[key] = [0] * (len(DURATION_BUCKETS) + 1)
+            self.duration_sums[key] += span.duration
+            for i, bound in enumerate(DURATION_BUCKETS + [float("inf")]):
+                if span.duration <= bound:
+                    self.bucket_counts[key][i] += 1
+            if span.status == "error":
+                self.errors[key] += 1
+            for kind in ["prompt", "completion"]:
+                tokens = span.attributes.get(f"{kind}_tokens")
+                if tokens:
+                    self.tokens[(model, kind)] += tokens
+            if span.attributes.get("retries"):
+                self.retries[model] += span.attributes["retries"]
+
+            if self.output_file is not None:
+                self.output_file.write(
+                    json.dumps(span.to_dict(), ensure_ascii=False) + "\n"
+                )
+
+    def set_gauge(self, name: str, value: float, **labels: Any) -> None:
+        """Sets a gauge exported as `gec_<name>{<labels>}`."""
+        label_text = ",".join(
+            f'{key}="{labels[key]}"' for key in sorted(labels)
+        )
+        with self.lock:
+            self.gauges[(name, label_text)] = value
+
+    def reset(self) -> None:
+        with self.lock:
+            self.duration_sums.clear()
+            self.bucket_counts.clear()
+            self.errors.clear()
+            self.tokens.clear()
+            self.retries.clear()
+            self.gauges.clear()
+
+    def render_prometheus(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        name = f"{METRICS_PREFIX}_span_duration_seconds"
+        lines = [
+            f"# HELP {name} Time spent in each span, by span name and model.",
+            f"# TYPE {name} histogram",
+        ]
+        with self.lock:
+            for key, counts in sorted(self.bucket_counts.items()):
+                labels = f'span="{key[0]}",model="{key[1]}"'
+                for bound, count in zip(DURATION_BUCKETS + ["+Inf"], counts):
+                    lines.append(
+                        f'{name}_bucket{{{labels},le="{bound}"}} {count}'
+                    )
+                lines.append(
+                    f"{name}_sum{{{labels}}} {self.duration_sums[key]}"
+                )
+                lines.append(f"{name}_count{{{labels}}} {counts[-1]}")
+
+            name = f"{METRICS_PREFIX}_span_errors_total"
+            lines.append(f"# HELP {name} Spans that ended with an exception.")
+            lines.append(f"# TYPE {name} counter")
+            for (span_name, model), count in sorted(self.errors.items()):
+                lines.append(
+                    f'{name}{{span="{span_name}",model="{model}"}} {count}'
+                )
+
+            name = f"{METRICS_PREFIX}_llm_tokens_total"
+            lines.append(f"# HELP {name} Tokens reported by the LLM APIs.")
+            lines.append(f"# TYPE {name} counter")
+            for (model, kind), count in sorted(self.tokens.items()):
+                labels = f'model="{model}",kind="{kind}"'
+                lines.append(f"{name}{{{labels}}} {count}")
+
+            name = f"{METRICS_PREFIX}_llm_retries_total"
+            lines.append(f"# HELP {name} LLM requests that were retried.")
+            lines.append(f"# TYPE {name} counter")
+            for model, count in sorted(self.retries.items()):
+                lines.append(f'{name}{{model="{model}"}} {count}')
+
+            name = None
+            for (gauge_name, labels), value in sorted(self.gauges.items()):
+                if name != f"{METRICS_PREFIX}_{gauge_name}":
+                    name = f"{METRICS_PREFIX}_{gauge_name}"
+                    lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name}{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# One tracer per process by default, shared by main.py and the in-process
+# GRECO workflow so a batch's spans land in the same trace
+tracers: Dict[str, Tracer] = {}
+
+
+def get_tracer(name: str = "default") -> Tracer:
+    if name not in tracers:
+        tracers[name] = Tracer()
+    return tracers[name]
+
+
+def serve_metrics(
+    tracer: Tracer, port: int, host: str = "127.0.0.1"
+) -> ThreadingHTTPServer:
+    """Serves `GET /metrics` from a daemon thread for Prometheus to scrape."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = tracer.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+            )
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes would otherwise flood stderr
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def read_spans(trace_path: str) -> Dict[str, List[Dict[str, Any]]]:
+    """Spans of a JSONL trace file, grouped by trace."""
+    traces: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    with open(trace_path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                span = json.loads(line)
+                traces[span["trace_id"]].append(span)
+    return traces
+
+
+def critical_path(
+    spans: List[Dict[str, Any]],
+) -> List[Tuple[int, Dict[str, Any]]]:
+    """
+    The spans that determined a trace's duration, with their depth.
+
+    Walking back from a span's end, the child that finished last is the one
+    its parent waited on (the slowest call of a gather, or the last stage);
+    before that child started, the same holds for the child that finished
+    last before it, and so on. Each child on the path is expanded the same
+    way.
+    """
+    children: Dict[Optional[str], List[Dict[str, Any]]] = defaultdict(list)
+    for span in spans:
+        children[span["parent_id"]].append(span)
+    span_ids = {span["span_id"] for span in spans}
+    # A span whose parent is in another file (e.g. a GRECO worker process)
+    # is treated as a root
+    roots = [
+        span
+        for span in spans
+        if span["parent_id"] is None or span["parent_id"] not in span_ids
+    ]
+    if not roots:
+        return []
+
+    def end(span):
+        return span["start_time"] + span["duration_seconds"]
+
+    def expand(span, depth):
+        path = [(depth, span)]
+        chain = []
+        cursor = end(span)
+        for child in sorted(children[span["span_id"]], key=end, reverse=True):
+            if end(child) <= cursor:
+                chain.append(child)
+                cursor = child["start_time"]
+        for child in reversed(chain):
+            path.extend(expand(child, depth + 1))
+        return path
+
+    return expand(max(roots, key=end), 0)
+
+
+def print_critical_path(spans: List[Dict[str, Any]]) -> None:
+    path = critical_path(spans)
+    if not path:
+        return
+    root = path[0][1]
+    batch_number = root["attributes"].get("batch_number", "-")
+    print(
+        f"Trace {root['trace_id'][:8]} (batch {batch_number}): "
+        f"{root['duration_seconds']:.3f}s, {len(spans)} spans"
+    )
+    for depth, span in path:
+        attributes = span["attributes"]
+        details = " ".join(
+            f"{key}={attributes[key]}"
+            for key in [
+                "model",
+                "retries",
+                "prompt_tokens",
+                "completion_tokens",
+            ]
+            if key in attributes
+        )
+        offset = span["start_time"] - root["start_time"]
+        print(
+            f"  {'  ' * depth}{span['name']:<{32 - 2 * depth}} "
+            f"+{offset:>8.3f}s {span['duration_seconds']:>8.3f}s "
+            f"{span['status']} {details}".rstrip()
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Print the critical path of every batch in a trace file."
+    )
+    parser.add_argument("trace", help="A JSONL trace written by a Tracer.")
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=None,
+        help="Only the traces of this batch number.",
+    )
+    parser.add_argument(
+        "--slowest",
+        type=int,
+        default=None,
+        help="Only the N slowest traces.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    traces = []
+    for spans in read_spans(args.trace).values():
+        path = critical_path(spans)
+        if not path:
+            continue
+        root = path[0][1]
+        if (
+            args.batch is not None
+            and root["attributes"].get("batch_number") != args.batch
+        ):
+            continue
+        traces.append((root["duration_seconds"], spans))
+
+    traces.sort(key=lambda trace: -trace[0])
+    if args.slowest is not None:
+        traces = traces[: args.slowest]
+    for _, spans in traces:
+        print_critical_path(spans)
@@ -0,0 +1,271 @@
+"""Token usage and cost of LLM calls per model, stage, batch and run."""
+
+import argparse
+import datetime
+import json
+import os
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from limiters.rate_limiter import count_prompt_tokens
+from splitters.token_counter import get_token_counter
+
+
+# Summarise the runs recorded in a usage file:
+# python3 -m metrics.usage corrected_output/ABCN.dev.gold.bea19.usage.json
+
+
+# USD per million (prompt, completion) tokens, as listed by the providers;
+# models not listed are reported with tokens only. Update when prices change.
+PRICES_PER_MILLION_TOKENS: Dict[str, Tuple[float, float]] = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-3.5-turbo-1106": (1.0, 2.0),
+    "gpt-4-1106-preview": (10.0, 30.0),
+    "togethercomputer/Llama-2-7B-32K-Instruct": (0.2, 0.2),
+    "mistralai/Mixtral-8x7B-Instruct-v0.1": (0.6, 0.6),
+    "gemma-7b-it": (0.07, 0.07),
+    "llama2-70b-4096": (0.7, 0.8),
+    "mixtral-8x7b-32768": (0.24, 0.24),
+    # Served locally
+    "llama-2-7b-chat.Q8_0.gguf": (0.0, 0.0),
+}
+
+# Counters kept for every model, stage and batch
+USAGE_FIELDS = [
+    "calls",
+    "cached_calls",
+    # Calls whose tokens were counted here because the API reported none
+    "estimated_calls",
+    "prompt_tokens",
+    "completion_tokens",
+    # Requests sent to complete a truncated JSON response, which re-send the
+    # whole conversation so far
+    "continuation_calls",
+    "continuation_prompt_tokens",
+    "continuation_completion_tokens",
+    # Completion tokens thrown away: trimmed partial JSON and responses that
+    # failed to parse or validate
+    "discarded_completion_tokens",
+]
+
+
+def get_usage_value(usage: Any, key: str) -> Optional[int]:
+    value = getattr(usage, key, None)
+    if value is None and isinstance(usage, dict):
+        value = usage.get(key)
+    return value
+
+
+def get_cost(
+    model_name: str, prompt_tokens: int, completion_tokens: int
+) -> Optional[float]:
+    if model_name not in PRICES_PER_MILLION_TOKENS:
+        return None
+    prompt_price, completion_price = PRICES_PER_MILLION_TOKENS[model_name]
+    return (
+        prompt_tokens * prompt_price + completion_tokens * completion_price
+    ) / 1_000_000
+
+
+class UsageTracker:
+    """
+    Aggregates the usage of every LLM call by model, stage and batch.
+
+    Calls served from the response cache are counted but cost nothing. When
+    a response has no `usage` (GRECO/Coze bots, some local servers), its
+    tokens are counted with the model's tokenizer instead.
+
+    Usage:
+        usage_tracker.record(
+            model_name, "quality_estimation", batch_number, model_params,
+            response, completion.usage,
+        )
+    """
+
+    def __init__(self):
+        self.run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.started_at = datetime.datetime.now().isoformat()
+        self.usage: Dict[Tuple[str, str, Any], Dict[str, int]] = defaultdict(
+            lambda: dict.fromkeys(USAGE_FIELDS, 0)
+        )
+
+    def record(
+        self,
+        model_name: str,
+        stage: str,
+        batch_number: Any,
+        model_params: Dict[str, Any],
+        response: str,
+        usage: Any = None,
+        continuation: bool = False,
+        cached: bool = False,
+    ) -> None:
+        counts = self.usage[(model_name, stage, batch_number)]
+        if cached:
+            counts["cached_calls"] += 1
+            return
+
+        prompt_tokens = get_usage_value(usage, "prompt_tokens")
+        completion_tokens = get_usage_value(usage, "completion_tokens")
+        if prompt_tokens is None or completion_tokens is None:
+            token_counter = get_token_counter(model_name)
+            prompt_tokens = count_prompt_tokens(
+                model_params, token_counter.count
+            )
+            completion_tokens = token_counter.count(response or "")
+            counts["estimated_calls"] += 1
+
+        counts["calls"] += 1
+        counts["prompt_tokens"] += prompt_tokens
+        counts["completion_tokens"] += completion_tokens
+        if continuation:
+            counts["continuation_calls"] += 1
+            counts["continuation_prompt_tokens"] += prompt_tokens
+            counts["continuation_completion_tokens"] += completion_tokens
+
+    def record_discarded(
+        self, model_name: str, stage: str, batch_number: Any, text: str
+    ) -> None:
+        if not text:
+            return
+        self.usage[(model_name, stage, batch_number)][
+            "discarded_completion_tokens"
+        ] += get_token_counter(model_name).count(text)
+
+    def reset(self) -> None:
+        self.usage.clear()
+
+    def get_totals(
+        self, group_by: Optional[int] = None
+    ) -> Dict[Any, Dict[str, Any]]:
+        """
+        Sums the counters over every key, or per model (group_by=0), stage
+        (1) or batch (2). The cost sums the models that have a price (None
+        if none has); models without one are listed in `unpriced_models`.
+        """
+        totals: Dict[Any, Dict[str, Any]] = {}
+        costs: Dict[Any, Optional[float]] = {}
+        unpriced_models: Dict[Any, Set[str]] = {}
+        for key, counts in self.usage.items():
+            group = "run" if group_by is None else key[group_by]
+            if group not in totals:
+                totals[group] = dict.fromkeys(USAGE_FIELDS, 0)
+                costs[group] = None
+                unpriced_models[group] = set()
+            for field in USAGE_FIELDS:
+                totals[group][field] += counts[field]
+
+            cost = get_cost(
+                key[0], counts["prompt_tokens"], counts["completion_tokens"]
+            )
+            if cost is not None:
+                costs[group] = (costs[group] or 0.0) + cost
+            elif counts["prompt_tokens"] or counts["completion_tokens"]:
+                unpriced_models[group].add(key[0])
+
+        for group, group_totals in totals.items():
+            group_totals["cost_usd"] = costs[group]
+            group_totals["unpriced_models"] = sorted(unpriced_models[group])
+        return totals
+
+    def get_summary(self) -> Dict[str, Any]:
+        return {
+            "run_id": self.run_id,
+            "started_at": self.started_at,
+            "run": self.get_totals().get(
+                "run",
+                {
+                    **dict.fromkeys(USAGE_FIELDS, 0),
+                    "cost_usd": 0.0,
+                    "unpriced_models": [],
+                },
+            ),
+            "models": self.get_totals(group_by=0),
+            "stages": self.get_totals(group_by=1),
+            # JSON keys are strings; batches are sorted by number, with
+            # calls made outside a main.py batch (None) last
+            "batches": {
+                str(batch_number): totals
+                for batch_number, totals in sorted(
+                    self.get_totals(group_by=2).items(),
+                    key=lambda item: (item[0] is None, item[0] or 0),
+                )
+            },
+        }
+
+    def write_summary(self, output_path: str) -> None:
+        """
+        Adds this run's summary to `output_path`, keeping earlier runs, so a
+        resumed corpus keeps the usage of every run that worked on it.
+        """
+        runs: List[Dict[str, Any]] = []
+        if os.path.exists(output_path):
+            with open(output_path, encoding="utf-8") as f:
+                runs = json.load(f).get("runs", [])
+        runs = [run for run in runs if run.get("run_id") != self.run_id]
+        runs.append(self.get_summary())
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump({"runs": runs}, f, indent=2)
+
+
+# One tracker per process by default, shared by main.py and the in-process
+# GRECO workflow so a run's usage lands in one summary
+usage_trackers: Dict[str, UsageTracker] = {}
+
+
+def get_usage_tracker(name: str = "default") -> UsageTracker:
+    if name not in usage_trackers:
+        usage_trackers[name] = UsageTracker()
+    return usage_trackers[name]
+
+
+def print_usage(runs: List[Dict[str, Any]]) -> None:
+    def format_cost(totals: Dict[str, Any]) -> str:
+        if totals["cost_usd"] is None:
+            return "-"
+        cost = f"${totals['cost_usd']:.4f}"
+        # Summaries written before unpriced models were listed have none
+        unpriced_models = totals.get("unpriced_models", [])
+        if unpriced_models:
+            cost += f" (+{', '.join(unpriced_models)} unpriced)"
+        return cost
+
+    header = ["", "Calls", "Cached", "Prompt", "Completion", "Wasted", "Cost"]
+    print("\t".join(header))
+
+    def print_row(name: str, totals: Dict[str, Any]) -> None:
+        wasted = (
+            totals["continuation_prompt_tokens"]
+            + totals["discarded_completion_tokens"]
+        )
+        row = [
+            name,
+            totals["calls"],
+            totals["cached_calls"],
+            totals["prompt_tokens"],
+            totals["completion_tokens"],
+            wasted,
+            format_cost(totals),
+        ]
+        print("\t".join(map(str, row)))
+
+    for run in runs:
+        print_row(f"run {run['run_id']}", run["run"])
+        for group in ["models", "stages"]:
+            for name, totals in run[group].items():
+                print_row(f"  {name}", totals)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Print the token usage and cost recorded in a usage "
+        "file."
+    )
+    parser.add_argument("usage", help="A usage JSON written by main.py.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with open(args.usage, encoding="utf-8") as f:
+        print_usage(json.load(f)["runs"])
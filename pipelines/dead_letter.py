@@ -0,0 +1,94 @@
+"""Batches that ran out of retries, kept to be re-driven later."""
+
+import datetime
+import json
+import os
+from typing import Any, Dict, Optional
+
+
+class LLMCallError(Exception):
+    """
+    An LLM call that failed, with the raw response it got (if any), so the
+    dead-letter entry shows what the model actually answered.
+    """
+
+    def __init__(self, error: BaseException, raw_response: str = ""):
+        super().__init__(f"{type(error).__name__}: {error}")
+        self.error = error
+        self.raw_response = raw_response
+
+
+class DeadLetterQueue:
+    """
+    An append-only JSONL file with one entry per failed batch.
+
+    The run goes on without the batch; re-driving reads the entries back
+    (the latest entry of a batch wins) and, once it is done, keeps only the
+    batches that failed again.
+
+    Usage:
+        dead_letters = DeadLetterQueue(path, run_id)
+        dead_letters.add(batch_number, text, attempts, error, raw_response)
+        ...
+        for entry in dead_letters.read().values():
+            ...
+        dead_letters.keep_run(run_id)
+    """
+
+    def __init__(self, path: str, run_id: Optional[str] = None):
+        self.path = path
+        self.run_id = run_id or datetime.datetime.now().strftime(
+            "%Y%m%d_%H%M%S"
+        )
+        self.added = 0
+
+    def add(
+        self,
+        batch_number: int,
+        text: str,
+        attempts: int,
+        error: BaseException,
+        raw_response: str = "",
+    ) -> None:
+        entry = {
+            "batch_number": batch_number,
+            "text": text,
+            "attempts": attempts,
+            "error": f"{type(error).__name__}: {error}",
+            "raw_response": raw_response,
+            "failed_at": datetime.datetime.now().isoformat(),
+            "run_id": self.run_id,
+        }
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # One line per write, so an interrupted run keeps every entry
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.added += 1
+
+    def read(self) -> Dict[int, Dict[str, Any]]:
+        entries: Dict[int, Dict[str, Any]] = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries[entry["batch_number"]] = entry
+        return dict(sorted(entries.items()))
+
+    def keep_run(self, run_id: str) -> None:
+        """Drops every batch whose latest entry is not from `run_id`."""
+        entries = [
+            entry
+            for entry in self.read().values()
+            if entry["run_id"] == run_id
+        ]
+        if not entries:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.path)
@@ -0,0 +1,92 @@
+"""Writes the output files in batch order while batches finish out of order."""
+
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import aiofiles
+
+
+class OrderedOutputWriter:
+    """
+    Appends the lines of every batch to the corrected and augmented-pool
+    files as soon as all earlier batches are written.
+
+    A batch that finishes before an earlier one waits in a buffer keyed by
+    batch number, so the buffer only holds the batches finished past the
+    oldest one still running, and the files always hold a complete prefix
+    of the run that can be read or evaluated while the run goes on.
+
+    Usage:
+        async with OrderedOutputWriter(output_path, pool_path) as writer:
+            for batch_number, text, pool_text in journal.iter_completed():
+                await writer.add(batch_number, text, pool_text)
+            ...
+            await writer.add(batch_number, text, pool_text)
+    """
+
+    def __init__(
+        self,
+        output_path: str,
+        augmented_pool_output_path: str,
+        first_batch: int = 1,
+    ):
+        self.output_path = output_path
+        self.augmented_pool_output_path = augmented_pool_output_path
+        self.next_batch = first_batch
+        self.pending: Dict[int, Tuple[str, str]] = {}
+        self.max_pending = 0
+        self.output_file: Optional[Any] = None
+        self.augmented_pool_output_file: Optional[Any] = None
+
+    async def __aenter__(self) -> "OrderedOutputWriter":
+        # Written from the first batch on, so a resumed run replays the
+        # batches it already has before the new ones
+        self.output_file = await aiofiles.open(
+            self.output_path, mode="w", newline="", encoding="utf-8"
+        )
+        self.augmented_pool_output_file = await aiofiles.open(
+            self.augmented_pool_output_path,
+            mode="w",
+            newline="",
+            encoding="utf-8",
+        )
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        if self.pending:
+            logging.warning(
+                f"Batches {sorted(self.pending)} were not written to {self.output_path}: batch {self.next_batch} never finished"
+            )
+        await self.output_file.close()
+        await self.augmented_pool_output_file.close()
+
+    async def add(
+        self,
+        batch_number: int,
+        corrected_text: str,
+        augmented_pool_text: str,
+    ) -> None:
+        if batch_number < self.next_batch:
+            # Already written; a batch is only written once per file
+            return
+        self.pending[batch_number] = (corrected_text, augmented_pool_text)
+        self.max_pending = max(self.max_pending, len(self.pending))
+        if self.next_batch not in self.pending:
+            return
+
+        while self.next_batch in self.pending:
+            corrected_text, augmented_pool_text = self.pending.pop(
+                self.next_batch
+            )
+            await self.output_file.write(
+                "".join(line + "\n" for line in corrected_text.split("\n"))
+            )
+            await self.augmented_pool_output_file.write(
+                "".join(
+                    line + "\n" for line in augmented_pool_text.split("\n")
+                )
+            )
+            self.next_batch += 1
+        # Readers of the files see every batch written so far
+        await self.output_file.flush()
+        await self.augmented_pool_output_file.flush()
@@ -0,0 +1,163 @@
+"""Per-batch state of a main.py run, kept in SQLite for resume and output."""
+
+import csv
+import os
+import sqlite3
+import time
+from typing import Dict, Iterator, Optional, Tuple
+
+
+# "dead_lettered" batches ran out of retries and hold their original text
+# until they are re-driven
+COMPLETED_STATUSES = ("done", "dead_lettered")
+
+
+class RunJournal:
+    """
+    One row per batch, keyed by batch number: status, attempts, the
+    corrected and augmented-pool text, and when the batch started and
+    finished.
+
+    Resuming looks each batch up by its key instead of re-reading the whole
+    output CSV, and the output files are written from one scan in batch
+    order instead of sorting every row. Writing a batch again (e.g. when a
+    dead-lettered batch is re-driven) replaces its row.
+
+    Usage:
+        journal = RunJournal("corrected_output/ABCN.journal.sqlite3", run_id)
+        if not journal.is_completed(batch_number):
+            ...
+            journal.record(batch_number, "done", attempts, text, pool_text)
+        for batch_number, text, pool_text in journal.iter_completed():
+            ...
+    """
+
+    def __init__(self, path: str, run_id: Optional[str] = None):
+        self.path = path
+        self.run_id = run_id
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30)
+        # Readers (e.g. a look at a run in progress) never block the writer,
+        # and a commit per batch does not wait for an fsync
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS batches (
+                batch_number INTEGER PRIMARY KEY,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                corrected_text TEXT,
+                augmented_pool_text TEXT,
+                error TEXT,
+                started_at REAL,
+                finished_at REAL,
+                run_id TEXT
+            )"""
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def is_empty(self) -> bool:
+        return (
+            self.connection.execute("SELECT 1 FROM batches LIMIT 1").fetchone()
+            is None
+        )
+
+    def is_completed(self, batch_number: int) -> bool:
+        row = self.connection.execute(
+            "SELECT status FROM batches WHERE batch_number = ?",
+            (batch_number,),
+        ).fetchone()
+        return row is not None and row[0] in COMPLETED_STATUSES
+
+    def record(
+        self,
+        batch_number: int,
+        status: str,
+        attempts: int,
+        corrected_text: str,
+        augmented_pool_text: str,
+        started_at: Optional[float] = None,
+        error: Optional[str] = None,
+    ) -> None:
+        self.connection.execute(
+            """INSERT INTO batches
+                (batch_number, status, attempts, corrected_text,
+                 augmented_pool_text, error, started_at, finished_at, run_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (batch_number) DO UPDATE SET
+                status = excluded.status,
+                attempts = excluded.attempts,
+                corrected_text = excluded.corrected_text,
+                augmented_pool_text = excluded.augmented_pool_text,
+                error = excluded.error,
+                started_at = excluded.started_at,
+                finished_at = excluded.finished_at,
+                run_id = excluded.run_id""",
+            (
+                batch_number,
+                status,
+                attempts,
+                corrected_text,
+                augmented_pool_text,
+                error,
+                started_at,
+                time.time(),
+                self.run_id,
+            ),
+        )
+        self.connection.commit()
+
+    def iter_completed(self) -> Iterator[Tuple[int, str, str]]:
+        """Completed batches in batch order, read as they are written out."""
+        yield from self.connection.execute(
+            "SELECT batch_number, corrected_text, augmented_pool_text "
+            "FROM batches WHERE status IN (?, ?) ORDER BY batch_number",
+            COMPLETED_STATUSES,
+        )
+
+    def get_status_counts(self) -> Dict[str, int]:
+        return dict(
+            self.connection.execute(
+                "SELECT status, COUNT(*) FROM batches GROUP BY status"
+            )
+        )
+
+    def import_csv(self, csv_path: str) -> int:
+        """
+        Takes over the rows of an output CSV written before the journal
+        existed, so such a run can still be resumed. The last row of a batch
+        wins, as it did when the output files were built from the CSV.
+        """
+        imported = 0
+        with open(csv_path, newline="", encoding="utf-8") as csv_file:
+            for row in csv.DictReader(csv_file):
+                try:
+                    batch_number = int(row["Batch Number"])
+                except (ValueError, KeyError, TypeError):
+                    # Skip rows with invalid or missing "Batch Number"
+                    continue
+                self.connection.execute(
+                    """INSERT OR REPLACE INTO batches
+                        (batch_number, status, corrected_text,
+                         augmented_pool_text, run_id)
+                        VALUES (?, 'done', ?, ?, ?)""",
+                    (
+                        batch_number,
+                        row.get("Corrected Text") or "",
+                        row.get("Augmented Pool Text") or "",
+                        self.run_id,
+                    ),
+                )
+                imported += 1
+        self.connection.commit()
+        return imported
+
+
+def remove_journal(path: str) -> None:
+    # WAL mode keeps two more files beside the database
+    for file_path in [path, f"{path}-wal", f"{path}-shm"]:
+        if os.path.exists(file_path):
+            os.remove(file_path)
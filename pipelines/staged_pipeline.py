@@ -0,0 +1,220 @@
+"""Bounded producer/consumer pipeline of async stages."""
+
+import asyncio
+import logging
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+)
+
+from metrics.tracing import Tracer
+
+
+# Batches corrected by 8 LLM workers, then tokenised and written one at a
+# time, with at most 16 batches waiting in front of each stage:
+#   pipeline = StagedPipeline("batches", tracer=get_tracer())
+#   pipeline.add_stage("llm", correct_batch, workers=8, queue_size=16)
+#   pipeline.add_stage("postprocessing", tokenise_batch, queue_size=16)
+#   pipeline.add_stage("write", write_batch, queue_size=16)
+#   await pipeline.run(batches)
+
+
+class RetryLater(Exception):
+    """
+    Raised by a handler to have its item handled again after `delay`
+    seconds, without keeping a worker busy in the meantime.
+    """
+
+    def __init__(self, delay: float):
+        super().__init__(f"Retrying in {delay:.1f}s")
+        self.delay = delay
+
+
+class Stage:
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Any], Awaitable[Any]],
+        workers: int,
+        queue_size: int,
+    ):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        # Created by `run`, inside the event loop that uses it
+        self.queue: Optional[asyncio.Queue] = None
+        self.busy_workers = 0
+        self.waiting_retries = 0
+        self.processed = 0
+        self.retried = 0
+        self.max_queue_depth = 0
+
+
+class StagedPipeline:
+    """
+    Passes items through stages joined by bounded queues.
+
+    Each stage has its own workers, which take items from the stage's queue
+    and put what the handler returns on the next stage's queue (None drops
+    the item). A full queue blocks the stage in front of it, so however
+    many items the producer has, only the queued items and those being
+    handled are in memory, and a slow stage slows the producer instead of
+    piling up work.
+
+    A handler raising `RetryLater` frees its worker at once; the item waits
+    out the delay outside the queue and is then queued again, so healthy
+    items keep flowing past one that is backing off.
+
+    The queue depth, busy workers and items waiting to retry of every stage
+    are kept as tracer gauges (`gec_pipeline_queue_depth`,
+    `gec_pipeline_busy_workers`, `gec_pipeline_waiting_retries`) and logged
+    every `monitor_interval` seconds. Any other exception in a handler
+    cancels the whole pipeline and is raised by `run`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        tracer: Optional[Tracer] = None,
+        monitor_interval: Optional[float] = None,
+    ):
+        self.name = name
+        self.tracer = tracer
+        self.monitor_interval = monitor_interval
+        self.stages: List[Stage] = []
+        self.retry_tasks: Set[asyncio.Task] = set()
+
+    def add_stage(
+        self,
+        name: str,
+        handler: Callable[[Any], Awaitable[Any]],
+        workers: int = 1,
+        queue_size: int = 1,
+    ) -> None:
+        self.stages.append(Stage(name, handler, workers, queue_size))
+
+    async def run(self, items: Iterable[Any]) -> None:
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(maxsize=stage.queue_size)
+            stage.busy_workers = 0
+            stage.waiting_retries = 0
+            stage.processed = 0
+            stage.retried = 0
+            stage.max_queue_depth = 0
+
+        tasks = [asyncio.create_task(self.produce(items))]
+        for index, stage in enumerate(self.stages):
+            next_stage = (
+                self.stages[index + 1]
+                if index + 1 < len(self.stages)
+                else None
+            )
+            for _ in range(stage.workers):
+                tasks.append(asyncio.create_task(self.work(stage, next_stage)))
+        if self.monitor_interval:
+            tasks.append(asyncio.create_task(self.monitor()))
+
+        try:
+            # The producer returns once every stage is drained; workers and
+            # the monitor only return by raising, which ends the run early
+            done, _ = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                task.result()
+        finally:
+            retry_tasks = list(self.retry_tasks)
+            for task in tasks + retry_tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, *retry_tasks, return_exceptions=True)
+            logging.info(f"Pipeline {self.name}: {self.get_stats()}")
+
+    async def produce(self, items: Iterable[Any]) -> None:
+        for item in items:
+            await self.put(self.stages[0], item)
+        # An item is only marked done once the next stage has it, or once a
+        # retry has queued it again, so the stages drain in order
+        for stage in self.stages:
+            await stage.queue.join()
+
+    async def work(self, stage: Stage, next_stage: Optional[Stage]) -> None:
+        while True:
+            item = await stage.queue.get()
+            stage.busy_workers += 1
+            self.update_gauges(stage)
+            try:
+                result = await stage.handler(item)
+            except RetryLater as e:
+                stage.retried += 1
+                self.retry_later(stage, item, e.delay)
+                continue
+            finally:
+                stage.busy_workers -= 1
+                self.update_gauges(stage)
+            stage.processed += 1
+
+            if next_stage is not None and result is not None:
+                await self.put(next_stage, result)
+            stage.queue.task_done()
+
+    def retry_later(self, stage: Stage, item: Any, delay: float) -> None:
+        async def requeue():
+            await asyncio.sleep(delay)
+            await self.put(stage, item)
+            stage.waiting_retries -= 1
+            stage.queue.task_done()
+            self.update_gauges(stage)
+
+        stage.waiting_retries += 1
+        self.update_gauges(stage)
+        task = asyncio.create_task(requeue())
+        self.retry_tasks.add(task)
+        task.add_done_callback(self.retry_tasks.discard)
+
+    async def put(self, stage: Stage, item: Any) -> None:
+        await stage.queue.put(item)
+        self.update_gauges(stage)
+
+    def update_gauges(self, stage: Stage) -> None:
+        depth = stage.queue.qsize()
+        stage.max_queue_depth = max(stage.max_queue_depth, depth)
+        if self.tracer is None:
+            return
+        for name, value in [
+            ("pipeline_queue_depth", depth),
+            ("pipeline_busy_workers", stage.busy_workers),
+            ("pipeline_waiting_retries", stage.waiting_retries),
+        ]:
+            self.tracer.set_gauge(
+                name, value, pipeline=self.name, stage=stage.name
+            )
+
+    async def monitor(self) -> None:
+        while True:
+            await asyncio.sleep(self.monitor_interval)
+            depths = ", ".join(
+                f"{stage.name} {stage.queue.qsize()} queued/"
+                f"{stage.busy_workers} of {stage.workers} busy/"
+                f"{stage.waiting_retries} waiting to retry/"
+                f"{stage.processed} done"
+                for stage in self.stages
+            )
+            logging.info(f"Pipeline {self.name}: {depths}")
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            stage.name: {
+                "workers": stage.workers,
+                "processed": stage.processed,
+                "retried": stage.retried,
+                "max_queue_depth": stage.max_queue_depth,
+            }
+            for stage in self.stages
+        }
@@ -0,0 +1,81 @@
+"""Cached, batched token counting with one tiktoken encoder per model family."""
+
+from typing import Dict, List
+
+import tiktoken
+
+
+# Used for models tiktoken doesn't know (local/Together/Groq/GRECO), which
+# keeps their batching the same as before
+DEFAULT_ENCODING = "gpt2"
+
+# Prefix fallbacks for deployment names tiktoken can't resolve on its own,
+# e.g. Azure deployments or dated snapshots
+MODEL_PREFIX_ENCODINGS = {
+    "gpt-4o": "o200k_base",
+    "gpt-4": "cl100k_base",
+    "gpt-35": "cl100k_base",
+    "gpt-3.5": "cl100k_base",
+}
+
+# Upper bound on memoised line counts per encoder
+MAX_CACHED_COUNTS = 200_000
+
+
+def get_encoding_name(model_name: str) -> str:
+    try:
+        return tiktoken.encoding_name_for_model(model_name)
+    except KeyError:
+        pass
+    for prefix, encoding_name in MODEL_PREFIX_ENCODINGS.items():
+        if model_name.startswith(prefix):
+            return encoding_name
+    return DEFAULT_ENCODING
+
+
+class TokenCounter:
+    """
+    Counts tokens with a single loaded encoder, memoising counts per string.
+
+    `count_batch` encodes all uncached strings in one `encode_ordinary_batch`
+    call (which tiktoken runs on a thread pool), so counting every line of a
+    corpus costs one call instead of one encoder lookup and encode per line.
+    """
+
+    def __init__(self, encoding_name: str):
+        self.encoding_name = encoding_name
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self.counts: Dict[str, int] = {}
+
+    def remember(self, text: str, token_count: int) -> None:
+        if len(self.counts) >= MAX_CACHED_COUNTS:
+            self.counts.clear()
+        self.counts[text] = token_count
+
+    def count(self, text: str) -> int:
+        token_count = self.counts.get(text)
+        if token_count is None:
+            token_count = len(self.encoding.encode_ordinary(text))
+            self.remember(text, token_count)
+        return token_count
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        missing = list(
+            dict.fromkeys(text for text in texts if text not in self.counts)
+        )
+        if missing:
+            encoded = self.encoding.encode_ordinary_batch(missing)
+            for text, tokens in zip(missing, encoded):
+                self.remember(text, len(tokens))
+        return [self.count(text) for text in texts]
+
+
+# One counter per encoding, shared by every model that uses it
+token_counters: Dict[str, TokenCounter] = {}
+
+
+def get_token_counter(model_name: str) -> TokenCounter:
+    encoding_name = get_encoding_name(model_name)
+    if encoding_name not in token_counters:
+        token_counters[encoding_name] = TokenCounter(encoding_name)
+    return token_counters[encoding_name]
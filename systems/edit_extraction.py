@@ -0,0 +1,83 @@
+"""Batched ERRANT edit extraction shared across models and candidate pools."""
+
+import itertools
+from typing import Any, Dict, Iterable, List, Tuple
+
+from caches.doc_cache import DocCache
+
+
+class EditExtractor:
+    """
+    Extracts ERRANT edits for many (original, corrected) sentence pairs.
+
+    Sentences are parsed through the shared DocCache (one `nlp.pipe` call
+    for everything not parsed before) and every distinct pair is annotated
+    once, so an original sentence shared by all models, or a correction
+    shared by the base and augmented pools, costs a single parse and a
+    single `annotator.annotate`.
+
+    One extractor is meant to live for one workflow run; its memo grows with
+    the number of distinct pairs it has seen.
+    """
+
+    def __init__(self, doc_cache: DocCache, annotator: Any):
+        self.doc_cache = doc_cache
+        self.annotator = annotator
+        self.docs: Dict[str, Any] = {}
+        self.edits: Dict[Tuple[str, str], List[str]] = {}
+
+    def parse(self, sentences: Iterable[str]) -> None:
+        missing = list(
+            dict.fromkeys(
+                sentence for sentence in sentences if sentence not in self.docs
+            )
+        )
+        if not missing:
+            return
+        docs = self.doc_cache.get_docs(missing)
+        for sentence, doc in zip(missing, docs):
+            self.docs[sentence] = doc
+
+    def annotate(
+        self, original_sentence: str, corrected_sentence: str
+    ) -> List[str]:
+        key = (original_sentence, corrected_sentence)
+        if key not in self.edits:
+            self.parse(key)
+            edits = self.annotator.annotate(
+                self.docs[original_sentence], self.docs[corrected_sentence]
+            )
+            # Convert edits to M2 format
+            self.edits[key] = [edit.to_m2() for edit in edits]
+        return self.edits[key]
+
+    def extract_edits(
+        self,
+        aggregated_responses: Dict[str, List[str]],
+        input_sentences: List[str],
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        :param aggregated_responses: Dictionary with model IDs as keys and lists of corrected sentences as values.
+        :param input_sentences: List of original sentences.
+        :return: Dictionary with model IDs as keys and lists of edits for each sentence as values.
+        """
+        # Parse every sentence up front so nlp.pipe sees the whole batch
+        self.parse(
+            itertools.chain(input_sentences, *aggregated_responses.values())
+        )
+
+        edits_output = {}
+        for model_id, corrected_sentences in aggregated_responses.items():
+            edits_output[model_id] = [
+                {
+                    "original_sentence": original_sentence,
+                    "corrected_sentence": corrected_sentence,
+                    "edits": self.annotate(
+                        original_sentence, corrected_sentence
+                    ),
+                }
+                for original_sentence, corrected_sentence in zip(
+                    input_sentences, corrected_sentences
+                )
+            ]
+        return edits_output
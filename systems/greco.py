@@ -16,6 +16,17 @@ import subprocess
 import groq
 from clients.greco import AsyncGreco
 from clients.mock_gec_system import AsyncMockGECSystem
+from clients.replay_client import AsyncReplayClient
+from systems.greco_rpc import read_frame, write_frame
+from limiters.concurrency_controller import get_concurrency_controller
+from caches.response_cache import ResponseCache
+from caches.doc_cache import get_doc_cache
+from systems.edit_extraction import EditExtractor
+from systems.incremental_json import IncrementalJSONParser
+from metrics.stage_timer import get_stage_timer
+from metrics.tracing import get_tracer, serve_metrics
+from metrics.usage import get_usage_tracker
+from pipelines.dead_letter import LLMCallError
 import spacy
 import errant
 import argparse
@@ -25,6 +36,8 @@ from typing import Any, List, Optional, Callable
 
 
 # python3 -m systems.greco $'This first sentence is.\nSecond is sentence.\nThird the is sentence.' --quiet
+# python3 -m systems.greco --worker --quiet
+# python3 -m systems.greco --worker --socket /tmp/greco.sock
 # python3 -m systems.greco $'This first sentence is.\nSecond is sentence.\nThird the is sentence.'
 # python3 -m systems.greco $'It \'s difficult answer at the question \" what are you going to do in the future ? \" if the only one who has to know it is in two minds .\nWhen I was younger I used to say that I wanted to be a teacher , a saleswoman and even a butcher .. I do n\'t know why .\nI would like to study Psychology because one day I would open my own psychology office and help people .\nIt \'s difficult because I \'ll have to study hard and a lot , but I think that if you like a subject , you \'ll study it easier .\nMaybe I \'ll change my mind , maybe not .\nI think that the public transport will always be in the future .\nThe rich people will buy a car but the poor people always need to use a bus or taxi .\nI consider that is more convenient to drive a car because you carry on more things in your own car than travelling by car .\nAlso , you \'ll meet friendly people who usually ask to you something to be friends and change your telephone number .\nIn my experience when I did n\'t have a car I used to use the bus to go to the school and go back to my house .\nIn my opinion , the car is n\'t necessary when you have crashed in the street , in that moment you realized the importance of a public transport .\nIn India we have various types of Public transport , like Cycle , Bike , Car , Train & Flight .\nDepending on the distance and duration to the desired place , mode of transport is chosen accordingly .\nBut Generally speaking , travelling by car is much more fun when compared with other modes of transport .\nThis reminds me of a trip that I have recently been to and the place is Agra .\nIt takes around 6 hours by National highway to go from Delhi to Agra .\nWe have stopped at hotels for having food and just in case if any of us feels hungry , we have purchased some snacks just before the trip .\nSince , we have the option to wait anytime we want to when we travel by car ( which is impossible when travelling by train & Flight ) .\nIn addition to it , we can also take a comfortable short nap on the back seat and wake up fresh .\nDue to the above mentioned reasons , I am going to conclude that travelling by car is much more convenient .\nMy name is Sarah .\nI am 17 years old .\nI am looking forward to join you in this year summer camps .\nI love children , and I enjoy looking after them . also , I organized many sports activities before in my school .\nIn addition to that , i enjoy cooking .\nMy family think that my cook is amazing .\nI hope that you give my the chance to join you .\nThanks\nMy favourite sport is volleyball because I love plays with my friends .'
 # python3 -m systems.greco $'When I was younger I used to say that I wanted to be a teacher , a saleswoman and even a butcher .. I do n\'t know why .\nI would like to study Psychology because one day I would open my own psychology office and help people .\nIt \'s difficult because I \'ll have to study hard and a lot , but I think that if you like a subject , you \'ll study it easier .\nMaybe I \'ll change my mind , maybe not .\nI think that the public transport will always be in the future .\nThe rich people will buy a car but the poor people always need to use a bus or taxi .\nI consider that is more convenient to drive a car because you carry on more things in your own car than travelling by car .\nAlso , you \'ll meet friendly people who usually ask to you something to be friends and change your telephone number .\nIn my experience when I did n\'t have a car I used to use the bus to go to the school and go back to my house .\nIn my opinion , the car is n\'t necessary when you have crashed in the street , in that moment you realized the importance of a public transport .\nIn India we have various types of Public transport , like Cycle , Bike , Car , Train & Flight .\nDepending on the distance and duration to the desired place , mode of transport is chosen accordingly .\nBut Generally speaking , travelling by car is much more fun when compared with other modes of transport .\nThis reminds me of a trip that I have recently been to and the place is Agra .\nIt takes around 6 hours by National highway to go from Delhi to Agra .\nWe have stopped at hotels for having food and just in case if any of us feels hungry , we have purchased some snacks just before the trip .\nSince , we have the option to wait anytime we want to when we travel by car ( which is impossible when travelling by train & Flight ) .\nIn addition to it , we can also take a comfortable short nap on the back seat and wake up fresh .\nDue to the above mentioned reasons , I am going to conclude that travelling by car is much more convenient .\nMy name is Sarah .\nI am 17 years old .\nI am looking forward to join you in this year summer camps .\nI love children , and I enjoy looking after them . also , I organized many sports activities before in my school .\nIn addition to that , i enjoy cooking .\nMy family think that my cook is amazing .\nI hope that you give my the chance to join you .\nThanks\nMy favourite sport is volleyball because I love plays with my friends .'
@@ -121,16 +134,60 @@ MAX_SCORE_CAP = 110  # Maximum allowed score
 # CHUNK_OVERLAP_IN_TOKENS = 50
 
 
+# CONFIGS: EDIT EXTRACTION
+# Worker processes for nlp.pipe; only used once a run has more distinct
+# sentences than EDIT_EXTRACTION_BATCH_SIZE
+EDIT_EXTRACTION_N_PROCESS = 1
+EDIT_EXTRACTION_BATCH_SIZE = 256
+
+
 # CONFIGS: PATHS
 # ABCN dev set
 CEFR_LEVEL_FILENAME = "ABCN.dev.gold.bea19.first5"
 TEST_FILE_PATH = f"test/{CEFR_LEVEL_FILENAME}.orig"
 FINAL_OUTPUT_PATH = f"corrected_output/{CEFR_LEVEL_FILENAME}.corrected"
 CSV_OUTPUT_PATH = f"corrected_output/{CEFR_LEVEL_FILENAME}.corrected.csv"
+RESPONSE_CACHE_PATH = "cache/responses.sqlite3"
+DOC_CACHE_PATH = "cache/docs.sqlite3"
+
+
+# CONFIGS: RESPONSE CACHE
+# "readwrite": reuse and store responses; "readonly": reuse only, for
+# reproducible evaluation runs; "off": always call the API
+RESPONSE_CACHE_MODE = "readwrite"
+RESPONSE_CACHE_MAX_SIZE_BYTES = 1024 * 1024 * 1024  # 1 GiB
+RESPONSE_CACHE_MAX_AGE_SECONDS: Optional[float] = None  # Never expire
+
+
+# CONFIGS: REPLAY
+# "off": call the real endpoints; "record": call them and append every
+# request/response to REPLAY_CASSETTE_PATH; "replay": serve responses from
+# the cassette only, so the whole workflow (including quality estimation)
+# runs offline. Set RESPONSE_CACHE_MODE = "off" when replaying for load
+# tests, otherwise cached responses skip the client and its latency.
+# Recording bypasses the response cache, so every request reaches the
+# cassette.
+REPLAY_MODE = "off"
+REPLAY_CASSETTE_PATH = "cache/greco.cassette.jsonl"
+# Replayed latency: scale * recorded + fixed seconds + uniform(0, jitter)
+REPLAY_LATENCY_SCALE = 1.0
+REPLAY_LATENCY_SECONDS = 0.0
+REPLAY_LATENCY_JITTER = 0.0
+REPLAY_SEED: Optional[int] = 0
+
+
+# CONFIGS: TRACING
+# Append every span (workflow, stage, LLM call) to TRACE_OUTPUT_PATH; print
+# each batch's critical path with `python3 -m metrics.tracing <path>`
+TRACING_ENABLED = True
+# Serve Prometheus metrics on http://127.0.0.1:<port>/metrics (None to
+# disable); ignored by --worker processes, which only write the trace file
+METRICS_PORT: Optional[int] = None
 
 
 # CONFIGS: API
 AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT", "")
+# e.g. http://127.0.0.1:8000/v1 for `python3 -m clients.mock_llm_server`
 LOCAL_ENDPOINT = os.getenv("LOCAL_ENDPOINT", "")
 TOGETHER_ENDPOINT = os.getenv("TOGETHER_ENDPOINT", "")
 TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY", "")
@@ -138,8 +195,10 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY", "")
 COZE_API_KEY = os.getenv("COZE_API_KEY", "")
 RETRY_DELAY = 5  # Delay in seconds before retrying an API
-# QPM_LIMIT = 5  # Queries per minute limit
-QPM_LIMIT = 4  # Queries per minute limit
+# In-flight requests per model to start with; the adaptive concurrency
+# controller raises it while latency is flat and halves it on 429/5xx
+INITIAL_CONCURRENCY = 4
+MAX_CONCURRENCY = 32
 # MAX_RETRIES = 3  # Maximum number of retries for an API call
 MAX_RETRIES = 10  # Maximum number of iterations to attempt to complete JSON or due to other retry conditions
 CONTINUE_PROMPT = "Continue to complete the JSON above."
@@ -402,9 +461,9 @@ run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 # Define log file paths with the unique run identifier
 LOGGING_OUTPUT_PATH = f"logs/run_{run_id}.log"
 ERROR_OUTPUT_PATH = f"logs/error_{run_id}.log"
+TRACE_OUTPUT_PATH = f"logs/trace_{run_id}.jsonl"
 
 
-# Configure logging to output to a file
 parser = argparse.ArgumentParser(description="Process some inputs.")
 parser.add_argument(
     "input_text",
@@ -417,44 +476,68 @@ parser.add_argument(
     action="store_true",
     help="Run in quiet mode, producing only the final output.",
 )
-args = parser.parse_args()
+parser.add_argument(
+    "--worker",
+    action="store_true",
+    help="Run as a long-lived worker that reads length-prefixed JSON batches "
+    "from stdin (or --socket) and streams back the results.",
+)
+parser.add_argument(
+    "--socket",
+    default=None,
+    help="Serve worker requests on this Unix socket path instead of stdin.",
+)
 
 
-if args.quiet:
-    # Configure logging to exclude stdout for quiet mode
-    logging.basicConfig(
-        level=logging.INFO,
-        format=f"{BLUE}%(asctime)s{RESET} - %(levelname)s - %(message)s",
-        handlers=[
-            logging.FileHandler(LOGGING_OUTPUT_PATH),
-        ],
-    )
-else:
-    # Existing logging configuration that includes stdout
+# Configure logging to output to a file
+# NOTE: only called when run as a script; when imported in-process (see
+# clients/greco.py) the caller's logging configuration is used instead
+def configure_logging(quiet: bool = False) -> None:
+    handlers: List[logging.Handler] = [
+        logging.FileHandler(LOGGING_OUTPUT_PATH)
+    ]
+    if not quiet:
+        # Existing logging configuration that includes stdout
+        handlers.append(logging.StreamHandler())
+
     logging.basicConfig(
         level=logging.INFO,
         format=f"{BLUE}%(asctime)s{RESET} - %(levelname)s - %(message)s",
-        handlers=[
-            logging.FileHandler(LOGGING_OUTPUT_PATH),
-            logging.StreamHandler(),
-        ],
+        handlers=handlers,
     )
 
+    # Create a separate handler for error logs
+    error_handler = logging.FileHandler(ERROR_OUTPUT_PATH)
+    error_handler.setLevel(logging.ERROR)
+    error_handler.setFormatter(
+        logging.Formatter(
+            f"{RED}%(asctime)s{RESET} - %(levelname)s - %(message)s"
+        )
+    )
 
-# Create a separate handler for error logs
-error_handler = logging.FileHandler(ERROR_OUTPUT_PATH)
-error_handler.setLevel(logging.ERROR)
-error_handler.setFormatter(
-    logging.Formatter(f"{RED}%(asctime)s{RESET} - %(levelname)s - %(message)s")
-)
+    # Get the root logger and add the error handler
+    root_logger = logging.getLogger()
+    root_logger.addHandler(error_handler)
 
-# Get the root logger and add the error handler
-root_logger = logging.getLogger()
-root_logger.addHandler(error_handler)
 
 # Initialize the OpenAI client based on the selected model
 # TODO: return type
 def get_openai_client(model_name: str) -> Any:
+    # Mock GEC systems already answer offline from local CSVs
+    if REPLAY_MODE != "off" and model_name not in MOCK_GEC_MODELS:
+        return AsyncReplayClient(
+            REPLAY_CASSETTE_PATH,
+            mode=REPLAY_MODE,
+            client_factory=lambda: create_openai_client(model_name),
+            latency_scale=REPLAY_LATENCY_SCALE,
+            latency_seconds=REPLAY_LATENCY_SECONDS,
+            latency_jitter=REPLAY_LATENCY_JITTER,
+            seed=REPLAY_SEED,
+        )
+    return create_openai_client(model_name)
+
+
+def create_openai_client(model_name: str) -> Any:
     if model_name in GROQ_MODELS:
         return groq.AsyncGroq(api_key=GROQ_API_KEY)
     if model_name in LOCAL_LLM_MODELS:
@@ -480,6 +563,31 @@ def get_openai_client(model_name: str) -> Any:
     )
 
 
+# Clients are reused across batches so that a long-lived process (e.g. the
+# in-process engine in clients/greco.py) does not reload the mock CSVs or
+# rebuild HTTP connection pools for every request
+openai_clients: Dict[str, Any] = {}
+
+
+def get_cached_openai_client(model_name: str) -> Any:
+    if model_name not in openai_clients:
+        openai_clients[model_name] = get_openai_client(model_name)
+    return openai_clients[model_name]
+
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_PATH,
+    mode=RESPONSE_CACHE_MODE,
+    max_size_bytes=RESPONSE_CACHE_MAX_SIZE_BYTES,
+    max_age_seconds=RESPONSE_CACHE_MAX_AGE_SECONDS,
+)
+
+# Shared with main.py when the workflow runs in-process, so its spans join
+# the trace of the batch that called it
+tracer = get_tracer()
+usage_tracker = get_usage_tracker()
+
+
 class InputParser:
     @staticmethod
     def parse_input(input_string: str) -> List[str]:
@@ -609,6 +717,80 @@ def merge_responses(previous_response: str, next_response: str) -> str:
         return trimmed_previous_response + trimmed_next_response
 
 
+def get_missing_items(
+    input_items: List[Dict[str, Any]], completed_items: Dict[int, Any]
+) -> List[Dict[str, Any]]:
+    return [
+        item
+        for item in input_items
+        if item["unique_index"] not in completed_items
+    ]
+
+
+def read_items(
+    response: str,
+    items_key: str,
+    input_items: List[Dict[str, Any]],
+    completed_items: Dict[int, Any],
+    usage_key: Optional[tuple] = None,
+) -> str:
+    """
+    Adds the items of `response` to `completed_items` by their unique index
+    and returns the whole output once every input item has one.
+
+    Items are matched to the missing input items by "unique_index", or in
+    order when the model left it out. Items whose index is already
+    completed or not in the input are dropped, so they are asked for again
+    instead of being stored under another item's index. Raises
+    JSONDecodeError while items are still missing, like an incomplete
+    response would.
+    """
+    missing = [
+        item["unique_index"]
+        for item in get_missing_items(input_items, completed_items)
+    ]
+    dropped_items = []
+    parser = IncrementalJSONParser(items_key)
+    for item in parser.feed(response):
+        if not missing:
+            break
+        if isinstance(item, dict) and "unique_index" in item:
+            index = item["unique_index"]
+            # Some models quote the index
+            if isinstance(index, str) and index.strip().isdigit():
+                index = int(index)
+        else:
+            index = missing[0]
+        if index not in missing:
+            dropped_items.append(json.dumps(item))
+            continue
+        completed_items[index] = item
+        missing.remove(index)
+
+    if usage_key is not None:
+        # The item that was cut off, items that did not parse and items
+        # that were dropped
+        usage_tracker.record_discarded(
+            *usage_key,
+            parser.pending
+            + "".join(parser.invalid_items)
+            + "".join(dropped_items),
+        )
+    if missing:
+        raise json.JSONDecodeError(
+            f"{len(missing)} of {len(input_items)} items missing",
+            response,
+            len(response),
+        )
+    return json.dumps(
+        {
+            items_key: [
+                completed_items[item["unique_index"]] for item in input_items
+            ]
+        }
+    )
+
+
 async def ask_llm(
     prompt: str,
     text: str,
@@ -620,11 +802,33 @@ async def ask_llm(
     is_json: bool = True,  # Indicates if the response should be JSON
     extra_model_params: Optional[dict] = None,
     json_config: Optional[Dict[str, Any]] = None,
+    stage: str = "generation",  # Stage the usage of this call is counted in
 ) -> List[str]:
-    client = get_openai_client(model_name)
+    client = get_cached_openai_client(model_name)
+    concurrency_controller = get_concurrency_controller(
+        model_name,
+        INITIAL_CONCURRENCY,
+        max_limit=MAX_CONCURRENCY,
+        tracer=tracer,
+    )
     iteration = 0  # Initialize iteration counter
     incomplete_json = False  # Flag to indicate if the previous attempt failed due to incomplete JSON
+    continuations = 0  # Requests sent to complete a truncated JSON response
+    cached_responses = 0
     response = ""
+    # Kept for the dead-letter entry if every attempt fails
+    last_error: Optional[BaseException] = None
+    last_response = ""
+    # Mock GEC systems already answer from local CSVs, spending no tokens.
+    # A cache hit never reaches the client, so while recording it would be
+    # missing from the cassette
+    use_response_cache = (
+        model_name not in MOCK_GEC_MODELS and REPLAY_MODE != "record"
+    )
+    track_usage = model_name not in MOCK_GEC_MODELS
+    # Responses (including partial ones followed by continuations) are only
+    # cached once the merged response parses, so bad output is not replayed
+    pending_cache_entries: List[tuple] = []
 
     # Default model parameters
     default_model_params = {
@@ -649,131 +853,241 @@ async def ask_llm(
     if json_config:
         default_json_config.update(json_config)
 
+    # With an "items_key", `text` is a JSON list of items with a
+    # "unique_index" and the response's items are read as they arrive, so
+    # after a cut-off response only the missing items are asked for again
+    items_key = default_json_config.get("items_key")
+    if items_key is not None:
+        input_items = json.loads(text)
+        completed_items: Dict[int, Any] = {}
+
     logging.info(
         f"[{model_name}] default_model_params : {default_model_params}"
     )
     logging.info(f"[{model_name}] default_json_config : {default_json_config}")
 
-    while iteration < MAX_RETRIES:
-        try:
-            logging.info(
-                f"[{model_name}] Sending request for batch {batch_number}/{total_batches}: {text}"
-            )
+    with tracer.span("ask_llm", model=model_name) as span:
+        # The main.py batch this call belongs to, if any
+        usage_key = (model_name, stage, span.attributes.get("batch_number"))
+        while iteration < MAX_RETRIES:
+            next_response = ""
+            try:
+                request_text = text
+                if items_key is not None and completed_items:
+                    request_text = json.dumps(
+                        get_missing_items(input_items, completed_items)
+                    )
 
-            # TODO: pass in model params, else use default
-            model_params = {
-                **default_model_params,  # Spread the default (or updated) model parameters
-                "model": model_name,
-                "messages": [
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": text},
-                ],
-            }
+                logging.info(
+                    f"[{model_name}] Sending request for batch {batch_number}/{total_batches}: {request_text}"
+                )
 
-            if model_name in OPENAI_JSON_MODE_SUPPORTED_MODELS:
-                model_params["response_format"] = {"type": "json_object"}
-
-            if iteration == 0 or not incomplete_json:
-                # Initial request or a retry not caused by incomplete JSON
-                model_params["messages"] = [
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": text},
-                ]
-            else:
-                # Retry due to incomplete JSON, include continuation prompt and partial response
-
-                model_params["messages"] = [
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": text},
-                    {
-                        "role": "assistant",
-                        "content": response,
-                    },  # Include the last partial JSON response
-                    {"role": "user", "content": CONTINUE_PROMPT},
-                ]
-
-                # del model_params["response_format"]next_response
+                # TODO: pass in model params, else use default
+                model_params = {
+                    **default_model_params,  # Spread the default (or updated) model parameters
+                    "model": model_name,
+                    "messages": [
+                        {"role": "system", "content": prompt},
+                        {"role": "user", "content": request_text},
+                    ],
+                }
 
-                # logging.info(
-                #     f"[{model_name}] {BLUE}Retrying request for batch due to incomplete JSON {batch_number}/{total_batches}: {model_params}{RESET}"
-                # )
+                if model_name in OPENAI_JSON_MODE_SUPPORTED_MODELS:
+                    model_params["response_format"] = {"type": "json_object"}
+
+                if (
+                    iteration == 0
+                    or not incomplete_json
+                    or items_key is not None
+                ):
+                    # Initial request, a retry not caused by incomplete JSON,
+                    # or a request for the missing items only
+                    model_params["messages"] = [
+                        {"role": "system", "content": prompt},
+                        {"role": "user", "content": request_text},
+                    ]
+                else:
+                    # Retry due to incomplete JSON, include continuation prompt and partial response
 
-            # logging.info(
-            #     f"[{model_name}] {BLUE}Sending request for batch {batch_number}/{total_batches}: {model_params}{RESET}"
-            # )
+                    model_params["messages"] = [
+                        {"role": "system", "content": prompt},
+                        {"role": "user", "content": text},
+                        {
+                            "role": "assistant",
+                            "content": response,
+                        },  # Include the last partial JSON response
+                        {"role": "user", "content": CONTINUE_PROMPT},
+                    ]
 
-            completion = await client.chat.completions.create(**model_params)
-            next_response = completion.choices[0].message.content
-            response = merge_responses(response, next_response)
+                    # del model_params["response_format"]next_response
 
-            logging.info(
-                f"[{model_name}] Received next response for batch {batch_number}/{total_batches}: {response}"
-            )
+                    # logging.info(
+                    #     f"[{model_name}] {BLUE}Retrying request for batch due to incomplete JSON {batch_number}/{total_batches}: {model_params}{RESET}"
+                    # )
 
-            # TODO: debug special character
-            logging.info(
-                f"[{model_name}] {YELLOW}Merged response for batch {batch_number}/{total_batches}: {response}{RESET}"
-            )
+                # logging.info(
+                #     f"[{model_name}] {BLUE}Sending request for batch {batch_number}/{total_batches}: {model_params}{RESET}"
+                # )
 
-            # Reset the incomplete_json flag for the next iteration
-            incomplete_json = False
+                cached_response = (
+                    response_cache.get(model_params)
+                    if use_response_cache
+                    else None
+                )
+                if cached_response is not None:
+                    logging.info(
+                        f"[{model_name}] Using cached response for batch {batch_number}/{total_batches}"
+                    )
+                    next_response = cached_response.content
+                    cached_responses += 1
+                    span.set(cached_responses=cached_responses)
+                    if track_usage:
+                        usage_tracker.record(
+                            *usage_key,
+                            model_params,
+                            next_response,
+                            cached=True,
+                        )
+                else:
+                    async with concurrency_controller.slot():
+                        completion = await client.chat.completions.create(
+                            **model_params
+                        )
+                    next_response = completion.choices[0].message.content
+                    span.add_usage(getattr(completion, "usage", None))
+                    if track_usage:
+                        usage_tracker.record(
+                            *usage_key,
+                            model_params,
+                            next_response,
+                            getattr(completion, "usage", None),
+                            continuation=incomplete_json,
+                        )
+                    if use_response_cache:
+                        pending_cache_entries.append(
+                            (
+                                model_params,
+                                next_response,
+                                getattr(completion, "usage", None),
+                            )
+                        )
+                if items_key is not None:
+                    response = read_items(
+                        next_response,
+                        items_key,
+                        input_items,
+                        completed_items,
+                        usage_key if track_usage else None,
+                    )
+                else:
+                    response = merge_responses(response, next_response)
 
-            if is_json:
-                # Attempt to parse the JSON to check completeness
-                json.loads(response)
                 logging.info(
-                    f"[{model_name}] Received complete JSON response for batch {batch_number}/{total_batches}"
+                    f"[{model_name}] Received next response for batch {batch_number}/{total_batches}: {response}"
                 )
 
-            # If successful, process and return the parsed output
-            parsed_output = output_parser(response)
-            return parsed_output
-
-        except json.JSONDecodeError as e:
-            if not is_json:
-                raise e  # If not expecting JSON, re-raise the exception
-
-            # Set the flag indicating that this retry will be due to incomplete JSON
-            incomplete_json = True
-            logging.warning(
-                f"[{model_name}] Received incomplete JSON, attempting to repair and continue."
-            )
+                # TODO: debug special character
+                logging.info(
+                    f"[{model_name}] {YELLOW}Merged response for batch {batch_number}/{total_batches}: {response}{RESET}"
+                )
 
-            # Extract relevant configurations from json_config
-            end_sequences = default_json_config["end_sequences"]
+                # Reset the incomplete_json flag for the next iteration
+                incomplete_json = False
 
-            response = trim_to_last_complete_sequence(
-                response,
-                end_sequences=end_sequences,
-            )
+                if is_json:
+                    # Attempt to parse the JSON to check completeness
+                    json.loads(response)
+                    logging.info(
+                        f"[{model_name}] Received complete JSON response for batch {batch_number}/{total_batches}"
+                    )
 
-            logging.info(f"[{model_name}] Repaired JSON: {response}")
+                # If successful, process and return the parsed output
+                parsed_output = output_parser(response)
+                for (
+                    cache_params,
+                    cache_response,
+                    usage,
+                ) in pending_cache_entries:
+                    response_cache.put(cache_params, cache_response, usage)
+                return parsed_output
+
+            except json.JSONDecodeError as e:
+                if not is_json:
+                    raise e  # If not expecting JSON, re-raise the exception
+
+                # With items, `response` is only set once every item is in,
+                # so the response that failed is the one just received
+                last_error = e
+                last_response = (
+                    next_response if items_key is not None else response
+                )
+                # Set the flag indicating that this retry will be due to incomplete JSON
+                incomplete_json = True
+                continuations += 1
+                span.set(continuations=continuations)
+                logging.warning(
+                    f"[{model_name}] Received incomplete JSON, attempting to repair and continue."
+                )
+                if items_key is not None:
+                    # Nothing to repair: the items read so far are kept
+                    logging.info(
+                        f"[{model_name}] Asking for the {len(input_items) - len(completed_items)} of {len(input_items)} items still missing"
+                    )
+                else:
+                    # Extract relevant configurations from json_config
+                    end_sequences = default_json_config["end_sequences"]
 
-        except Exception as e:
-            response = ""
-            logging.error(
-                f"[{model_name}] An error occurred while processing: {e}"
-            )
+                    trimmed_response = trim_to_last_complete_sequence(
+                        response,
+                        end_sequences=end_sequences,
+                    )
+                    if track_usage:
+                        usage_tracker.record_discarded(
+                            *usage_key, response[len(trimmed_response) :]
+                        )
+                    response = trimmed_response
+
+                    logging.info(f"[{model_name}] Repaired JSON: {response}")
+
+            except Exception as e:
+                last_error, last_response = e, response
+                if track_usage:
+                    usage_tracker.record_discarded(*usage_key, response)
+                response = ""
+                pending_cache_entries = []
+                if items_key is not None and len(completed_items) == len(
+                    input_items
+                ):
+                    # The assembled output was rejected, so none of its
+                    # items can be trusted
+                    completed_items.clear()
+                logging.error(
+                    f"[{model_name}] An error occurred while processing: {e}"
+                )
 
-        # Increment the iteration after handling all exceptions
-        iteration += 1
-        if iteration >= MAX_RETRIES:
-            return await handle_max_retries(
-                model_name,
-                fallback_model_name,
-                prompt,
-                text,
-                batch_number,
-                total_batches,
-                output_parser,
-                is_json,
-            )
+            # Increment the iteration after handling all exceptions
+            iteration += 1
+            span.set(retries=iteration)
+            if iteration >= MAX_RETRIES:
+                return await handle_max_retries(
+                    model_name,
+                    fallback_model_name,
+                    prompt,
+                    text,
+                    batch_number,
+                    total_batches,
+                    output_parser,
+                    is_json,
+                    stage,
+                    last_error,
+                    last_response,
+                )
 
-    # If loop exits due to reaching MAX_RETRIES
-    logging.error(
-        f"[{model_name}] Failed to complete JSON or recover from error after maximum iterations."
-    )
-    raise RuntimeError("Maximum iteration limit reached.")
+        # If loop exits due to reaching MAX_RETRIES
+        logging.error(
+            f"[{model_name}] Failed to complete JSON or recover from error after maximum iterations."
+        )
+        raise RuntimeError("Maximum iteration limit reached.")
 
 
 async def handle_max_retries(
@@ -785,7 +1099,12 @@ async def handle_max_retries(
     total_batches,
     output_parser,
     is_json,
+    stage,
+    last_error=None,
+    last_response="",
 ):
+    # Raises instead of exiting, so one failed batch does not end the run:
+    # main.py dead-letters the batch and the worker answers with an error
     if fallback_model_name:
         logging.info(
             f"[{model_name}] Max retries reached, switching to fallback model: {fallback_model_name}"
@@ -803,20 +1122,23 @@ async def handle_max_retries(
                 output_parser=output_parser,
                 fallback_model_name=None,  # Ensure no further fallback attempts
                 is_json=is_json,
+                stage=stage,
             )
             return fallback_response
         except Exception as e:
-            # If the fallback attempt also fails, log the error and exit
+            # If the fallback attempt also fails, log the error and give up
             logging.error(
                 f"[{fallback_model_name}] Fallback attempt failed: {e}"
             )
-            sys.exit(1)
+            raise
     else:
         # No fallback model specified, or fallback attempt failed
         logging.error(
-            f"[{model_name}] Max retries reached with no available fallback. Exiting."
+            f"[{model_name}] Max retries reached with no available fallback."
+        )
+        raise LLMCallError(
+            last_error or RuntimeError("Max retries reached"), last_response
         )
-        sys.exit(1)
 
 
 async def mock_gec_system(
@@ -830,59 +1152,52 @@ async def mock_gec_system(
     prepared_input = ModelIOParser.prepare_model_input(input_sentences)
     # TODO: Implement the mock GEC system logic here
 
-    model_output = await ask_llm(
-        prompt=GRAMMAR_PROMPT,
-        text=prepared_input,
-        batch_number=1,
-        total_batches=1,
-        model_name=model_name,
-        fallback_model_name=fallback_model_name,
-        output_parser=lambda response: ModelIOParser.parse_model_output(
-            response, input_sentences
-        ),
-    )
+    with tracer.span("mock_gec_system", model=model_name, model_id=model_id):
+        model_output = await ask_llm(
+            prompt=GRAMMAR_PROMPT,
+            text=prepared_input,
+            batch_number=1,
+            total_batches=1,
+            model_name=model_name,
+            fallback_model_name=fallback_model_name,
+            output_parser=lambda response: ModelIOParser.parse_model_output(
+                response, input_sentences
+            ),
+        )
 
     return model_id, model_output
 
 
 # Additional components (Aggregate Node, Condition Node, etc.) remain similar
 # to the previous code skeleton and should be implemented accordingly
-async def extract_edits(aggregated_responses, input_sentences):
+def create_edit_extractor() -> EditExtractor:
+    doc_cache = get_doc_cache(
+        nlp,
+        DOC_CACHE_PATH,
+        n_process=EDIT_EXTRACTION_N_PROCESS,
+        batch_size=EDIT_EXTRACTION_BATCH_SIZE,
+    )
+    return EditExtractor(doc_cache, annotator)
+
+
+@tracer.trace("extract_edits")
+async def extract_edits(
+    aggregated_responses,
+    input_sentences,
+    edit_extractor: Optional[EditExtractor] = None,
+):
     """
     Extracts edits from corrected sentences using ERRANT.
 
     :param aggregated_responses: Dictionary with model IDs as keys and lists of corrected sentences as values.
     :param input_sentences: List of original sentences.
+    :param edit_extractor: Extractor whose parsed sentences and edits are reused across calls.
     :return: Dictionary with model IDs as keys and lists of edits for each sentence as values.
     """
-    edits_output = {}
-
-    for model_id, corrected_sentences in aggregated_responses.items():
-        model_edits = []
-        for original_sentence, corrected_sentence in zip(
-            input_sentences, corrected_sentences
-        ):
-            # Parse the original and corrected sentences
-            orig_doc = nlp(original_sentence)
-            cor_doc = nlp(corrected_sentence)
-
-            # Generate ERRANT edits
-            edits = annotator.annotate(orig_doc, cor_doc)
-
-            # Convert edits to M2 format
-            edit_list = [edit.to_m2() for edit in edits]
-
-            sentence_output = {
-                "original_sentence": original_sentence,
-                "corrected_sentence": corrected_sentence,
-                "edits": edit_list,
-            }
+    if edit_extractor is None:
+        edit_extractor = create_edit_extractor()
 
-            model_edits.append(sentence_output)
-
-        edits_output[model_id] = model_edits
-
-    return edits_output
+    return edit_extractor.extract_edits(aggregated_responses, input_sentences)
 
 
 def calculate_edit_votes(edits_output):
@@ -940,6 +1255,7 @@ def quality_estimation_output_parser(
         raise ValueError(f"Failed to decode JSON response: {str(e)}")
 
 
+@tracer.trace("quality_estimation_node")
 async def quality_estimation_node(
     input_sentences: List[str],
     aggregated_responses: Dict[str, List[str]],
@@ -994,7 +1310,7 @@ async def quality_estimation_node(
             "frequency_penalty": QUALITY_ESTIMATION_FREQUENCY_PENALTY,
         }
 
-        json_config = {"end_sequences": ['"student_sentence_feedback": [']}
+        json_config = {"items_key": "evaluations"}
 
         ask_llm_task = ask_llm(
             prompt=prompt,
@@ -1011,6 +1327,7 @@ async def quality_estimation_node(
             is_json=True,
             extra_model_params=extra_model_params,
             json_config=json_config,
+            stage="quality_estimation",
         )
 
         ask_llm_tasks.append((model_id, ask_llm_task))
@@ -1036,6 +1353,7 @@ async def quality_estimation_node(
 # TODO: fix this node
 
 
+@tracer.trace("quality_adjustment_node")
 async def quality_adjustment_node(
     quality_scores: Dict[str, List[float]],
     edit_votes: Dict[str, int],
@@ -1072,6 +1390,7 @@ async def quality_adjustment_node(
     return adjusted_quality_scores
 
 
+@tracer.trace("system_combination_node")
 async def system_combination_node(
     adjusted_quality_scores: Dict[str, List[float]],
     aggregated_responses: Dict[str, List[str]],
@@ -1142,7 +1461,13 @@ def combine_dicts(
 
 
 async def execute_workflow(input_string: str) -> str:
+    with get_stage_timer().stage("workflow"), tracer.span("workflow"):
+        return await run_workflow(input_string)
+
+
+async def run_workflow(input_string: str) -> str:
     start_time = datetime.datetime.now()  # Start timing the workflow
+    stage_timer = get_stage_timer()
 
     input_sentences = InputParser.parse_input(input_string)
     models: List[dict[str, str]] = [
@@ -1157,7 +1482,8 @@ async def execute_workflow(input_string: str) -> str:
         for model_id in models
     ]
     model_responses_start = datetime.datetime.now()
-    model_responses = await asyncio.gather(*tasks)
+    with stage_timer.stage("generation"):
+        model_responses = await asyncio.gather(*tasks)
     model_responses_end = datetime.datetime.now()
     logging.info(
         f"Model responses gathered in {model_responses_end - model_responses_start}."
@@ -1168,16 +1494,17 @@ async def execute_workflow(input_string: str) -> str:
     }
 
     quality_and_edits_start = datetime.datetime.now()
-    (
-        quality_estimation,
-        teacher_quality_estimation,
-        teacher_aggregated_responses,
-    ) = await quality_estimation_node(
-        input_sentences,
-        aggregated_responses,
-        models,
-        QUALITY_ESTIMATION_MODEL_NAME,
-    )
+    with stage_timer.stage("quality_estimation"):
+        (
+            quality_estimation,
+            teacher_quality_estimation,
+            teacher_aggregated_responses,
+        ) = await quality_estimation_node(
+            input_sentences,
+            aggregated_responses,
+            models,
+            QUALITY_ESTIMATION_MODEL_NAME,
+        )
 
     quality_and_edits_end = datetime.datetime.now()
     logging.info(
@@ -1198,13 +1525,21 @@ async def execute_workflow(input_string: str) -> str:
     # print("kw5", quality_estimation)
     # print("kw6", aggregated_responses)
 
+    # Shared by both pools: the augmented pool contains every base pool
+    # correction, so those are parsed and annotated only once
+    edit_extractor = create_edit_extractor()
+
     best_sentences = await select_best_sentences(
-        quality_estimation, aggregated_responses, input_sentences
+        quality_estimation,
+        aggregated_responses,
+        input_sentences,
+        edit_extractor,
     )
     best_sentences_augmented_pool = await select_best_sentences(
         quality_estimation_augmented_pool,
         aggregated_responses_augmented_pool,
         input_sentences,
+        edit_extractor,
     )
 
     end_time = datetime.datetime.now()
@@ -1223,24 +1558,31 @@ async def select_best_sentences(
     quality_estimation: Dict[str, List[float]],
     aggregated_responses: Dict[str, List[str]],
     input_sentences: List[str],
+    edit_extractor: Optional[EditExtractor] = None,
 ):
-    edits_output = await extract_edits(aggregated_responses, input_sentences)
+    stage_timer = get_stage_timer()
+    with stage_timer.stage("edit_extraction"):
+        edits_output = await extract_edits(
+            aggregated_responses, input_sentences, edit_extractor
+        )
 
     edit_votes = calculate_edit_votes(edits_output)
 
     adjusted_quality_scores_start = datetime.datetime.now()
-    adjusted_quality_scores = await quality_adjustment_node(
-        quality_estimation, edit_votes, edits_output
-    )
+    with stage_timer.stage("quality_adjustment"):
+        adjusted_quality_scores = await quality_adjustment_node(
+            quality_estimation, edit_votes, edits_output
+        )
     adjusted_quality_scores_end = datetime.datetime.now()
     logging.info(
         f"Adjusted quality scores calculated in {adjusted_quality_scores_end - adjusted_quality_scores_start}."
     )
 
     best_sentences_start = datetime.datetime.now()
-    best_sentences = await system_combination_node(
-        adjusted_quality_scores, aggregated_responses
-    )
+    with stage_timer.stage("system_combination"):
+        best_sentences = await system_combination_node(
+            adjusted_quality_scores, aggregated_responses
+        )
     best_sentences_end = datetime.datetime.now()
     logging.info(
         f"Best sentences selection completed in {best_sentences_end - best_sentences_start}."
@@ -1265,6 +1607,72 @@ async def select_best_sentences(
     return best_sentences
 
 
+async def handle_worker_connection(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """
+    Serves batches sent by clients/greco.py's GrecoWorkerPool.
+
+    Request frame:  {"id": 1, "query": "sentence 1\nsentence 2"}
+    Response frame: {"id": 1, "best_sentences": [...],
+                     "best_sentences_augmented_pool": [...]}
+                or: {"id": 1, "error": "...", "raw_response": "..."}
+    """
+    while True:
+        request = await read_frame(reader)
+        if request is None:
+            break
+
+        request_id = request.get("id")
+        try:
+            output = json.loads(await execute_workflow(request["query"]))
+            response = {"id": request_id, **output}
+        except Exception as e:
+            logging.error(
+                f"[worker] Failed to process request {request_id}: {e}"
+            )
+            response = {
+                "id": request_id,
+                "error": str(e),
+                # What the LLM answered last, for the caller's dead letter
+                "raw_response": getattr(e, "raw_response", ""),
+            }
+
+        await write_frame(writer, response)
+
+    writer.close()
+
+
+async def serve_worker(socket_path: Optional[str] = None) -> None:
+    if socket_path is not None:
+        server = await asyncio.start_unix_server(
+            handle_worker_connection, path=socket_path
+        )
+        logging.info(f"[worker] Listening on {socket_path}")
+        async with server:
+            await server.serve_forever()
+        return
+
+    # Keep the real stdout for frames and send anything else that writes to
+    # stdout (stray prints, C extensions) to stderr so it can't corrupt them
+    rpc_stdout = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer
+    )
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, rpc_stdout
+    )
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+
+    logging.info("[worker] Serving requests on stdin")
+    await handle_worker_connection(reader, writer)
+
+
 async def read_input_file(file_path: str) -> str:
     """Reads the input file and returns its content."""
     async with aiofiles.open(file_path, "r") as f:
@@ -1272,6 +1680,14 @@ async def read_input_file(file_path: str) -> str:
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
+    configure_logging(args.quiet)
+    if TRACING_ENABLED:
+        tracer.export_to(TRACE_OUTPUT_PATH)
+
+    if args.worker:
+        asyncio.run(serve_worker(args.socket))
+        sys.exit(0)
 
     # print("input_text", args.input_text)
     # print("--quiet", args.quiet)
@@ -1283,7 +1699,11 @@ if __name__ == "__main__":
         # If no input text is provided, you might read from a default file or another source
         input_string = asyncio.run(read_input_file(TEST_FILE_PATH))
 
+    if METRICS_PORT is not None:
+        serve_metrics(tracer, METRICS_PORT)
+
     # Execute the workflow
     output = asyncio.run(execute_workflow(input_string))
+    logging.info(f"Token usage: {usage_tracker.get_totals().get('run')}")
 
     print(output)
@@ -0,0 +1,41 @@
+"""Length-prefixed JSON framing shared by the GRECO worker and its pool."""
+
+import asyncio
+import json
+import struct
+from typing import Any, Dict, Optional
+
+
+# Every frame is a 4-byte big-endian payload length followed by UTF-8 JSON
+FRAME_HEADER = struct.Struct(">I")
+
+
+def encode_frame(message: Dict[str, Any]) -> bytes:
+    payload = json.dumps(message).encode("utf-8")
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[Dict[str, Any]]:
+    """
+    Reads one frame from the stream.
+
+    Returns None on a clean end of stream (the peer closed between frames);
+    raises asyncio.IncompleteReadError if the stream ends mid-frame.
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise
+
+    (length,) = FRAME_HEADER.unpack(header)
+    payload = await reader.readexactly(length)
+    return json.loads(payload.decode("utf-8"))
+
+
+async def write_frame(
+    writer: asyncio.StreamWriter, message: Dict[str, Any]
+) -> None:
+    writer.write(encode_frame(message))
+    await writer.drain()
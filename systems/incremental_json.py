@@ -0,0 +1,141 @@
+"""Incremental parsing of the item arrays in structured LLM output."""
+
+import json
+from typing import Any, List, Optional
+
+
+# What may follow (after whitespace) the opening bracket of the document:
+# a key, or the first item of a bare array. Any other bracket is taken to be
+# part of the text around the document
+DOCUMENT_STARTS = {"{": '"', "[": "{]"}
+
+
+class IncrementalJSONParser:
+    """
+    Parses `{..., "<items_key>": [{...}, {...}, ...], ...}` as it arrives and
+    returns every item of the array as soon as its closing brace is read.
+
+    Only the text of the item being read is kept, so a response that is cut
+    off loses nothing but that one item: `feed` can be called with each
+    streamed delta, and after a truncated response the items already
+    returned never need to be parsed, or asked for, again.
+
+    Text around the document (a ```json fence, a preamble, even one with
+    brackets in it) is skipped, a bare top-level array is read as the item
+    array, and a missing comma
+    between two items (a common seam where a continuation starts) is
+    tolerated.
+
+    Usage:
+        parser = IncrementalJSONParser("evaluations")
+        for chunk in chunks:
+            for item in parser.feed(chunk):
+                ...
+        parser.done  # False if the response was cut off
+    """
+
+    def __init__(self, items_key: str):
+        self.items_key = items_key
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        # A "{" or "[" read outside the document, which opens it only if
+        # the next non-whitespace character fits DOCUMENT_STARTS
+        self.opening: Optional[str] = None
+        # Depth inside the item array once it is opened; -1 once it closed
+        self.items_depth: Optional[int] = None
+        # The last string read directly inside the top-level object; a "["
+        # right after the items key opens the item array
+        self.last_string: Optional[str] = None
+        self.string_chars: Optional[List[str]] = None
+        self.item_chunks: List[str] = []
+        self.in_item = False
+        self.invalid_items: List[str] = []
+        self.done = False
+
+    @property
+    def pending(self) -> str:
+        """The text of the item being read, lost if the response ends."""
+        return "".join(self.item_chunks)
+
+    def feed(self, chunk: str) -> List[Any]:
+        items: List[Any] = []
+        item_start: Optional[int] = 0 if self.in_item else None
+
+        for i, char in enumerate(chunk):
+            if self.done:
+                break
+
+            if self.opening is not None:
+                if char.isspace():
+                    continue
+                if char in DOCUMENT_STARTS[self.opening]:
+                    if self.opening == "[":
+                        # A bare array of items
+                        self.items_depth = 1
+                    self.depth = 1
+                # Either way the character itself is read as usual
+                self.opening = None
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.string_chars is not None:
+                        self.last_string = "".join(self.string_chars)
+                        self.string_chars = None
+                elif self.string_chars is not None:
+                    self.string_chars.append(char)
+                continue
+
+            if char == '"':
+                if self.depth == 0:
+                    continue
+                self.in_string = True
+                if self.depth == 1 and self.items_depth is None:
+                    self.string_chars = []
+            elif char in "{[":
+                if self.depth == 0:
+                    self.opening = char
+                    continue
+                if (
+                    self.depth == 1
+                    and char == "["
+                    and self.items_depth is None
+                    and self.last_string == self.items_key
+                ):
+                    self.items_depth = 2
+                elif self.depth == self.items_depth and char == "{":
+                    self.in_item = True
+                    item_start = i
+                self.depth += 1
+            elif char in "}]":
+                if self.depth == 0:
+                    continue
+                self.depth -= 1
+                if self.depth == self.items_depth and self.in_item:
+                    self.item_chunks.append(chunk[item_start : i + 1])
+                    item_start = None
+                    item_text = self.pending
+                    self.item_chunks = []
+                    self.in_item = False
+                    try:
+                        items.append(json.loads(item_text))
+                    except json.JSONDecodeError:
+                        # Asked for again like an item that never arrived
+                        self.invalid_items.append(item_text)
+                elif (
+                    self.items_depth is not None
+                    and self.depth == self.items_depth - 1
+                ):
+                    # The rest of the document is not read
+                    self.items_depth = -1
+                if self.depth == 0:
+                    self.done = True
+
+        if self.in_item and item_start is not None:
+            self.item_chunks.append(chunk[item_start:])
+        return items